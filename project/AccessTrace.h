@@ -0,0 +1,75 @@
+#ifndef ACCESSTRACE_H
+#define ACCESSTRACE_H
+
+#include <atomic>
+#include <cstdint>
+#include <cstdio>
+#include <mutex>
+#include <string>
+#include <vector>
+
+// KV_TRACE: records the keys live requests touch, in order, so the load
+// generator can replay the traffic (load_gen/keygen.py reads the format).
+//
+// File: the 8 bytes "KVTRACE1", then one 5-byte record per key: the id as
+// a little-endian uint32 and the operation (0 read, 1 write, 2 delete).
+// Records are collected in a 64 KB buffer and written when it fills, so a
+// request only appends under the lock. Recording stops after max_records.
+class AccessTrace {
+public:
+  enum Op : uint8_t { READ = 0, WRITE = 1, DELETE = 2 };
+
+  AccessTrace(const std::string &path, uint64_t max_records)
+      : max_records(max_records) {
+    file = std::fopen(path.c_str(), "wb");
+    if (file)
+      std::fwrite("KVTRACE1", 1, 8, file);
+    buf.reserve(kBuffer);
+  }
+
+  ~AccessTrace() {
+    if (!file)
+      return;
+    write_out();
+    std::fclose(file);
+  }
+
+  bool ok() const { return file != nullptr; }
+  uint64_t records() const { return count.load(); }
+
+  void record(Op op, int id) { record(op, &id, 1); }
+  void record(Op op, const std::vector<int> &ids) {
+    record(op, ids.data(), ids.size());
+  }
+
+private:
+  static const size_t kBuffer = 64 * 1024;
+
+  std::FILE *file;
+  const uint64_t max_records;
+  std::atomic<uint64_t> count{0};
+  std::mutex mtx; // guards buf and the file
+  std::string buf;
+
+  void record(Op op, const int *ids, size_t n) {
+    if (!file || count.load(std::memory_order_relaxed) >= max_records)
+      return;
+    std::lock_guard<std::mutex> lock(mtx);
+    for (size_t i = 0; i < n && count.load() < max_records; i++) {
+      uint32_t id = (uint32_t)ids[i];
+      char rec[5] = {(char)(id & 0xff), (char)((id >> 8) & 0xff),
+                     (char)((id >> 16) & 0xff), (char)(id >> 24), (char)op};
+      buf.append(rec, sizeof(rec));
+      count.fetch_add(1, std::memory_order_relaxed);
+    }
+    if (buf.size() >= kBuffer)
+      write_out();
+  }
+
+  void write_out() {
+    std::fwrite(buf.data(), 1, buf.size(), file);
+    buf.clear();
+  }
+};
+
+#endif // ACCESSTRACE_H
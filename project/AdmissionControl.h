@@ -0,0 +1,137 @@
+#ifndef ADMISSIONCONTROL_H
+#define ADMISSIONCONTROL_H
+
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <cmath>
+#include <cstdint>
+#include <exception>
+#include <mutex>
+#include <stdexcept>
+
+// Thrown when a request is not admitted to the DB path. Handlers answer 503
+// with Retry-After, like PoolTimeout, but without having waited.
+struct Overloaded : std::runtime_error {
+  Overloaded() : std::runtime_error("server overloaded") {}
+};
+
+// Concurrency limit for DB work that adapts to observed latency, following
+// TCP Vegas (as in Netflix' concurrency-limits). With rtt the average latency
+// over the last window and min_rtt the lowest seen (latency without
+// queueing), the number of requests waiting rather than being served is
+//   queue = limit * (1 - min_rtt / rtt)
+// Below alpha the limit grows by sqrt(limit) (if it was actually reached),
+// above beta it shrinks by log10(limit), so it settles where the DB is
+// busy but only a few requests queue. Failed requests (timeouts, DB errors)
+// cut it by 10%. Requests over the limit are rejected at once instead of
+// queueing for a pool connection.
+class AdaptiveLimiter {
+public:
+  AdaptiveLimiter(int initial, int min_limit, int max_limit)
+      : min_limit(std::max(1, min_limit)),
+        max_limit(std::max(this->min_limit, max_limit)) {
+    estimate = std::min<double>(std::max(initial, this->min_limit),
+                                this->max_limit);
+    current.store((int)estimate);
+    window_start = Clock::now();
+  }
+
+  bool try_acquire() {
+    int n = in_flight.load(std::memory_order_relaxed);
+    while (n < current.load(std::memory_order_relaxed)) {
+      if (in_flight.compare_exchange_weak(n, n + 1,
+                                          std::memory_order_relaxed)) {
+        return true;
+      }
+    }
+    rejected.fetch_add(1, std::memory_order_relaxed);
+    return false;
+  }
+
+  void release(std::chrono::steady_clock::duration rtt, bool ok) {
+    int before = in_flight.fetch_sub(1, std::memory_order_relaxed);
+    std::lock_guard<std::mutex> lock(mtx);
+    samples++;
+    if (!ok)
+      drops++;
+    rtt_sum_us +=
+        std::chrono::duration_cast<std::chrono::microseconds>(rtt).count();
+    peak_in_flight = std::max(peak_in_flight, before);
+    auto now = Clock::now();
+    if (samples >= kWindowSamples || now - window_start >= kWindow)
+      update(now);
+  }
+
+  int limit() const { return current.load(); }
+  int in_flight_count() const { return in_flight.load(); }
+  uint64_t rejected_count() const { return rejected.load(); }
+
+private:
+  using Clock = std::chrono::steady_clock;
+  static constexpr int kWindowSamples = 50;
+  static constexpr std::chrono::milliseconds kWindow{100};
+
+  const int min_limit, max_limit;
+  std::atomic<int> current{1};
+  std::atomic<int> in_flight{0};
+  std::atomic<uint64_t> rejected{0};
+
+  std::mutex mtx; // guards the window and the estimates below
+  double estimate;
+  double min_rtt_us = 0;
+  Clock::time_point window_start;
+  int samples = 0, drops = 0, peak_in_flight = 0;
+  uint64_t rtt_sum_us = 0;
+
+  void update(Clock::time_point now) {
+    double rtt = std::max(1.0, double(rtt_sum_us) / samples);
+    // Let min_rtt creep up slowly so a lasting change in DB speed is learnt.
+    min_rtt_us = min_rtt_us == 0 ? rtt : std::min(rtt, min_rtt_us * 1.001);
+
+    double log_limit = std::max(1.0, std::log10(estimate));
+    double alpha = 3 * log_limit, beta = 6 * log_limit;
+    double queue = estimate * (1 - min_rtt_us / rtt);
+    if (drops > 0)
+      estimate *= 0.9;
+    else if (queue > beta)
+      estimate -= log_limit;
+    else if (queue < alpha && peak_in_flight >= (int)estimate)
+      estimate += std::sqrt(estimate); // only when the limit was reached
+    estimate = std::max<double>(min_limit,
+                                std::min<double>(max_limit, estimate));
+    current.store((int)estimate, std::memory_order_relaxed);
+
+    window_start = now;
+    samples = drops = peak_in_flight = 0;
+    rtt_sum_us = 0;
+  }
+};
+
+// One admitted unit of DB work. Throws Overloaded if the limiter is full;
+// reports the latency (and whether it ended in an exception) when it goes
+// out of scope. A null limiter admits everything.
+class DbPermit {
+  AdaptiveLimiter *limiter;
+  std::chrono::steady_clock::time_point start;
+  int exceptions;
+
+public:
+  explicit DbPermit(AdaptiveLimiter *limiter) : limiter(limiter) {
+    if (limiter && !limiter->try_acquire())
+      throw Overloaded();
+    start = std::chrono::steady_clock::now();
+    exceptions = std::uncaught_exceptions();
+  }
+
+  ~DbPermit() {
+    if (limiter)
+      limiter->release(std::chrono::steady_clock::now() - start,
+                       std::uncaught_exceptions() == exceptions);
+  }
+
+  DbPermit(const DbPermit &) = delete;
+  DbPermit &operator=(const DbPermit &) = delete;
+};
+
+#endif // ADMISSIONCONTROL_H
@@ -0,0 +1,201 @@
+#ifndef BULKCOPY_H
+#define BULKCOPY_H
+
+#include <libpq-fe.h>
+
+#include <atomic>
+#include <cstdlib>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include "AdmissionControl.h"
+
+// /bulk/import and /bulk/export: kv_store in COPY text format, one
+// "id<TAB>value" per line (the /mset format, see KVText.h), passed between
+// an HTTP body and Postgres COPY a piece at a time, so neither end holds the
+// whole table. Each transfer has a libpq connection of its own for as long
+// as the client takes, outside the pool.
+
+// A failed COPY. bad_input is set when Postgres rejected the data (SQLSTATE
+// class 22 or 23: a malformed line, a non-integer id, a NULL value).
+struct BulkError : std::runtime_error {
+  bool bad_input;
+  explicit BulkError(const std::string &what, bool bad_input = false)
+      : std::runtime_error(what), bad_input(bad_input) {}
+};
+
+// Caps the transfers running at once, since each holds a connection.
+class BulkLimit {
+public:
+  explicit BulkLimit(long max) : max(max) {}
+  long running() const { return n.load(); }
+
+private:
+  friend class BulkConnection;
+  std::atomic<long> n{0};
+  const long max;
+};
+
+class BulkConnection {
+public:
+  BulkConnection(const BulkConnection &) = delete;
+  BulkConnection &operator=(const BulkConnection &) = delete;
+
+protected:
+  PGconn *conn = nullptr;
+
+  // Throws Overloaded when the limit is reached, BulkError if Postgres
+  // cannot be reached.
+  BulkConnection(const std::string &conninfo, BulkLimit &limit)
+      : limit(limit) {
+    if (limit.n.fetch_add(1) >= limit.max) {
+      limit.n.fetch_sub(1);
+      throw Overloaded();
+    }
+    conn = PQconnectdb(conninfo.c_str());
+    if (PQstatus(conn) != CONNECTION_OK) {
+      std::string error = PQerrorMessage(conn);
+      PQfinish(conn);
+      limit.n.fetch_sub(1);
+      throw BulkError(error);
+    }
+  }
+
+  // Closing the connection rolls back whatever was not committed.
+  ~BulkConnection() {
+    PQfinish(conn);
+    limit.n.fetch_sub(1);
+  }
+
+  void exec(const char *sql, ExecStatusType want = PGRES_COMMAND_OK) {
+    check(PQexec(conn, sql), want);
+  }
+
+  // Takes ownership of r.
+  void check(PGresult *r, ExecStatusType want) {
+    if (PQresultStatus(r) == want) {
+      PQclear(r);
+      return;
+    }
+    std::string error = r ? PQresultErrorMessage(r) : PQerrorMessage(conn);
+    const char *state = r ? PQresultErrorField(r, PG_DIAG_SQLSTATE) : nullptr;
+    bool bad_input =
+        state && state[0] == '2' && (state[1] == '2' || state[1] == '3');
+    PQclear(r);
+    throw BulkError(error, bad_input);
+  }
+
+private:
+  BulkLimit &limit;
+};
+
+// COPY kv_store TO STDOUT, read in pieces.
+class BulkExport : public BulkConnection {
+public:
+  BulkExport(const std::string &conninfo, BulkLimit &limit)
+      : BulkConnection(conninfo, limit) {
+    exec("COPY kv_store (id, value) TO STDOUT", PGRES_COPY_OUT);
+  }
+
+  // Appends rows to out until it holds at least max bytes or the table is
+  // done; returns the number of rows appended.
+  size_t read(std::string &out, size_t max) {
+    size_t rows = 0;
+    while (!finished && out.size() < max) {
+      char *row = nullptr;
+      int n = PQgetCopyData(conn, &row, 0);
+      if (n > 0) {
+        out.append(row, n);
+        PQfreemem(row);
+        rows++;
+      } else if (n == -1) {
+        check(PQgetResult(conn), PGRES_COMMAND_OK);
+        finished = true;
+      } else {
+        throw BulkError(PQerrorMessage(conn));
+      }
+    }
+    return rows;
+  }
+
+  bool done() const { return finished; }
+
+private:
+  bool finished = false;
+};
+
+// COPY into a temporary table, then one upsert into kv_store (the last line
+// for an id wins, as in /mset), all in one transaction.
+class BulkImport : public BulkConnection {
+public:
+  // Remembers up to max_ids of the imported ids, for cache invalidation.
+  BulkImport(const std::string &conninfo, BulkLimit &limit, size_t max_ids)
+      : BulkConnection(conninfo, limit), max_ids(max_ids) {
+    exec("BEGIN");
+    exec("CREATE TEMP TABLE kv_import "
+         "(id INT, value TEXT, n BIGSERIAL) ON COMMIT DROP");
+    exec("COPY kv_import (id, value) FROM STDIN", PGRES_COPY_IN);
+  }
+
+  // A piece of the body; lines may span pieces.
+  void write(const char *data, size_t len) {
+    if (PQputCopyData(conn, data, (int)len) != 1)
+      throw BulkError(PQerrorMessage(conn));
+  }
+
+  // Ends the COPY, applies it and commits. Returns the number of distinct
+  // ids imported.
+  size_t commit() {
+    if (PQputCopyEnd(conn, nullptr) != 1)
+      throw BulkError(PQerrorMessage(conn));
+    check(PQgetResult(conn), PGRES_COMMAND_OK); // bad lines show up here
+    drain();
+
+    // The ids come back one row at a time instead of in one result.
+    if (!PQsendQuery(conn,
+                     "INSERT INTO kv_store (id, value) "
+                     "SELECT DISTINCT ON (id) id, value FROM kv_import "
+                     "ORDER BY id, n DESC "
+                     "ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value "
+                     "RETURNING id") ||
+        !PQsetSingleRowMode(conn))
+      throw BulkError(PQerrorMessage(conn));
+    size_t count = 0;
+    PGresult *failed = nullptr;
+    while (PGresult *r = PQgetResult(conn)) {
+      if (PQresultStatus(r) == PGRES_SINGLE_TUPLE) {
+        count++;
+        if (imported.size() < max_ids)
+          imported.push_back(std::atoi(PQgetvalue(r, 0, 0)));
+        else
+          all = false;
+        PQclear(r);
+      } else if (PQresultStatus(r) == PGRES_TUPLES_OK || failed) {
+        PQclear(r);
+      } else {
+        failed = r;
+      }
+    }
+    if (failed)
+      check(failed, PGRES_TUPLES_OK);
+    exec("COMMIT");
+    return count;
+  }
+
+  // The imported ids; all of them only if complete().
+  const std::vector<int> &ids() const { return imported; }
+  bool complete() const { return all; }
+
+private:
+  const size_t max_ids;
+  std::vector<int> imported;
+  bool all = true;
+
+  void drain() {
+    while (PGresult *r = PQgetResult(conn))
+      PQclear(r);
+  }
+};
+
+#endif // BULKCOPY_H
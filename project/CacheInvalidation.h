@@ -0,0 +1,328 @@
+#ifndef CACHEINVALIDATION_H
+#define CACHEINVALIDATION_H
+
+#include <libpq-fe.h>
+#include <poll.h>
+#include <unistd.h>
+
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <condition_variable>
+#include <cstdint>
+#include <cstdlib>
+#include <iostream>
+#include <mutex>
+#include <random>
+#include <set>
+#include <sstream>
+#include <string>
+#include <thread>
+#include <vector>
+
+#include "kvcache.h"
+
+struct InvalidationStats {
+  uint64_t published = 0;  // ids announced to the other instances
+  uint64_t notifies = 0;   // NOTIFY messages sent
+  uint64_t received = 0;   // ids evicted on another instance's behalf
+  uint64_t resets = 0;     // whole-cache clears after missed notifications
+  uint64_t reconnects = 0; // LISTEN connections re-established
+};
+
+// Keeps the caches of several server instances on one kv_store coherent.
+// After a write, publish() queues the id; a publisher thread collects ids
+// for `window` and sends them in one NOTIFY (several if the payload would
+// exceed Postgres' 8000 bytes), on a libpq connection of its own. Every
+// instance LISTENs on another connection and evicts the ids written by the
+// others from its cache and negative cache; the next read fetches them.
+//
+// Each NOTIFY also bumps the single counter in kv_invalidation, in the same
+// statement, so the versions arrive in commit order without gaps. A gap, or
+// a counter that moved while the LISTEN connection was down, means some
+// notifications were missed, and the whole cache is cleared.
+//
+// Payload: "<version> <instance> <id>,<id>,...", or "*" instead of the ids
+// when every cache should be cleared.
+class CacheInvalidation {
+public:
+  static constexpr const char *kChannel = "kv_invalidate";
+
+  // Run once before the instances start (CREATE ... IF NOT EXISTS).
+  static const char *schema() {
+    return "CREATE TABLE IF NOT EXISTS kv_invalidation ("
+           "  one BOOLEAN PRIMARY KEY DEFAULT true CHECK (one),"
+           "  version BIGINT NOT NULL"
+           ");"
+           "INSERT INTO kv_invalidation (version) VALUES (0) "
+           "ON CONFLICT DO NOTHING;";
+  }
+
+  CacheInvalidation(const std::string &conninfo, KVCache &cache,
+                    NegativeCache &missing, std::chrono::milliseconds window)
+      : conninfo(conninfo), cache(cache), missing(missing), window(window) {
+    std::random_device rd;
+    std::ostringstream id;
+    id << std::hex << ((uint64_t(rd()) << 32) | rd()) << '-' << getpid();
+    instance = id.str();
+    publisher = std::thread([this] { run_publisher(); });
+    listener = std::thread([this] { run_listener(); });
+  }
+
+  // Sends what is still queued, then stops.
+  ~CacheInvalidation() {
+    {
+      std::lock_guard<std::mutex> lock(mtx);
+      stopping = true;
+    }
+    cv.notify_all();
+    publisher.join();
+    listener.join();
+  }
+
+  void publish(int id) { publish(std::vector<int>{id}); }
+
+  void publish(const std::vector<int> &ids) {
+    if (ids.empty())
+      return;
+    {
+      std::lock_guard<std::mutex> lock(mtx);
+      pending.insert(ids.begin(), ids.end());
+    }
+    cv.notify_one();
+  }
+
+  // For changes too large to list (a bulk import): the other instances
+  // clear their whole cache.
+  void publish_all() {
+    {
+      std::lock_guard<std::mutex> lock(mtx);
+      pending_all = true;
+    }
+    cv.notify_one();
+  }
+
+  InvalidationStats stats() {
+    InvalidationStats s;
+    s.published = published.load();
+    s.notifies = notifies.load();
+    s.received = received.load();
+    s.resets = resets.load();
+    s.reconnects = reconnects.load();
+    return s;
+  }
+
+  const std::string &instance_id() const { return instance; }
+
+private:
+  static const size_t kMaxPayload = 7900; // Postgres' limit is 8000 bytes
+
+  std::string conninfo;
+  KVCache &cache;
+  NegativeCache &missing;
+  std::chrono::milliseconds window;
+  std::string instance;
+
+  std::mutex mtx; // guards pending, pending_all and stopping
+  std::condition_variable cv;
+  std::set<int> pending; // coalesces repeated writes to a key
+  bool pending_all = false;
+  bool stopping = false;
+  std::thread publisher, listener;
+
+  std::atomic<uint64_t> published{0}, notifies{0}, received{0}, resets{0},
+      reconnects{0};
+
+  bool stop_requested() {
+    std::lock_guard<std::mutex> lock(mtx);
+    return stopping;
+  }
+
+  PGconn *connect() {
+    PGconn *conn = PQconnectdb(conninfo.c_str());
+    if (PQstatus(conn) != CONNECTION_OK) {
+      std::cerr << "Cache invalidation: " << PQerrorMessage(conn);
+      PQfinish(conn);
+      return nullptr;
+    }
+    return conn;
+  }
+
+  // Sends one batch; false if the connection failed (the ids are kept).
+  bool send(PGconn *conn, const std::vector<std::string> &payloads) {
+    for (const std::string &ids : payloads) {
+      const char *params[3] = {kChannel, instance.c_str(), ids.c_str()};
+      PGresult *r = PQexecParams(
+          conn,
+          "WITH v AS (UPDATE kv_invalidation SET version = version + 1 "
+          "RETURNING version) "
+          "SELECT pg_notify($1, v.version || ' ' || $2 || ' ' || $3) FROM v",
+          3, nullptr, params, nullptr, nullptr, 0);
+      bool ok = PQresultStatus(r) == PGRES_TUPLES_OK;
+      if (!ok)
+        std::cerr << "Cache invalidation: " << PQresultErrorMessage(r);
+      PQclear(r);
+      if (!ok)
+        return false;
+      notifies.fetch_add(1, std::memory_order_relaxed);
+    }
+    return true;
+  }
+
+  void run_publisher() {
+    PGconn *conn = nullptr;
+    auto backoff = std::chrono::milliseconds(50);
+    std::unique_lock<std::mutex> lock(mtx);
+    for (;;) {
+      cv.wait(lock, [this] {
+        return stopping || !pending.empty() || pending_all;
+      });
+      if (pending.empty() && !pending_all)
+        break; // stopping and drained
+      // Let more writes join the batch.
+      if (!stopping)
+        cv.wait_for(lock, window, [this] { return stopping; });
+      std::set<int> batch;
+      batch.swap(pending);
+      bool all = pending_all;
+      pending_all = false;
+      bool last = stopping;
+      lock.unlock();
+
+      std::vector<std::string> payloads(1);
+      if (all) {
+        payloads[0] = "*"; // covers the ids as well
+        batch.clear();
+      }
+      for (int id : batch) {
+        std::string s = std::to_string(id);
+        if (payloads.back().size() + s.size() + 1 > kMaxPayload)
+          payloads.emplace_back();
+        if (!payloads.back().empty())
+          payloads.back() += ',';
+        payloads.back() += s;
+      }
+      if (!conn)
+        conn = connect();
+      bool ok = conn && send(conn, payloads);
+      if (ok) {
+        published.fetch_add(batch.size(), std::memory_order_relaxed);
+        backoff = std::chrono::milliseconds(50);
+      } else if (conn && PQstatus(conn) != CONNECTION_OK) {
+        PQfinish(conn);
+        conn = nullptr;
+      }
+
+      lock.lock();
+      if (!ok && !last) {
+        pending.insert(batch.begin(), batch.end()); // retry
+        pending_all = pending_all || all;
+        cv.wait_for(lock, backoff, [this] { return stopping; });
+        backoff = std::min(backoff * 2, std::chrono::milliseconds(2000));
+      } else if (!ok) {
+        std::cerr << "Cache invalidation: " << batch.size()
+                  << " ids not announced" << std::endl;
+      }
+      if (last && pending.empty() && !pending_all)
+        break;
+    }
+    lock.unlock();
+    if (conn)
+      PQfinish(conn);
+  }
+
+  void reset(const char *why) {
+    std::cerr << "Cache invalidation: " << why << ", clearing the cache"
+              << std::endl;
+    cache.clear();
+    missing.clear();
+    resets.fetch_add(1, std::memory_order_relaxed);
+  }
+
+  // LISTENs, then reads the counter; true on success.
+  bool subscribe(PGconn *conn, int64_t &version) {
+    PGresult *r = PQexec(conn, (std::string("LISTEN ") + kChannel).c_str());
+    bool ok = PQresultStatus(r) == PGRES_COMMAND_OK;
+    PQclear(r);
+    if (!ok)
+      return false;
+    r = PQexec(conn, "SELECT version FROM kv_invalidation");
+    ok = PQresultStatus(r) == PGRES_TUPLES_OK && PQntuples(r) == 1;
+    if (ok)
+      version = std::atoll(PQgetvalue(r, 0, 0));
+    PQclear(r);
+    return ok;
+  }
+
+  void handle(const std::string &payload, int64_t &seen) {
+    std::istringstream in(payload);
+    int64_t version;
+    std::string from, ids;
+    if (!(in >> version >> from >> ids))
+      return;
+    if (version > seen + 1)
+      reset("missed notifications");
+    seen = std::max(seen, version);
+    if (from == instance)
+      return;
+    if (ids == "*") {
+      reset("bulk change on another instance");
+      return;
+    }
+    std::stringstream list(ids);
+    std::string item;
+    while (std::getline(list, item, ',')) {
+      int id = std::atoi(item.c_str());
+      cache.erase(id);
+      missing.erase(id);
+      received.fetch_add(1, std::memory_order_relaxed);
+    }
+  }
+
+  void run_listener() {
+    PGconn *conn = nullptr;
+    bool subscribed_once = false;
+    int64_t seen = 0;
+    auto backoff = std::chrono::milliseconds(50);
+    while (!stop_requested()) {
+      if (!conn) {
+        conn = connect();
+        int64_t version = 0;
+        if (!conn || !subscribe(conn, version)) {
+          if (conn)
+            PQfinish(conn);
+          conn = nullptr;
+          std::this_thread::sleep_for(backoff);
+          backoff = std::min(backoff * 2, std::chrono::milliseconds(2000));
+          continue;
+        }
+        backoff = std::chrono::milliseconds(50);
+        if (subscribed_once) {
+          reconnects.fetch_add(1, std::memory_order_relaxed);
+          if (version != seen)
+            reset("writes happened while not listening");
+        }
+        subscribed_once = true;
+        seen = version;
+      }
+
+      pollfd pfd = {PQsocket(conn), POLLIN, 0};
+      poll(&pfd, 1, 250); // wakes up to notice stop
+      if (!PQconsumeInput(conn) || PQstatus(conn) != CONNECTION_OK) {
+        std::cerr << "Cache invalidation: LISTEN connection lost: "
+                  << PQerrorMessage(conn);
+        PQfinish(conn);
+        conn = nullptr;
+        continue;
+      }
+      while (PGnotify *n = PQnotifies(conn)) {
+        handle(n->extra, seen);
+        PQfreemem(n);
+      }
+    }
+    if (conn)
+      PQfinish(conn);
+  }
+};
+
+#endif // CACHEINVALIDATION_H
@@ -0,0 +1,193 @@
+#ifndef CACHEWARMUP_H
+#define CACHEWARMUP_H
+
+#include <pqxx/pqxx>
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <cstdint>
+#include <cstdio>
+#include <fstream>
+#include <iostream>
+#include <string>
+#include <string_view>
+#include <thread>
+#include <vector>
+
+#include "kvcache.h"
+#include "PgArray.h"
+
+// Fills the cache in the background after a restart, so the first minutes of
+// traffic do not all go to Postgres one row at a time. Rows are read with
+// one streaming COPY ... TO STDOUT per batch (pqxx stream), on a connection
+// of its own, and inserted with KVCache::warm(): only absent keys, and only
+// while they fit. The cache is fenced for the whole warm-up
+// (KVCache::begin_warmup), so a key that a /save, /delete or invalidation
+// touched after the warm-up started is never loaded from its older snapshot.
+//
+// Keys come from the hot-key file written at the last shutdown (hottest
+// first) if there is one, otherwise from the most recently written rows
+// (youngest xmin first). Ids in the negative cache are skipped too.
+// In multi-process mode, partition (an SQL condition on id) limits it to the
+// keys this worker owns.
+class CacheWarmup {
+public:
+  enum State { IDLE, RUNNING, DONE, FAILED };
+
+  CacheWarmup(const std::string &conn_str, KVCache &cache,
+              NegativeCache &missing, const std::string &hot_keys_file,
+              const std::string &partition = "")
+      : conn_str(conn_str), cache(cache), missing(missing),
+        hot_keys_file(hot_keys_file), partition(partition) {}
+
+  ~CacheWarmup() { stop(); }
+
+  void start() {
+    state = RUNNING;
+    cache.begin_warmup(); // before any snapshot is taken
+    worker = std::thread([this] { run(); });
+  }
+
+  // Abandons a running warm-up (the server is shutting down).
+  void stop() {
+    stopping = true;
+    if (worker.joinable())
+      worker.join();
+  }
+
+  State current_state() const { return state.load(); }
+  uint64_t rows_loaded() const { return loaded.load(); }
+  uint64_t rows_read() const { return read.load(); }
+
+  static const char *state_name(State s) {
+    switch (s) {
+    case RUNNING: return "running";
+    case DONE: return "done";
+    case FAILED: return "failed";
+    default: return "idle";
+    }
+  }
+
+  // Writes the cache's resident keys, hottest first, one per line. Goes
+  // through a temp file so a crash mid-write keeps the previous list.
+  static bool save_hot_keys(KVCache &cache, const std::string &path) {
+    std::vector<int> keys = cache.hot_keys();
+    std::string tmp = path + ".tmp";
+    {
+      std::ofstream out(tmp, std::ios::trunc);
+      for (int k : keys)
+        out << k << '\n';
+      if (!out.good())
+        return false;
+    }
+    return std::rename(tmp.c_str(), path.c_str()) == 0;
+  }
+
+private:
+  static const size_t kBatch = 10000; // ids per COPY from the hot-key file
+
+  std::string conn_str;
+  KVCache &cache;
+  NegativeCache &missing;
+  std::string hot_keys_file;
+  std::string partition;
+
+  std::thread worker;
+  std::atomic<bool> stopping{false};
+  std::atomic<State> state{IDLE};
+  std::atomic<uint64_t> loaded{0}, read{0};
+  std::chrono::steady_clock::time_point started;
+
+  // Upper bound on how many rows can fit: the entry count, or for a byte
+  // budget what fits if every value were empty.
+  size_t row_limit() const {
+    const CacheConfig &cfg = cache.configuration();
+    return cfg.capacity_in_bytes ? cfg.capacity / 64 : cfg.capacity;
+  }
+
+  bool full() {
+    const CacheConfig &cfg = cache.configuration();
+    CacheStats st = cache.stats();
+    size_t used = cfg.capacity_in_bytes ? st.bytes : st.entries;
+    return used >= cfg.capacity - cfg.capacity / 50; // within 2%
+  }
+
+  void report(bool final) {
+    double secs = std::chrono::duration<double>(
+                      std::chrono::steady_clock::now() - started)
+                      .count();
+    std::cout << "Cache warm-up: " << (final ? "finished, " : "")
+              << loaded.load() << " rows cached (" << read.load()
+              << " read) in " << secs << " s" << std::endl;
+  }
+
+  // Streams one query and warms the cache with its rows. Returns false once
+  // the cache is full or the warm-up is stopped.
+  bool load(pqxx::connection &conn, const std::string &query) {
+    pqxx::read_transaction tx{conn};
+    for (auto [id, value] : tx.stream<int, std::string_view>(query)) {
+      if (stopping)
+        return false;
+      read++;
+      if (!missing.contains(id) && cache.warm(id, std::string(value)))
+        loaded++;
+      if (read % 100000 == 0) {
+        report(false);
+        if (full())
+          return false; // connection is dropped with the stream unfinished
+      }
+    }
+    tx.commit();
+    return !full();
+  }
+
+  std::string and_partition() const {
+    return partition.empty() ? "" : " AND (" + partition + ")";
+  }
+
+  std::vector<int> read_hot_keys() {
+    std::vector<int> keys;
+    if (hot_keys_file.empty())
+      return keys;
+    std::ifstream in(hot_keys_file);
+    size_t limit = row_limit();
+    int id;
+    while (keys.size() < limit && in >> id)
+      keys.push_back(id);
+    return keys;
+  }
+
+  void run() {
+    started = std::chrono::steady_clock::now();
+    try {
+      pqxx::connection conn(conn_str);
+      std::vector<int> hot = read_hot_keys();
+      if (!hot.empty()) {
+        std::cout << "Cache warm-up: " << hot.size() << " keys from "
+                  << hot_keys_file << std::endl;
+        for (size_t i = 0; i < hot.size(); i += kBatch) {
+          size_t end = std::min(hot.size(), i + kBatch);
+          std::vector<int> batch(hot.begin() + i, hot.begin() + end);
+          // COPY takes no parameters; the literal is built from ints only.
+          std::string ids = pg_int_array(batch);
+          if (!load(conn, "SELECT id, value FROM kv_store WHERE id = ANY('" +
+                              ids + "'::int[])" + and_partition()))
+            break;
+        }
+      } else {
+        std::cout << "Cache warm-up: most recently written rows" << std::endl;
+        load(conn, "SELECT id, value FROM kv_store WHERE true" +
+                       and_partition() + " ORDER BY age(xmin) LIMIT " +
+                       std::to_string(row_limit()));
+      }
+      state = DONE;
+    } catch (const std::exception &e) {
+      std::cerr << "Cache warm-up failed: " << e.what() << std::endl;
+      state = FAILED;
+    }
+    cache.end_warmup();
+    report(true);
+  }
+};
+
+#endif // CACHEWARMUP_H
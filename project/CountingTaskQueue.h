@@ -0,0 +1,48 @@
+#ifndef COUNTINGTASKQUEUE_H
+#define COUNTINGTASKQUEUE_H
+
+#include <functional>
+#include <utility>
+
+#include "httplib.h"
+#include "Metrics.h"
+
+// Gauges shared by the server and its task queue (httplib creates the queue
+// itself, inside listen()).
+struct TaskQueueStats {
+  Gauge queued; // accepted connections waiting for a worker thread
+  Gauge active; // connections being served by a worker thread
+  Counter refused; // connections turned away because the queue was full
+};
+
+// httplib::ThreadPool is final, so this wraps one and counts jobs as they
+// are queued, start and finish. max_queued > 0 bounds the queue; httplib
+// closes connections it cannot enqueue.
+class CountingTaskQueue : public httplib::TaskQueue {
+  httplib::ThreadPool pool;
+  TaskQueueStats &stats;
+
+public:
+  CountingTaskQueue(size_t threads, size_t max_queued, TaskQueueStats &stats)
+      : pool(threads, max_queued), stats(stats) {}
+
+  bool enqueue(std::function<void()> fn) override {
+    stats.queued.add(1);
+    bool ok = pool.enqueue([this, fn = std::move(fn)] {
+      stats.queued.add(-1);
+      stats.active.add(1);
+      fn();
+      stats.active.add(-1);
+    });
+    if (!ok) {
+      stats.queued.add(-1);
+      stats.refused.add();
+    }
+    return ok;
+  }
+
+  void shutdown() override { pool.shutdown(); }
+  void on_idle() override { pool.on_idle(); }
+};
+
+#endif // COUNTINGTASKQUEUE_H
@@ -5,45 +5,287 @@
 #include <queue>
 #include <mutex>
 #include <condition_variable>
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <cstdint>
 #include <string>
+#include <thread>
+#include <utility>
+#include <vector>
 #include <iostream> // For std::cerr
 #include <stdexcept> // For std::exception
 
+#include "Metrics.h"
+
+// Thrown by acquire() when no connection frees up before the deadline.
+// Handlers turn it into 503 instead of queueing the request indefinitely.
+struct PoolTimeout : std::runtime_error {
+  PoolTimeout() : std::runtime_error("timed out waiting for a DB connection") {}
+};
+
+struct PoolConfig {
+  int min_size = 1;
+  int max_size = 1;
+  std::chrono::milliseconds acquire_timeout{0}; // 0 = wait forever
+  // Grow (up to max_size) when acquires have to wait longer than this.
+  std::chrono::milliseconds grow_wait{5};
+  // Shrink (down to min_size) when some connections stayed idle this long.
+  std::chrono::milliseconds shrink_idle{30000};
+};
+
+struct PoolStats {
+  int size = 0;    // open connections, idle + in use
+  int idle = 0;
+  int waiting = 0; // threads blocked in acquire()
+  uint64_t acquires = 0;
+  uint64_t timeouts = 0;
+  uint64_t replaced = 0; // broken connections closed and reopened
+  uint64_t grown = 0;
+  uint64_t shrunk = 0;
+  HistogramSnapshot wait; // acquire wait time, timeouts included
+
+  int in_use() const { return size - idle; }
+  double avg_wait_us() const {
+    return wait.count ? double(wait.sum_us) / wait.count : 0.0;
+  }
+};
+
 class LibpqxxPool {
 private:
+  using Clock = std::chrono::steady_clock;
+
   std::queue<pqxx::connection *> pool;
   std::mutex mtx;
   std::condition_variable cv;
   std::string conn_string;
+  std::vector<std::pair<std::string, std::string>> statements;
 
-public:
-  LibpqxxPool(int size, const std::string &connStr) : conn_string(connStr) {
-    for (int i = 0; i < size; i++) {
+  PoolConfig config;
+  int total = 0;   // open + being opened
+  int waiting = 0;
+  size_t min_idle; // fewest idle connections seen since the last shrink check
+  uint64_t slow_waits = 0; // acquires slower than grow_wait since last tick
+  bool stopping = false;
+  std::condition_variable maint_cv;
+  std::thread maintainer;
+
+  std::atomic<uint64_t> timeouts{0}, replaced{0}, grown{0}, shrunk{0};
+  Histogram wait_hist{10,    100,   1000,   5000,   10000,
+                      50000, 100000, 500000, 1000000};
+
+  // Opens a connection and prepares every registered statement on it.
+  pqxx::connection *connect() {
+    std::vector<std::pair<std::string, std::string>> prepared;
+    {
+      std::lock_guard<std::mutex> lock(mtx);
+      prepared = statements;
+    }
+    pqxx::connection *conn = new pqxx::connection(conn_string);
+    try {
+      for (auto &st : prepared)
+        conn->prepare(st.first, st.second);
+    } catch (...) {
+      delete conn;
+      throw;
+    }
+    return conn;
+  }
+
+  void record_wait(Clock::duration waited) {
+    wait_hist.observe_us(
+        std::chrono::duration_cast<std::chrono::microseconds>(waited).count());
+  }
+
+  // Opens n connections outside the lock. total already counts them.
+  void open_connections(int n) {
+    for (int i = 0; i < n; i++) {
+      pqxx::connection *conn = nullptr;
       try {
-        pool.push(new pqxx::connection(conn_string));
+        conn = connect();
+      } catch (const std::exception &e) {
+        std::cerr << "DB connection failed in pool: " << e.what() << std::endl;
+      }
+      std::lock_guard<std::mutex> lock(mtx);
+      if (conn && !stopping) {
+        pool.push(conn);
+        cv.notify_one();
+      } else {
+        delete conn;
+        total--;
+      }
+    }
+  }
+
+  // Background thread: replaces broken connections (keeps total >= min),
+  // grows the pool while acquires are slow and shrinks it when connections
+  // sit idle for a whole shrink_idle period.
+  void maintain() {
+    auto tick = std::chrono::milliseconds(100);
+    auto next_shrink = Clock::now() + config.shrink_idle;
+    std::unique_lock<std::mutex> lock(mtx);
+    while (!stopping) {
+      maint_cv.wait_for(lock, tick);
+      if (stopping)
+        break;
+
+      int replace = std::max(0, config.min_size - total);
+      int want = replace;
+      if (slow_waits > 0 || (waiting > 0 && pool.empty()))
+        want = std::max(want, std::max(1, waiting));
+      want = std::min(want, config.max_size - total);
+      slow_waits = 0;
+
+      if (want > 0) {
+        total += want;
+        grown += std::max(0, want - replace);
+        lock.unlock();
+        open_connections(want);
+        lock.lock();
+        next_shrink = Clock::now() + config.shrink_idle;
+        min_idle = pool.size();
+        continue;
+      }
+
+      if (Clock::now() >= next_shrink) {
+        if (min_idle > 0 && total > config.min_size && !pool.empty()) {
+          delete pool.front();
+          pool.pop();
+          total--;
+          shrunk++;
+        }
+        next_shrink = Clock::now() + config.shrink_idle;
+        min_idle = pool.size();
+      }
+    }
+  }
+
+  void start(int initial) {
+    for (int i = 0; i < initial; i++) {
+      try {
+        pool.push(connect());
+        total++;
       } catch (const std::exception &e) {
         std::cerr << "DB connection failed in pool: " << e.what() << std::endl;
         exit(1);
       }
     }
+    min_idle = pool.size();
+    if (config.max_size > config.min_size || config.acquire_timeout.count() > 0)
+      maintainer = std::thread([this] { maintain(); });
+  }
+
+public:
+  // Fixed-size pool; acquire() waits as long as it takes.
+  LibpqxxPool(int size, const std::string &connStr) : conn_string(connStr) {
+    config.min_size = config.max_size = size;
+    start(size);
+  }
+
+  // Adaptive pool: starts with min_size connections, grows up to max_size
+  // while acquires wait longer than grow_wait and shrinks back when idle.
+  // Broken connections are dropped on release and reopened in the
+  // background, retrying until they open (a fixed pool without timeout
+  // starts its maintainer thread on the first one).
+  LibpqxxPool(const PoolConfig &cfg, const std::string &connStr)
+      : conn_string(connStr), config(cfg) {
+    config.min_size = std::max(1, config.min_size);
+    config.max_size = std::max(config.min_size, config.max_size);
+    start(config.min_size);
+  }
+
+  // Registers a named prepared statement. It is prepared right away on every
+  // idle connection and on every connection the pool opens later, so
+  // handlers can call txn.exec_prepared(name, ...) on any acquired
+  // connection. Call at startup, before connections are handed out.
+  void prepare(const std::string &name, const std::string &sql) {
+    std::unique_lock<std::mutex> lock(mtx);
+    statements.emplace_back(name, sql);
+    for (size_t i = 0; i < pool.size(); i++) {
+      pqxx::connection *conn = pool.front();
+      pool.pop();
+      pool.push(conn);
+      conn->prepare(name, sql);
+    }
   }
 
+  // Throws PoolTimeout if acquire_timeout passes without a free connection.
   pqxx::connection *acquire() {
+    auto start = Clock::now();
     std::unique_lock<std::mutex> lock(mtx);
-    cv.wait(lock, [&] { return !pool.empty(); });
+    if (pool.empty()) {
+      waiting++;
+      bool got = true;
+      if (config.acquire_timeout.count() > 0)
+        got = cv.wait_until(lock, start + config.acquire_timeout,
+                            [&] { return !pool.empty(); });
+      else
+        cv.wait(lock, [&] { return !pool.empty(); });
+      waiting--;
+      if (!got) {
+        slow_waits++;
+        timeouts.fetch_add(1, std::memory_order_relaxed);
+        record_wait(Clock::now() - start);
+        throw PoolTimeout();
+      }
+    }
     pqxx::connection *conn = pool.front();
     pool.pop();
+    min_idle = std::min(min_idle, pool.size());
+    auto waited = Clock::now() - start;
+    if (waited > config.grow_wait)
+      slow_waits++;
+    lock.unlock();
+    record_wait(waited);
     return conn;
   }
 
+  // A connection that broke while in use is closed instead of going back to
+  // the queue, so it cannot fail the next request too.
   void release(pqxx::connection *conn) {
+    if (!conn->is_open()) {
+      delete conn;
+      replaced.fetch_add(1, std::memory_order_relaxed);
+      std::lock_guard<std::mutex> lock(mtx);
+      total--;
+      // Reopened by the maintainer, which retries if Postgres is still
+      // down; reopening it here once would shrink the pool for good.
+      if (!maintainer.joinable() && !stopping)
+        maintainer = std::thread([this] { maintain(); });
+      maint_cv.notify_one();
+      return;
+    }
     std::unique_lock<std::mutex> lock(mtx);
     pool.push(conn);
     lock.unlock();
     cv.notify_one();
   }
 
+  PoolStats stats() {
+    PoolStats s;
+    {
+      std::lock_guard<std::mutex> lock(mtx);
+      s.size = total;
+      s.idle = pool.size();
+      s.waiting = waiting;
+    }
+    s.wait = wait_hist.snapshot();
+    s.acquires = s.wait.count;
+    s.timeouts = timeouts.load();
+    s.replaced = replaced.load();
+    s.grown = grown.load();
+    s.shrunk = shrunk.load();
+    return s;
+  }
+
   ~LibpqxxPool() {
+    {
+      std::lock_guard<std::mutex> lock(mtx);
+      stopping = true;
+    }
+    maint_cv.notify_all();
+    if (maintainer.joinable())
+      maintainer.join();
     while (!pool.empty()) {
       delete pool.front();
       pool.pop();
@@ -51,4 +293,4 @@ public:
   }
 };
 
-#endif
\ No newline at end of file
+#endif
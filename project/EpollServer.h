@@ -0,0 +1,838 @@
+#ifndef EPOLLSERVER_H
+#define EPOLLSERVER_H
+
+#include <arpa/inet.h>
+#include <fcntl.h>
+#include <netinet/in.h>
+#include <netinet/tcp.h>
+#include <poll.h>
+#include <strings.h>
+#include <sys/epoll.h>
+#include <sys/eventfd.h>
+#include <sys/socket.h>
+#include <unistd.h>
+
+#include <atomic>
+#include <cctype>
+#include <cerrno>
+#include <chrono>
+#include <condition_variable>
+#include <cstdint>
+#include <cstdio>
+#include <cstring>
+#include <functional>
+#include <iostream>
+#include <map>
+#include <memory>
+#include <mutex>
+#include <string>
+#include <thread>
+#include <unordered_map>
+#include <utility>
+#include <vector>
+
+#include "httplib.h"
+#include "CountingTaskQueue.h"
+#include "Metrics.h"
+
+// HTTP/1.1 front end that multiplexes many keep-alive connections over a few
+// epoll I/O threads, instead of tying up one httplib worker thread per
+// connection. Requests are parsed into httplib::Request/Response so the
+// server's handlers run unchanged. A route may have an inline handler that
+// runs on the I/O thread (it must not block, e.g. a cache lookup) and
+// answers the request if it can; everything else goes to a worker pool and
+// the response is handed back to the connection's I/O thread. An async
+// handler also runs on the I/O thread but answers later, from any thread
+// (e.g. a DB callback), so a request waiting on the DB holds no thread.
+// A worker handler may stream its body with set_chunked_content_provider;
+// the provider runs on the worker, which waits whenever kStreamWindow bytes
+// have not reached the socket yet, so a slow client bounds the memory used.
+// A handler with a content reader gets the request body as it arrives: the
+// connection's socket is read by the worker while the handler consumes it.
+//
+// Each I/O thread has its own SO_REUSEPORT listening socket, so the kernel
+// spreads new connections over them. A connection has at most one request
+// in progress; pipelined requests wait in its input buffer. Request bodies
+// need a Content-Length (no chunked uploads) and, except for content reader
+// routes, are read whole before the handler runs.
+class EpollServer {
+public:
+  using Handler =
+      std::function<void(const httplib::Request &, httplib::Response &)>;
+  // Returns true if it answered the request.
+  using InlineHandler =
+      std::function<bool(const httplib::Request &, httplib::Response &)>;
+  // Sends the response of a request taken by an async handler. Call it
+  // exactly once, from any thread.
+  using Reply = std::function<void(httplib::Response &)>;
+  // Returns true if it took the request (and will call reply); must not
+  // block. The request is only valid during the call.
+  using AsyncHandler =
+      std::function<bool(const httplib::Request &, Reply reply)>;
+  // Like httplib's: reads the body through the ContentReader (multipart
+  // form data is not supported).
+  using ReaderHandler =
+      std::function<void(const httplib::Request &, httplib::Response &,
+                         const httplib::ContentReader &)>;
+
+  // workers threads run the handlers; max_queued (0 = unbounded) caps the
+  // requests waiting for one, beyond it requests get 503 at once.
+  EpollServer(size_t io_threads, size_t workers, size_t max_queued,
+              TaskQueueStats &stats)
+      : io(std::max<size_t>(1, io_threads)),
+        pool(workers, max_queued, stats) {}
+
+  ~EpollServer() {
+    stop();
+    pool.shutdown();
+    // Replies still owed by async handlers write to the I/O threads' queues.
+    {
+      std::unique_lock<std::mutex> lock(async_mtx);
+      async_cv.wait(lock, [this] { return async_pending == 0; });
+    }
+    for (auto &t : io) {
+      close(t.ep);
+      close(t.wake);
+      close(t.listen_fd);
+      close(t.spare);
+    }
+  }
+
+  void Get(const std::string &path, Handler h) { route("GET", path, h); }
+  void Post(const std::string &path, Handler h) { route("POST", path, h); }
+  void Post(const std::string &path, ReaderHandler h) {
+    routes["POST " + path].reader = std::move(h);
+  }
+  void Delete(const std::string &path, Handler h) { route("DELETE", path, h); }
+
+  // Answers a request on the I/O thread when fn returns true; otherwise it
+  // goes to the route's handler as usual.
+  void serve_inline(const std::string &method, const std::string &path,
+                    InlineHandler fn) {
+    routes[method + " " + path].fast = std::move(fn);
+  }
+
+  // Tried after the inline handler, before the route's handler.
+  void serve_async(const std::string &method, const std::string &path,
+                   AsyncHandler fn) {
+    routes[method + " " + path].async = std::move(fn);
+  }
+
+  // Runs on the I/O thread before routing, like httplib's; returns true if
+  // it answered the request.
+  void set_pre_routing_handler(InlineHandler fn) { pre_routing = fn; }
+
+  bool bind_to_port(const std::string &host, int port) {
+    for (auto &t : io) {
+      t.listen_fd = open_listener(host, port);
+      if (t.listen_fd < 0)
+        return false;
+      t.spare = open("/dev/null", O_RDONLY | O_CLOEXEC);
+      t.ep = epoll_create1(EPOLL_CLOEXEC);
+      t.wake = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+      watch(t, t.listen_fd, kListen, EPOLLIN);
+      watch(t, t.wake, kWake, EPOLLIN);
+    }
+    return true;
+  }
+
+  // Serves until stop() is called.
+  void listen_after_bind() {
+    std::vector<std::thread> threads;
+    for (auto &t : io)
+      threads.emplace_back([this, &t] { run(t); });
+    for (auto &th : threads)
+      th.join();
+  }
+
+  void stop() {
+    stopping = true;
+    for (auto &t : io)
+      if (t.wake >= 0)
+        wake(t);
+  }
+
+  int64_t connection_count() const { return open_connections.value(); }
+  uint64_t inline_count() const { return answered_inline.value(); }
+  uint64_t dispatched_count() const { return dispatched.value(); }
+  uint64_t async_count() const { return deferred.value(); }
+  uint64_t rejected_count() const { return rejected.value(); }
+
+private:
+  static const uint64_t kListen = 0, kWake = 1; // epoll tags; conns from 2
+  static const size_t kMaxHeader = 16 * 1024;
+  static const size_t kMaxBody = 64 * 1024 * 1024;
+  static const size_t kStreamWindow = 256 * 1024;
+  static const int kBodyTimeoutMs = 30000; // a streamed body stalls this long
+
+  struct Route {
+    Handler handler;
+    InlineHandler fast;
+    AsyncHandler async;
+    ReaderHandler reader;
+  };
+
+  // Flow control between a streaming worker and the connection's I/O thread.
+  struct Stream {
+    std::mutex mtx;
+    std::condition_variable cv;
+    uint64_t posted = 0, written = 0; // windows handed over / sent
+    bool gone = false;                // the connection was closed
+
+    void wrote(uint64_t n) {
+      std::lock_guard<std::mutex> lock(mtx);
+      written = n;
+      cv.notify_all();
+    }
+    void close() {
+      std::lock_guard<std::mutex> lock(mtx);
+      gone = true;
+      cv.notify_all();
+    }
+  };
+
+  struct Conn {
+    int fd;
+    uint64_t id;
+    std::string in, out;
+    size_t out_off = 0;
+    bool busy = false;        // a request is with a worker or async handler
+    bool close_after = false; // close once out is written
+    bool want_write = false;  // EPOLLOUT armed
+    bool peer_closed = false; // EOF read; finish what was sent, then close
+    bool reading = false;     // a worker reads the body from the socket
+    bool sent_continue = false;
+    std::string remote_addr;
+    int remote_port = -1;
+    std::shared_ptr<Stream> stream; // response being streamed
+    uint64_t stream_seq = 0;        // its windows appended to out
+  };
+
+  struct Completion {
+    uint64_t conn;
+    std::string bytes;
+    bool close;
+    std::shared_ptr<Stream> stream; // set for a streamed window
+    uint64_t seq = 0;
+    bool more = false; // more of the response follows
+  };
+
+  struct IoThread {
+    int ep = -1, wake = -1, listen_fd = -1;
+    int spare = -1; // given up to accept (and close) a connection at EMFILE
+    uint64_t next_id = 2;
+    std::unordered_map<uint64_t, std::unique_ptr<Conn>> conns;
+    std::mutex mtx; // guards done
+    std::vector<Completion> done;
+  };
+
+  std::vector<IoThread> io;
+  CountingTaskQueue pool;
+  std::map<std::string, Route> routes; // "METHOD /path"
+  InlineHandler pre_routing;
+  std::atomic<bool> stopping{false};
+  Gauge open_connections;
+  Counter answered_inline, dispatched, deferred, rejected;
+  std::mutex async_mtx; // guards async_pending
+  std::condition_variable async_cv;
+  long async_pending = 0; // replies owed by async handlers
+
+  void route(const std::string &method, const std::string &path, Handler h) {
+    routes[method + " " + path].handler = std::move(h);
+  }
+
+  static int open_listener(const std::string &host, int port) {
+    int fd = socket(AF_INET, SOCK_STREAM | SOCK_NONBLOCK | SOCK_CLOEXEC, 0);
+    if (fd < 0)
+      return -1;
+    int one = 1;
+    setsockopt(fd, SOL_SOCKET, SO_REUSEADDR, &one, sizeof(one));
+    setsockopt(fd, SOL_SOCKET, SO_REUSEPORT, &one, sizeof(one));
+    sockaddr_in addr{};
+    addr.sin_family = AF_INET;
+    addr.sin_port = htons(port);
+    if (inet_pton(AF_INET, host.c_str(), &addr.sin_addr) != 1 ||
+        bind(fd, (sockaddr *)&addr, sizeof(addr)) < 0 ||
+        listen(fd, SOMAXCONN) < 0) {
+      close(fd);
+      return -1;
+    }
+    return fd;
+  }
+
+  static void watch(IoThread &t, int fd, uint64_t tag, uint32_t events,
+                    int op = EPOLL_CTL_ADD) {
+    epoll_event ev{};
+    ev.events = events;
+    ev.data.u64 = tag;
+    epoll_ctl(t.ep, op, fd, &ev);
+  }
+
+  static void arm(IoThread &t, Conn &c) {
+    uint32_t ev = c.peer_closed || c.reading ? 0u : EPOLLIN | EPOLLRDHUP;
+    if (c.want_write)
+      ev |= EPOLLOUT;
+    watch(t, c.fd, c.id, ev, EPOLL_CTL_MOD);
+  }
+
+  static void wake(IoThread &t) {
+    uint64_t one = 1;
+    (void)!write(t.wake, &one, sizeof(one));
+  }
+
+  // Hands a finished response (or a window of a streamed one) to the
+  // connection's I/O thread.
+  static void post(IoThread &t, uint64_t conn, std::string bytes, bool close,
+                   std::shared_ptr<Stream> stream = nullptr, uint64_t seq = 0,
+                   bool more = false) {
+    {
+      std::lock_guard<std::mutex> lock(t.mtx);
+      t.done.push_back(
+          {conn, std::move(bytes), close, std::move(stream), seq, more});
+    }
+    wake(t);
+  }
+
+  void add_pending(int n) {
+    std::lock_guard<std::mutex> lock(async_mtx);
+    async_pending += n;
+    if (async_pending == 0)
+      async_cv.notify_all();
+  }
+
+  void run(IoThread &t) {
+    epoll_event events[256];
+    while (!stopping) {
+      int n = epoll_wait(t.ep, events, 256, -1);
+      for (int i = 0; i < n && !stopping; i++) {
+        uint64_t tag = events[i].data.u64;
+        if (tag == kListen) {
+          accept_all(t);
+        } else if (tag == kWake) {
+          uint64_t count;
+          (void)!read(t.wake, &count, sizeof(count));
+          complete(t);
+        } else {
+          auto it = t.conns.find(tag);
+          if (it == t.conns.end())
+            continue;
+          Conn &c = *it->second;
+          uint32_t ev = events[i].events;
+          if ((ev & EPOLLOUT) && !flush(t, c))
+            continue;
+          if (c.reading && (ev & (EPOLLHUP | EPOLLERR)))
+            close_conn(t, c); // the worker's reads fail
+          else if (ev & (EPOLLIN | EPOLLHUP | EPOLLERR))
+            on_readable(t, c);
+        }
+      }
+    }
+    for (auto &kv : t.conns) {
+      if (kv.second->stream)
+        kv.second->stream->close();
+      if (kv.second->reading)
+        shutdown(kv.second->fd, SHUT_RDWR);
+      close(kv.second->fd);
+      open_connections.add(-1);
+    }
+    t.conns.clear();
+  }
+
+  void accept_all(IoThread &t) {
+    for (;;) {
+      sockaddr_in addr{};
+      socklen_t len = sizeof(addr);
+      int fd = accept4(t.listen_fd, (sockaddr *)&addr, &len,
+                       SOCK_NONBLOCK | SOCK_CLOEXEC);
+      if (fd < 0) {
+        // Out of descriptors: the listening socket would stay readable and
+        // spin, so accept with the spare descriptor and close at once.
+        if (errno == EMFILE && t.spare >= 0) {
+          close(t.spare);
+          int drop = accept(t.listen_fd, nullptr, nullptr);
+          if (drop >= 0)
+            close(drop);
+          t.spare = open("/dev/null", O_RDONLY | O_CLOEXEC);
+          rejected.add();
+          continue;
+        }
+        return;
+      }
+      int one = 1;
+      setsockopt(fd, IPPROTO_TCP, TCP_NODELAY, &one, sizeof(one));
+      std::unique_ptr<Conn> c(new Conn);
+      c->fd = fd;
+      c->id = t.next_id++;
+      char ip[INET_ADDRSTRLEN] = "";
+      inet_ntop(AF_INET, &addr.sin_addr, ip, sizeof(ip));
+      c->remote_addr = ip;
+      c->remote_port = ntohs(addr.sin_port);
+      watch(t, fd, c->id, EPOLLIN | EPOLLRDHUP);
+      t.conns.emplace(c->id, std::move(c));
+      open_connections.add(1);
+    }
+  }
+
+  void close_conn(IoThread &t, Conn &c) {
+    if (c.stream)
+      c.stream->close();
+    if (c.reading)
+      shutdown(c.fd, SHUT_RDWR); // the worker holds a duplicate
+    epoll_ctl(t.ep, EPOLL_CTL_DEL, c.fd, nullptr);
+    close(c.fd);
+    open_connections.add(-1);
+    t.conns.erase(c.id); // c is gone after this
+  }
+
+  void on_readable(IoThread &t, Conn &c) {
+    char buf[16384];
+    for (;;) {
+      ssize_t n = recv(c.fd, buf, sizeof(buf), 0);
+      if (n > 0) {
+        c.in.append(buf, n);
+        if (c.in.size() > kMaxHeader + kMaxBody) {
+          close_conn(t, c);
+          return;
+        }
+        continue;
+      }
+      if (n < 0 && (errno == EAGAIN || errno == EWOULDBLOCK))
+        break;
+      if (n < 0 && errno == EINTR)
+        continue;
+      if (n == 0 && !c.peer_closed && !c.in.empty()) {
+        // Half-close after sending requests: answer them, then close.
+        c.peer_closed = true;
+        arm(t, c);
+        break;
+      }
+      // EOF or error. A request still with a worker is dropped on return.
+      close_conn(t, c);
+      return;
+    }
+    process(t, c);
+  }
+
+  // Writes as much of c.out as the socket takes. Returns false if the
+  // connection was closed.
+  bool flush(IoThread &t, Conn &c) {
+    while (c.out_off < c.out.size()) {
+      ssize_t n = send(c.fd, c.out.data() + c.out_off, c.out.size() - c.out_off,
+                       MSG_NOSIGNAL);
+      if (n > 0) {
+        c.out_off += n;
+      } else if (n < 0 && (errno == EAGAIN || errno == EWOULDBLOCK)) {
+        if (!c.want_write) {
+          c.want_write = true;
+          arm(t, c);
+        }
+        return true;
+      } else if (!(n < 0 && errno == EINTR)) {
+        close_conn(t, c);
+        return false;
+      }
+    }
+    c.out.clear();
+    c.out_off = 0;
+    if (c.stream)
+      c.stream->wrote(c.stream_seq);
+    // When no request is with a worker, every complete request has been
+    // answered, so a closing connection can go.
+    if ((c.close_after || c.peer_closed) && !c.busy) {
+      close_conn(t, c);
+      return false;
+    }
+    if (c.want_write) {
+      c.want_write = false;
+      arm(t, c);
+    }
+    return true;
+  }
+
+  void complete(IoThread &t) {
+    std::vector<Completion> done;
+    {
+      std::lock_guard<std::mutex> lock(t.mtx);
+      done.swap(t.done);
+    }
+    for (auto &d : done) {
+      auto it = t.conns.find(d.conn);
+      if (it == t.conns.end()) {
+        if (d.stream)
+          d.stream->close();
+        continue; // client went away meanwhile
+      }
+      Conn &c = *it->second;
+      c.out += d.bytes;
+      if (d.more) {
+        c.stream = d.stream;
+        c.stream_seq = d.seq;
+        flush(t, c);
+        continue;
+      }
+      c.busy = false;
+      c.stream.reset();
+      c.close_after = c.close_after || d.close;
+      if (c.reading) {
+        c.reading = false;
+        arm(t, c);
+      }
+      process(t, c);
+    }
+  }
+
+  static std::string serialize(httplib::Response &res, bool close) {
+    if (res.status == -1)
+      res.status = 200;
+    std::string s = "HTTP/1.1 " + std::to_string(res.status) + " " +
+                    httplib::status_message(res.status) + "\r\n";
+    for (auto &h : res.headers)
+      s += h.first + ": " + h.second + "\r\n";
+    if (res.is_chunked_content_provider_)
+      s += "Transfer-Encoding: chunked\r\n";
+    else if (!res.has_header("Content-Length"))
+      s += "Content-Length: " + std::to_string(res.body.size()) + "\r\n";
+    if (close)
+      s += "Connection: close\r\n";
+    s += "\r\n";
+    s += res.body;
+    return s;
+  }
+
+  void answer(Conn &c, int status, const std::string &msg) {
+    httplib::Response res;
+    res.status = status;
+    res.set_content(msg, "text/plain");
+    c.out += serialize(res, true);
+    c.close_after = true;
+  }
+
+  // Parses and starts requests from c.in while none is in progress.
+  void process(IoThread &t, Conn &c) {
+    while (!c.busy && !c.close_after) {
+      size_t end = c.in.find("\r\n\r\n");
+      if (end == std::string::npos) {
+        if (c.in.size() > kMaxHeader)
+          answer(c, 431, "Request header too large");
+        break;
+      }
+      auto req = std::make_shared<httplib::Request>();
+      size_t body_len = 0;
+      bool expect_continue = false;
+      if (!parse_head(c.in.substr(0, end + 2), *req, body_len,
+                      expect_continue)) {
+        answer(c, 400, "Bad request");
+        break;
+      }
+      if (req->has_header("Transfer-Encoding")) {
+        answer(c, 501, "Chunked request bodies are not supported");
+        break;
+      }
+      auto rt = routes.find(req->method + " " + req->path);
+      if (rt != routes.end() && rt->second.reader) {
+        c.in.erase(0, end + 4);
+        read_body(t, c, req, body_len, expect_continue, rt->second.reader);
+        break;
+      }
+      if (body_len > kMaxBody) {
+        answer(c, 413, "Payload too large");
+        break;
+      }
+      size_t total = end + 4 + body_len;
+      if (c.in.size() < total) {
+        if (expect_continue && !c.sent_continue) {
+          c.out += "HTTP/1.1 100 Continue\r\n\r\n";
+          c.sent_continue = true;
+        }
+        break;
+      }
+      req->body = c.in.substr(end + 4, body_len);
+      c.in.erase(0, total);
+      c.sent_continue = false;
+      req->remote_addr = c.remote_addr;
+      req->remote_port = c.remote_port;
+      if (req->get_header_value("Content-Type")
+              .find("application/x-www-form-urlencoded") == 0)
+        httplib::detail::parse_query_text(req->body, req->params);
+      bool close = wants_close(*req);
+      c.close_after = close;
+      dispatch(t, c, req, close);
+    }
+    flush(t, c);
+  }
+
+  void dispatch(IoThread &t, Conn &c, std::shared_ptr<httplib::Request> req,
+                bool close) {
+    httplib::Response res;
+    if (pre_routing && pre_routing(*req, res)) {
+      answered_inline.add();
+      c.out += serialize(res, close);
+      return;
+    }
+    auto it = routes.find(req->method + " " + req->path);
+    if (it == routes.end() || !it->second.handler) {
+      res.status = 404;
+      c.out += serialize(res, close);
+      return;
+    }
+    if (it->second.fast && it->second.fast(*req, res)) {
+      answered_inline.add();
+      c.out += serialize(res, close);
+      return;
+    }
+    IoThread *tp = &t;
+    uint64_t id = c.id;
+    if (it->second.async) {
+      add_pending(1);
+      Reply reply = [this, tp, id, req, close](httplib::Response &res) {
+        post(*tp, id, serialize(res, close), close);
+        add_pending(-1);
+      };
+      if (it->second.async(*req, reply)) {
+        deferred.add();
+        c.busy = true;
+        return;
+      }
+      add_pending(-1);
+    }
+    Handler h = it->second.handler;
+    bool queued = pool.enqueue([this, tp, id, req, h, close] {
+      httplib::Response res;
+      try {
+        h(*req, res);
+      } catch (const std::exception &e) {
+        res.status = 500;
+        res.set_content(std::string("Internal error: ") + e.what(),
+                        "text/plain");
+      }
+      if (res.is_chunked_content_provider_)
+        stream(*tp, id, res, close);
+      else
+        post(*tp, id, serialize(res, close), close);
+    });
+    if (!queued) {
+      rejected.add();
+      res.status = 503;
+      res.set_header("Retry-After", "1");
+      res.set_content("Service busy: request queue is full", "text/plain");
+      c.out += serialize(res, close);
+      return;
+    }
+    dispatched.add();
+    c.busy = true;
+  }
+
+  // Starts a request whose handler reads the body itself. The I/O thread
+  // stops reading the connection and a worker takes the body from what was
+  // already read, then from a duplicate of the socket, as the handler asks
+  // for it; the response goes back through the I/O thread as usual. If the
+  // handler leaves part of the body unread, the connection is closed.
+  void read_body(IoThread &t, Conn &c, std::shared_ptr<httplib::Request> req,
+                 size_t body_len, bool expect_continue, ReaderHandler h) {
+    req->remote_addr = c.remote_addr;
+    req->remote_port = c.remote_port;
+    bool close = wants_close(*req);
+    httplib::Response res;
+    if (pre_routing && pre_routing(*req, res)) {
+      answered_inline.add();
+      c.out += serialize(res, true); // the body is not read
+      c.close_after = true;
+      return;
+    }
+    std::string start = c.in.substr(0, std::min(body_len, c.in.size()));
+    c.in.erase(0, start.size());
+    int fd = dup(c.fd);
+    if (fd < 0) {
+      answer(c, 503, "Service busy: out of file descriptors");
+      return;
+    }
+    IoThread *tp = &t;
+    uint64_t id = c.id;
+    bool queued = pool.enqueue([this, tp, id, req, h, close, fd, body_len,
+                                start] {
+      size_t left = body_len - start.size();
+      httplib::ContentReader reader(
+          [&](httplib::ContentReceiver receive) {
+            if (!start.empty() && !receive(start.data(), start.size()))
+              return false;
+            return receive_body(fd, left, receive);
+          },
+          [](httplib::FormDataHeader, httplib::ContentReceiver) {
+            return false;
+          });
+      httplib::Response res;
+      try {
+        h(*req, res, reader);
+      } catch (const std::exception &e) {
+        res.status = 500;
+        res.set_content(std::string("Internal error: ") + e.what(),
+                        "text/plain");
+      }
+      ::close(fd);
+      bool unread = left > 0;
+      if (res.is_chunked_content_provider_)
+        stream(*tp, id, res, close || unread);
+      else
+        post(*tp, id, serialize(res, close || unread), close || unread);
+    });
+    if (!queued) {
+      ::close(fd);
+      rejected.add();
+      answer(c, 503, "Service busy: request queue is full");
+      return;
+    }
+    if (expect_continue && start.size() < body_len)
+      c.out += "HTTP/1.1 100 Continue\r\n\r\n";
+    dispatched.add();
+    c.busy = true;
+    c.reading = true;
+    c.close_after = close;
+    arm(t, c);
+  }
+
+  // Reads the rest of a body (left bytes) from a non-blocking socket and
+  // passes it on. False if the client stalls or goes away, or receive
+  // returns false.
+  bool receive_body(int fd, size_t &left,
+                    const httplib::ContentReceiver &receive) {
+    char buf[64 * 1024];
+    int idle_ms = 0;
+    while (left > 0) {
+      if (stopping || idle_ms >= kBodyTimeoutMs)
+        return false;
+      ssize_t n = recv(fd, buf, std::min(left, sizeof(buf)), 0);
+      if (n > 0) {
+        idle_ms = 0;
+        left -= n;
+        if (!receive(buf, n))
+          return false;
+      } else if (n < 0 && (errno == EAGAIN || errno == EWOULDBLOCK)) {
+        pollfd p = {fd, POLLIN, 0};
+        if (poll(&p, 1, 250) == 0)
+          idle_ms += 250;
+      } else if (!(n < 0 && errno == EINTR)) {
+        return false;
+      }
+    }
+    return true;
+  }
+
+  // Runs the response's chunked content provider on the worker thread and
+  // sends its output in windows of about kStreamWindow bytes, waiting until
+  // each has been written before producing the next. A provider that fails
+  // (or a client that leaves) ends the response without the last chunk and
+  // closes the connection, so the client can tell it is incomplete.
+  void stream(IoThread &t, uint64_t id, httplib::Response &res, bool close) {
+    auto st = std::make_shared<Stream>();
+    std::string buf = serialize(res, close);
+    bool ok = true, finished = false;
+    size_t offset = 0;
+
+    auto send_window = [&] {
+      uint64_t seq;
+      {
+        std::lock_guard<std::mutex> lock(st->mtx);
+        seq = ++st->posted;
+      }
+      post(t, id, std::move(buf), false, st, seq, true);
+      buf.clear();
+      std::unique_lock<std::mutex> lock(st->mtx);
+      while (st->written < seq && !st->gone && !stopping)
+        st->cv.wait_for(lock, std::chrono::milliseconds(100));
+      return !st->gone && !stopping;
+    };
+
+    httplib::DataSink sink;
+    sink.write = [&](const char *data, size_t len) {
+      if (!ok || len == 0)
+        return ok;
+      char size[20];
+      snprintf(size, sizeof(size), "%zx\r\n", len);
+      buf += size;
+      buf.append(data, len);
+      buf += "\r\n";
+      offset += len;
+      if (buf.size() >= kStreamWindow)
+        ok = send_window();
+      return ok;
+    };
+    sink.is_writable = [&] { return ok; };
+    sink.done = [&] { finished = true; };
+    sink.done_with_trailer = [&](const httplib::Headers &) {
+      finished = true;
+    };
+
+    try {
+      while (ok && !finished)
+        ok = res.content_provider_(offset, 0, sink) && ok;
+    } catch (const std::exception &e) {
+      std::cerr << "Streamed response failed: " << e.what() << std::endl;
+      ok = false;
+    }
+    if (ok) {
+      buf += "0\r\n\r\n";
+      res.content_provider_success_ = true;
+    }
+    post(t, id, std::move(buf), close || !ok, st);
+  }
+
+  static bool wants_close(const httplib::Request &req) {
+    std::string conn = req.get_header_value("Connection");
+    for (auto &ch : conn)
+      ch = tolower(ch);
+    if (req.version == "HTTP/1.0")
+      return conn.find("keep-alive") == std::string::npos;
+    return conn.find("close") != std::string::npos;
+  }
+
+  // Request line and headers (head ends with one CRLF).
+  static bool parse_head(const std::string &head, httplib::Request &req,
+                         size_t &body_len, bool &expect_continue) {
+    size_t eol = head.find("\r\n");
+    std::string line = head.substr(0, eol);
+    size_t sp1 = line.find(' ');
+    size_t sp2 = line.rfind(' ');
+    if (sp1 == std::string::npos || sp2 == sp1)
+      return false;
+    req.method = line.substr(0, sp1);
+    req.target = line.substr(sp1 + 1, sp2 - sp1 - 1);
+    req.version = line.substr(sp2 + 1);
+    if (req.version.compare(0, 5, "HTTP/") != 0)
+      return false;
+    size_t q = req.target.find('?');
+    req.path = httplib::decode_path_component(req.target.substr(0, q));
+    if (q != std::string::npos)
+      httplib::detail::parse_query_text(req.target.substr(q + 1), req.params);
+
+    size_t pos = eol + 2;
+    while (pos < head.size()) {
+      size_t next = head.find("\r\n", pos);
+      if (next == std::string::npos)
+        next = head.size();
+      std::string h = head.substr(pos, next - pos);
+      pos = next + 2;
+      size_t colon = h.find(':');
+      if (colon == std::string::npos)
+        return false;
+      size_t v = h.find_first_not_of(" \t", colon + 1);
+      std::string value = v == std::string::npos ? "" : h.substr(v);
+      while (!value.empty() && (value.back() == ' ' || value.back() == '\t'))
+        value.pop_back();
+      req.headers.emplace(h.substr(0, colon), value);
+    }
+    body_len = 0;
+    if (req.has_header("Content-Length")) {
+      std::string len = req.get_header_value("Content-Length");
+      char *endp = nullptr;
+      unsigned long long n = std::strtoull(len.c_str(), &endp, 10);
+      if (len.empty() || *endp != '\0')
+        return false;
+      body_len = n;
+    }
+    std::string expect = req.get_header_value("Expect");
+    expect_continue = strcasecmp(expect.c_str(), "100-continue") == 0;
+    return true;
+  }
+};
+
+#endif // EPOLLSERVER_H
@@ -0,0 +1,217 @@
+#ifndef GROUPCOMMIT_H
+#define GROUPCOMMIT_H
+
+#include <pqxx/pqxx>
+#include <algorithm>
+#include <chrono>
+#include <condition_variable>
+#include <cstdint>
+#include <deque>
+#include <exception>
+#include <future>
+#include <map>
+#include <mutex>
+#include <optional>
+#include <set>
+#include <string>
+#include <thread>
+#include <vector>
+
+#include "dbpool.h"
+#include "PgArray.h"
+#include "KVStatements.h"
+
+struct GroupCommitStats {
+  uint64_t batches = 0;
+  uint64_t ops = 0;
+  uint64_t max_batch = 0;
+  uint64_t wait_us_total = 0; // enqueue -> commit, summed over all ops
+  uint64_t wait_us_max = 0;
+
+  double avg_batch() const { return batches ? double(ops) / batches : 0.0; }
+  double avg_wait_us() const { return ops ? double(wait_us_total) / ops : 0.0; }
+};
+
+// Group commit for /save and /delete. Requests are queued; a committer
+// thread waits up to `window` after the first one arrives (or until
+// `max_batch` are queued), then applies the whole batch in ONE transaction:
+// one multi-row DELETE and one multi-row upsert. Each caller blocks until
+// that transaction has committed, so a request is still only acknowledged
+// once its change is durable - it just shares the commit (and WAL flush)
+// with its neighbours. A failed batch fails every request in it.
+// Uses the kv_*_many statements from KVStatements.h.
+class GroupCommitWriter {
+public:
+  GroupCommitWriter(LibpqxxPool &pool, size_t max_batch,
+                    std::chrono::microseconds window)
+      : pool(pool), max_batch(std::max<size_t>(1, max_batch)), window(window) {
+    committer = std::thread([this] { run(); });
+  }
+
+  ~GroupCommitWriter() {
+    {
+      std::lock_guard<std::mutex> lock(mtx);
+      stopping = true;
+    }
+    cv.notify_all();
+    committer.join();
+  }
+
+  // save() always succeeds unless the DB fails; remove() returns whether the
+  // row existed, taking earlier operations in the same batch into account.
+  void save(int id, const std::string &value) { submit(Op::SAVE, id, value); }
+  bool remove(int id) { return submit(Op::DELETE, id, ""); }
+
+  GroupCommitStats stats() {
+    std::lock_guard<std::mutex> lock(stats_mtx);
+    return totals;
+  }
+
+private:
+  using Clock = std::chrono::steady_clock;
+
+  struct Op {
+    enum Kind { SAVE, DELETE } kind;
+    int id;
+    std::string value;
+    Clock::time_point enqueued;
+    std::promise<bool> done;
+  };
+
+  LibpqxxPool &pool;
+  size_t max_batch;
+  std::chrono::microseconds window;
+
+  std::deque<Op *> queue;
+  bool stopping = false;
+  std::mutex mtx;
+  std::condition_variable cv;
+  std::thread committer;
+
+  GroupCommitStats totals;
+  std::mutex stats_mtx;
+
+  bool submit(Op::Kind kind, int id, const std::string &value) {
+    Op op{kind, id, value, Clock::now(), {}};
+    std::future<bool> result = op.done.get_future();
+    {
+      std::lock_guard<std::mutex> lock(mtx);
+      queue.push_back(&op);
+    }
+    cv.notify_one();
+    return result.get();
+  }
+
+  void run() {
+    for (;;) {
+      std::vector<Op *> batch;
+      {
+        std::unique_lock<std::mutex> lock(mtx);
+        cv.wait(lock, [&] { return stopping || !queue.empty(); });
+        if (queue.empty())
+          return; // stopping and drained
+
+        // The window starts with the oldest queued request.
+        auto deadline = queue.front()->enqueued + window;
+        while (!stopping && queue.size() < max_batch &&
+               cv.wait_until(lock, deadline) != std::cv_status::timeout) {
+        }
+
+        while (!queue.empty() && batch.size() < max_batch) {
+          batch.push_back(queue.front());
+          queue.pop_front();
+        }
+      }
+      commit(batch);
+    }
+  }
+
+  void commit(std::vector<Op *> &batch) {
+    std::vector<bool> results(batch.size(), true);
+    std::exception_ptr error;
+
+    pqxx::connection *conn = nullptr;
+    try {
+      std::set<int> delete_ids;
+      for (Op *op : batch)
+        if (op->kind == Op::DELETE)
+          delete_ids.insert(op->id);
+
+      conn = pool.acquire();
+      pqxx::work txn{*conn};
+
+      // Which of the deleted ids exist right now; rows are locked so the
+      // answer stays valid until commit.
+      std::set<int> existing;
+      if (!delete_ids.empty()) {
+        std::vector<int> ids(delete_ids.begin(), delete_ids.end());
+        pqxx::result r = txn.exec_prepared("kv_lock_many", pg_int_array(ids));
+        for (const auto &row : r)
+          existing.insert(row[0].as<int>());
+      }
+
+      // Replay the batch in arrival order to get each request's answer and
+      // the final state of every key (last write wins). std::map keeps the
+      // ids sorted, so rows are always locked in the same order.
+      std::map<int, std::optional<std::string>> final_state;
+      for (size_t i = 0; i < batch.size(); i++) {
+        Op *op = batch[i];
+        if (op->kind == Op::SAVE) {
+          final_state[op->id] = op->value;
+        } else {
+          auto it = final_state.find(op->id);
+          results[i] = it != final_state.end() ? it->second.has_value()
+                                               : existing.count(op->id) > 0;
+          final_state[op->id] = std::nullopt;
+        }
+      }
+
+      std::vector<int> del, ups;
+      std::vector<std::string> vals;
+      for (auto &kv : final_state) {
+        if (kv.second) {
+          ups.push_back(kv.first);
+          vals.push_back(*kv.second);
+        } else {
+          del.push_back(kv.first);
+        }
+      }
+      if (!del.empty())
+        txn.exec_prepared("kv_delete_many", pg_int_array(del));
+      if (!ups.empty())
+        txn.exec_prepared("kv_upsert_many", pg_int_array(ups),
+                          pg_text_array(vals));
+      txn.commit();
+      pool.release(conn);
+      conn = nullptr;
+    } catch (...) {
+      if (conn)
+        pool.release(conn);
+      error = std::current_exception();
+    }
+
+    auto now = Clock::now();
+    {
+      std::lock_guard<std::mutex> lock(stats_mtx);
+      totals.batches++;
+      totals.ops += batch.size();
+      totals.max_batch = std::max<uint64_t>(totals.max_batch, batch.size());
+      for (Op *op : batch) {
+        uint64_t us = std::chrono::duration_cast<std::chrono::microseconds>(
+                          now - op->enqueued)
+                          .count();
+        totals.wait_us_total += us;
+        totals.wait_us_max = std::max(totals.wait_us_max, us);
+      }
+    }
+
+    for (size_t i = 0; i < batch.size(); i++) {
+      if (error)
+        batch[i]->done.set_exception(error);
+      else
+        batch[i]->done.set_value(results[i]);
+    }
+  }
+};
+
+#endif // GROUPCOMMIT_H
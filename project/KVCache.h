@@ -1,24 +1,269 @@
 #ifndef KVCACHE_H
 #define KVCACHE_H
 
+#include <algorithm>
+#include <atomic>
+#include <chrono>
 #include <list>
+#include <deque>
+#include <memory>
 #include <string>
 #include <unordered_map>
+#include <unordered_set>
 #include <mutex>
-#include <utility> 
-#include <cstddef> 
+#include <shared_mutex>
+#include <utility>
+#include <vector>
+#include <cstddef>
+#include <cstdint>
 
 
-class KVCache {
+// Eviction policy of every cache segment.
+//  LRU    - strict LRU; a hit moves the entry to the front, so it needs the
+//           exclusive lock.
+//  CLOCK  - a hit only sets the entry's reference bit; hits run under a
+//           shared lock and eviction sweeps a clock hand over the slots.
+//  S3FIFO - small FIFO + main FIFO + ghost queue (S3-FIFO). A hit only bumps
+//           a 2-bit frequency counter, also under a shared lock.
+enum class EvictionPolicy { LRU, CLOCK, S3FIFO };
+
+inline bool parse_eviction_policy(const std::string &name, EvictionPolicy &out) {
+  if (name == "lru")
+    out = EvictionPolicy::LRU;
+  else if (name == "clock")
+    out = EvictionPolicy::CLOCK;
+  else if (name == "s3fifo")
+    out = EvictionPolicy::S3FIFO;
+  else
+    return false;
+  return true;
+}
+
+inline const char *eviction_policy_name(EvictionPolicy p) {
+  switch (p) {
+  case EvictionPolicy::CLOCK:
+    return "clock";
+  case EvictionPolicy::S3FIFO:
+    return "s3fifo";
+  default:
+    return "lru";
+  }
+}
+
+struct CacheConfig {
+  size_t capacity = 1000;         // entries, or bytes if capacity_in_bytes
+  bool capacity_in_bytes = false; // charge key + value + node overhead
+  size_t shards = 1;
+  EvictionPolicy policy = EvictionPolicy::LRU;
+  bool admission = false;         // TinyLFU admission for fill()
+};
+
+struct CacheStats {
+  uint64_t hits = 0;
+  uint64_t misses = 0;
+  uint64_t evictions = 0;
+  uint64_t rejected = 0; // fills refused by the admission filter
+  size_t entries = 0;
+  size_t bytes = 0;      // approximate, key + value + node overhead
+
+  double hit_ratio() const {
+    uint64_t total = hits + misses;
+    return total ? double(hits) / total : 0.0;
+  }
+};
+
+// Count-min sketch of recent access frequency (TinyLFU). Four rows of 4-bit
+// saturating counters (one byte each here); once sample_size accesses have
+// been recorded every counter is halved, so old popularity fades out.
+// Counters are relaxed atomics: lost increments only make the estimate a
+// little lower, which is fine for an admission heuristic.
+class FrequencySketch {
+  static constexpr int kRows = 4;
+  std::vector<std::atomic<uint8_t>> table;
+  size_t width_mask;
+  size_t sample_size;
+  std::atomic<size_t> additions{0};
+  std::mutex reset_mtx;
+
+  static uint64_t hash(int key, int row) {
+    uint64_t x = static_cast<uint32_t>(key) + 0x9e3779b97f4a7c15ULL * (row + 1);
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    x = (x ^ (x >> 27)) * 0x94d049bb133111ebULL;
+    return x ^ (x >> 31);
+  }
+
+  std::atomic<uint8_t> &counter(int key, int row) {
+    return table[row * (width_mask + 1) + (hash(key, row) & width_mask)];
+  }
+
+  void reset() {
+    std::unique_lock<std::mutex> lock(reset_mtx, std::try_to_lock);
+    if (!lock.owns_lock() || additions.load() < sample_size)
+      return;
+    for (auto &c : table)
+      c.store(c.load(std::memory_order_relaxed) / 2, std::memory_order_relaxed);
+    additions.store(sample_size / 2);
+  }
+
+public:
+  explicit FrequencySketch(size_t expected_entries) {
+    size_t width = 16;
+    while (width < expected_entries)
+      width <<= 1;
+    table = std::vector<std::atomic<uint8_t>>(kRows * width);
+    width_mask = width - 1;
+    sample_size = 10 * width;
+  }
+
+  void record(int key) {
+    for (int r = 0; r < kRows; r++) {
+      auto &c = counter(key, r);
+      uint8_t v = c.load(std::memory_order_relaxed);
+      if (v < 15)
+        c.store(v + 1, std::memory_order_relaxed);
+    }
+    if (additions.fetch_add(1, std::memory_order_relaxed) + 1 >= sample_size)
+      reset();
+  }
+
+  uint8_t estimate(int key) {
+    uint8_t m = 15;
+    for (int r = 0; r < kRows; r++) {
+      uint8_t v = counter(key, r).load(std::memory_order_relaxed);
+      if (v < m)
+        m = v;
+    }
+    return m;
+  }
+};
+
+// One independently locked part of the cache. Every segment owns its lock;
+// the policy decides whether a hit needs it exclusively. Capacity is counted
+// in "units": one per entry, or the entry's byte charge in byte-budget mode.
+enum class InsertMode { Replace, Admit, Warm };
+
+class alignas(64) CacheSegment {
+protected:
   size_t capacity;
+  bool charge_bytes;
+  size_t node_overhead;
+  size_t used = 0;
+  std::unique_ptr<FrequencySketch> sketch;
+
+  std::atomic<uint64_t> hits{0}, misses{0}, evictions{0}, rejected{0};
+
+  // Warm-up fence: while it is up, every write to a key is noted, and a
+  // Warm insert of a noted key is dropped. The check and the insert happen
+  // under fence_mtx, so a row written or deleted after the warm-up's
+  // snapshot started can't be put back from it. Only the warm-up takes
+  // fence_mtx for long; writers take it briefly, and only while it is up.
+  std::atomic<bool> fencing{false};
+  std::mutex fence_mtx;
+  std::unordered_set<int> written; // guarded by fence_mtx
+  bool fence_all = false;          // clear() while fenced: warm nothing more
+
+  size_t charge(const std::string &value) const {
+    return charge_bytes ? node_overhead + value.size() : 1;
+  }
+
+  // TinyLFU: a new key only displaces victim if it was seen more often.
+  bool admits(int key, int victim) {
+    if (sketch && sketch->estimate(key) <= sketch->estimate(victim)) {
+      rejected.fetch_add(1, std::memory_order_relaxed);
+      return false;
+    }
+    return true;
+  }
+
+  virtual bool lookup(int key, std::string &value) = 0;
+  // Inserts or updates key; returns false if the value was not stored.
+  //   Replace - always store, evicting as needed
+  //   Admit   - a new key that would force an eviction is checked against
+  //             the first victim (TinyLFU)
+  //   Warm    - only store a key that is absent and fits without evicting
+  virtual bool insert(int key, const std::string &value, InsertMode mode) = 0;
+  virtual void resident(size_t &entries, size_t &bytes) = 0;
+
+public:
+  CacheSegment(size_t cap, bool bytes, size_t overhead, bool admission)
+      : capacity(cap), charge_bytes(bytes), node_overhead(overhead) {
+    if (admission)
+      sketch.reset(new FrequencySketch(bytes ? cap / 128 : cap));
+  }
+  virtual ~CacheSegment() = default;
+
+  // With record_miss false a miss leaves no trace (no stats, no sketch).
+  bool get(int key, std::string &value, bool record_miss = true) {
+    bool hit = lookup(key, value);
+    if (!hit && !record_miss)
+      return false;
+    if (sketch)
+      sketch->record(key);
+    (hit ? hits : misses).fetch_add(1, std::memory_order_relaxed);
+    return hit;
+  }
+
+  bool put(int key, const std::string &value, InsertMode mode) {
+    if (mode != InsertMode::Warm) {
+      note_write(key);
+      return insert(key, value, mode);
+    }
+    std::lock_guard<std::mutex> lock(fence_mtx);
+    if (fence_all || written.count(key))
+      return false;
+    return insert(key, value, mode);
+  }
+
+  // Called before every change that does not go through put().
+  void note_write(int key) {
+    if (!fencing.load())
+      return;
+    std::lock_guard<std::mutex> lock(fence_mtx);
+    written.insert(key);
+  }
+
+  void note_clear() {
+    if (!fencing.load())
+      return;
+    std::lock_guard<std::mutex> lock(fence_mtx);
+    fence_all = true;
+  }
+
+  void set_fence(bool on) {
+    std::lock_guard<std::mutex> lock(fence_mtx);
+    fencing = on;
+    fence_all = false;
+    written.clear();
+  }
+
+  virtual void erase(int key) = 0;
+  // Resident keys, most valuable to keep first (as far as the policy knows).
+  virtual void keys(std::vector<int> &out) = 0;
+
+  void add_stats(CacheStats &st) {
+    st.hits += hits.load(std::memory_order_relaxed);
+    st.misses += misses.load(std::memory_order_relaxed);
+    st.evictions += evictions.load(std::memory_order_relaxed);
+    st.rejected += rejected.load(std::memory_order_relaxed);
+    resident(st.entries, st.bytes);
+  }
+};
+
+class LruSegment : public CacheSegment {
   std::list<std::pair<int, std::string>> items;
   std::unordered_map<int, std::list<std::pair<int, std::string>>::iterator> index;
+  size_t value_bytes = 0;
   std::mutex mtx;
 
-public:
-  KVCache(size_t cap) : capacity(cap) {}
+  void remove(std::list<std::pair<int, std::string>>::iterator it) {
+    used -= charge(it->second);
+    value_bytes -= it->second.size();
+    index.erase(it->first);
+    items.erase(it);
+  }
 
-  bool get(int key, std::string &value) {
+protected:
+  bool lookup(int key, std::string &value) override {
     std::lock_guard<std::mutex> lock(mtx);
     auto it = index.find(key);
     if (it == index.end())
@@ -31,28 +276,640 @@ public:
     return true;
   }
 
-  void put(int key, const std::string &value) {
+  bool insert(int key, const std::string &value, InsertMode mode) override {
     std::lock_guard<std::mutex> lock(mtx);
-    if (index.count(key)) {
-      items.erase(index[key]);
-    } else if (items.size() >= capacity) {
-      auto last = items.back();
-      index.erase(last.first);
-      items.pop_back();
+    bool admit = mode == InsertMode::Admit;
+    auto it = index.find(key);
+    if (it != index.end()) {
+      if (mode == InsertMode::Warm)
+        return false;
+      remove(it->second);
+      admit = false;
+    }
+    size_t c = charge(value);
+    if (c > capacity || (mode == InsertMode::Warm && used + c > capacity))
+      return false;
+    while (used + c > capacity && !items.empty()) {
+      if (admit && !admits(key, items.back().first))
+        return false;
+      admit = false;
+      remove(std::prev(items.end()));
+      evictions.fetch_add(1, std::memory_order_relaxed);
     }
     items.emplace_front(key, value);
     index[key] = items.begin();
+    used += c;
+    value_bytes += value.size();
     // std::cout << "Cache put: " << key << " -> " << value << std::endl;
+    return true;
+  }
+
+  void resident(size_t &entries, size_t &bytes) override {
+    std::lock_guard<std::mutex> lock(mtx);
+    entries += items.size();
+    bytes += items.size() * node_overhead + value_bytes;
+  }
+
+public:
+  // List node (two links + key/value pair) plus hash node (next, cached
+  // hash, list iterator) and its bucket pointer.
+  static constexpr size_t kOverhead =
+      sizeof(std::pair<int, std::string>) + 6 * sizeof(void *);
+
+  LruSegment(size_t cap, bool bytes, bool admission)
+      : CacheSegment(cap, bytes, kOverhead, admission) {}
+
+  void erase(int key) override {
+    std::lock_guard<std::mutex> lock(mtx);
+    auto it = index.find(key);
+    if (it != index.end())
+      remove(it->second);
+    // std::cout << "Cache delete: " << key << std::endl;
+  }
+
+  void keys(std::vector<int> &out) override {
+    std::lock_guard<std::mutex> lock(mtx);
+    for (auto &kv : items) // most recently used first
+      out.push_back(kv.first);
+  }
+};
+
+class ClockSegment : public CacheSegment {
+  struct Slot {
+    int key = 0;
+    bool live = false;
+    std::atomic<uint8_t> ref{0};
+    std::string value;
+  };
+
+  std::deque<Slot> slots; // grows on demand; never moves existing slots
+  std::vector<size_t> free_slots;
+  std::unordered_map<int, size_t> index;
+  size_t value_bytes = 0;
+  size_t hand = 0;
+  std::shared_mutex mtx;
+
+  // Advance the hand, clearing reference bits, until a live unreferenced
+  // slot comes up. Called with the exclusive lock held and index non-empty.
+  size_t next_victim() {
+    for (;;) {
+      Slot &s = slots[hand];
+      size_t pos = hand;
+      hand = (hand + 1) % slots.size();
+      if (!s.live)
+        continue;
+      if (s.ref.load(std::memory_order_relaxed) == 0)
+        return pos;
+      s.ref.store(0, std::memory_order_relaxed);
+    }
+  }
+
+  void remove(size_t pos) {
+    Slot &s = slots[pos];
+    used -= charge(s.value);
+    value_bytes -= s.value.size();
+    index.erase(s.key);
+    s.live = false;
+    s.value.clear();
+    s.value.shrink_to_fit();
+    free_slots.push_back(pos);
+  }
+
+protected:
+  bool lookup(int key, std::string &value) override {
+    std::shared_lock<std::shared_mutex> lock(mtx);
+    auto it = index.find(key);
+    if (it == index.end())
+      return false;
+    Slot &s = slots[it->second];
+    if (s.ref.load(std::memory_order_relaxed) == 0)
+      s.ref.store(1, std::memory_order_relaxed);
+    value = s.value;
+    return true;
+  }
+
+  bool insert(int key, const std::string &value, InsertMode mode) override {
+    std::unique_lock<std::shared_mutex> lock(mtx);
+    bool admit = mode == InsertMode::Admit;
+    uint8_t ref = 0;
+    auto it = index.find(key);
+    if (it != index.end()) {
+      if (mode == InsertMode::Warm)
+        return false;
+      remove(it->second);
+      admit = false;
+      ref = 1;
+    }
+    size_t c = charge(value);
+    if (c > capacity || (mode == InsertMode::Warm && used + c > capacity))
+      return false;
+    while (used + c > capacity && !index.empty()) {
+      size_t pos = next_victim();
+      if (admit && !admits(key, slots[pos].key))
+        return false;
+      admit = false;
+      remove(pos);
+      evictions.fetch_add(1, std::memory_order_relaxed);
+    }
+
+    size_t pos;
+    if (!free_slots.empty()) {
+      pos = free_slots.back();
+      free_slots.pop_back();
+    } else {
+      pos = slots.size();
+      slots.emplace_back();
+    }
+    Slot &s = slots[pos];
+    s.key = key;
+    s.live = true;
+    s.value = value;
+    s.ref.store(ref, std::memory_order_relaxed);
+    index[key] = pos;
+    used += c;
+    value_bytes += value.size();
+    return true;
+  }
+
+  void resident(size_t &entries, size_t &bytes) override {
+    std::shared_lock<std::shared_mutex> lock(mtx);
+    entries += index.size();
+    bytes += index.size() * node_overhead + value_bytes;
+  }
+
+public:
+  // Slot in the deque plus hash node (next, cached hash, slot position),
+  // bucket pointer and free-list entry.
+  static constexpr size_t kOverhead = sizeof(Slot) + 5 * sizeof(void *);
+
+  ClockSegment(size_t cap, bool bytes, bool admission)
+      : CacheSegment(cap, bytes, kOverhead, admission) {}
+
+  void erase(int key) override {
+    std::unique_lock<std::shared_mutex> lock(mtx);
+    auto it = index.find(key);
+    if (it != index.end())
+      remove(it->second);
+  }
+
+  void keys(std::vector<int> &out) override {
+    std::shared_lock<std::shared_mutex> lock(mtx);
+    // Referenced slots first.
+    for (uint8_t want : {1, 0})
+      for (auto &s : slots)
+        if (s.live && std::min<uint8_t>(s.ref.load(std::memory_order_relaxed),
+                                        1) == want)
+          out.push_back(s.key);
+  }
+};
+
+// S3-FIFO (Yang et al., SOSP'23): new keys enter a small FIFO holding ~10% of
+// the capacity. Keys hit again while in it are promoted to the main FIFO;
+// the rest are evicted, leaving their key in a ghost FIFO so that a quick
+// re-insert goes straight to main. Main is a FIFO with reinsertion.
+class S3FifoSegment : public CacheSegment {
+  struct Entry {
+    int key;
+    std::string value;
+    std::atomic<uint8_t> freq{0};
+    bool in_main = false;
+
+    Entry(int k, const std::string &v) : key(k), value(v) {}
+  };
+  using Queue = std::list<Entry>;
+
+  size_t small_capacity;
+  size_t small_used = 0, main_used = 0;
+  Queue small_q, main_q; // front = newest, back = oldest
+  std::unordered_map<int, Queue::iterator> index;
+  std::list<int> ghost_q;
+  std::unordered_map<int, std::list<int>::iterator> ghost_index;
+  size_t value_bytes = 0;
+  std::shared_mutex mtx;
+
+  void ghost_insert(int key) {
+    ghost_q.push_front(key);
+    ghost_index[key] = ghost_q.begin();
+    // The ghost queue remembers about as many keys as main holds.
+    size_t limit = charge_bytes ? index.size() : capacity - small_capacity;
+    while (ghost_q.size() > limit && !ghost_q.empty()) {
+      ghost_index.erase(ghost_q.back());
+      ghost_q.pop_back();
+    }
+  }
+
+  void drop(Queue &q, Queue::iterator it) {
+    size_t c = charge(it->value);
+    (it->in_main ? main_used : small_used) -= c;
+    used -= c;
+    value_bytes -= it->value.size();
+    index.erase(it->key);
+    q.erase(it);
+  }
+
+  void evict_main() {
+    while (!main_q.empty()) {
+      auto tail = std::prev(main_q.end());
+      uint8_t f = tail->freq.load(std::memory_order_relaxed);
+      if (f > 0) {
+        tail->freq.store(f - 1, std::memory_order_relaxed);
+        main_q.splice(main_q.begin(), main_q, tail);
+      } else {
+        drop(main_q, tail);
+        evictions.fetch_add(1, std::memory_order_relaxed);
+        return;
+      }
+    }
+  }
+
+  void evict_small() {
+    while (!small_q.empty()) {
+      auto tail = std::prev(small_q.end());
+      if (tail->freq.load(std::memory_order_relaxed) > 1) {
+        size_t c = charge(tail->value);
+        tail->freq.store(0, std::memory_order_relaxed);
+        tail->in_main = true;
+        small_used -= c;
+        main_used += c;
+        main_q.splice(main_q.begin(), small_q, tail);
+        if (main_used > capacity - small_capacity)
+          evict_main();
+      } else {
+        int key = tail->key;
+        drop(small_q, tail);
+        ghost_insert(key);
+        evictions.fetch_add(1, std::memory_order_relaxed);
+        return;
+      }
+    }
+  }
+
+  bool evict_from_small() const {
+    return small_used >= small_capacity || main_q.empty();
+  }
+
+protected:
+  bool lookup(int key, std::string &value) override {
+    std::shared_lock<std::shared_mutex> lock(mtx);
+    auto it = index.find(key);
+    if (it == index.end())
+      return false;
+    Entry &e = *it->second;
+    uint8_t f = e.freq.load(std::memory_order_relaxed);
+    if (f < 3)
+      e.freq.store(f + 1, std::memory_order_relaxed);
+    value = e.value;
+    return true;
+  }
+
+  bool insert(int key, const std::string &value, InsertMode mode) override {
+    std::unique_lock<std::shared_mutex> lock(mtx);
+    bool admit = mode == InsertMode::Admit;
+    size_t c = charge(value);
+    auto it = index.find(key);
+    if (it != index.end()) {
+      if (mode == InsertMode::Warm)
+        return false;
+      // Update in place so a written key keeps its queue and frequency.
+      Entry &e = *it->second;
+      if (c > capacity) {
+        drop(e.in_main ? main_q : small_q, it->second);
+        return false;
+      }
+      size_t old_c = charge(e.value);
+      (e.in_main ? main_used : small_used) -= old_c;
+      (e.in_main ? main_used : small_used) += c;
+      used = used - old_c + c;
+      value_bytes = value_bytes - e.value.size() + value.size();
+      e.value = value;
+      while (used > capacity && !index.empty()) {
+        if (evict_from_small())
+          evict_small();
+        else
+          evict_main();
+      }
+      return true;
+    }
+    if (c > capacity || (mode == InsertMode::Warm && used + c > capacity))
+      return false;
+    while (used + c > capacity && !index.empty()) {
+      if (admit) {
+        int victim = evict_from_small() ? small_q.back().key : main_q.back().key;
+        if (!admits(key, victim))
+          return false;
+        admit = false;
+      }
+      if (evict_from_small())
+        evict_small();
+      else
+        evict_main();
+    }
+
+    auto g = ghost_index.find(key);
+    if (g != ghost_index.end()) {
+      ghost_q.erase(g->second);
+      ghost_index.erase(g);
+      main_q.emplace_front(key, value);
+      main_q.front().in_main = true;
+      index[key] = main_q.begin();
+      main_used += c;
+    } else {
+      small_q.emplace_front(key, value);
+      index[key] = small_q.begin();
+      small_used += c;
+    }
+    used += c;
+    value_bytes += value.size();
+    return true;
+  }
+
+  void resident(size_t &entries, size_t &bytes) override {
+    std::shared_lock<std::shared_mutex> lock(mtx);
+    entries += index.size();
+    bytes += index.size() * node_overhead + value_bytes;
+  }
+
+public:
+  // List node (two links + entry) plus hash node and bucket pointer; the
+  // ghost queue is keys only and not charged.
+  static constexpr size_t kOverhead = sizeof(Entry) + 6 * sizeof(void *);
+
+  S3FifoSegment(size_t cap, bool bytes, bool admission)
+      : CacheSegment(cap < 2 ? 2 : cap, bytes, kOverhead, admission),
+        small_capacity(capacity / 10) {
+    if (small_capacity == 0)
+      small_capacity = 1;
+  }
+
+  void erase(int key) override {
+    std::unique_lock<std::shared_mutex> lock(mtx);
+    auto it = index.find(key);
+    if (it == index.end())
+      return;
+    drop(it->second->in_main ? main_q : small_q, it->second);
+  }
+
+  void keys(std::vector<int> &out) override {
+    std::shared_lock<std::shared_mutex> lock(mtx);
+    for (auto &e : main_q)
+      out.push_back(e.key);
+    for (auto &e : small_q)
+      out.push_back(e.key);
+  }
+};
+
+// Cache split into independent segments ("shards"). A key always maps to the
+// same shard, and every shard has its own lock, so HTTP threads working on
+// different keys no longer serialize on a single mutex. Eviction happens per
+// shard with the configured policy.
+class KVCache {
+  std::vector<std::unique_ptr<CacheSegment>> shards;
+  CacheConfig config;
+
+  // Integer keys are hashed to themselves by std::hash, so mix the bits
+  // first; otherwise sequential ids would fill the shards in lock-step.
+  static size_t mix(int key) {
+    uint64_t x = static_cast<uint32_t>(key);
+    x ^= x >> 16;
+    x *= 0x45d9f3bULL;
+    x ^= x >> 16;
+    x *= 0x45d9f3bULL;
+    x ^= x >> 16;
+    return static_cast<size_t>(x);
+  }
+
+  CacheSegment &shard_for(int key) { return *shards[mix(key) % shards.size()]; }
+
+public:
+  // The capacity (entries or bytes) is divided between the shards, the
+  // first capacity % shards of them taking one more, so the total is the
+  // configured capacity; there are never more shards than units of capacity.
+  // One LRU shard counting entries is the old single-lock cache.
+  explicit KVCache(const CacheConfig &cfg) : config(cfg) {
+    config.shards = std::max<size_t>(
+        1, std::min(config.shards, config.capacity));
+    bool bytes = config.capacity_in_bytes;
+    for (size_t i = 0; i < config.shards; i++) {
+      size_t per_shard = config.capacity / config.shards +
+                         (i < config.capacity % config.shards ? 1 : 0);
+      if (per_shard == 0)
+        per_shard = 1;
+      switch (config.policy) {
+      case EvictionPolicy::CLOCK:
+        shards.emplace_back(new ClockSegment(per_shard, bytes, config.admission));
+        break;
+      case EvictionPolicy::S3FIFO:
+        shards.emplace_back(new S3FifoSegment(per_shard, bytes, config.admission));
+        break;
+      default:
+        shards.emplace_back(new LruSegment(per_shard, bytes, config.admission));
+      }
+    }
+  }
+
+  KVCache(size_t cap, size_t num_shards = 1,
+          EvictionPolicy policy = EvictionPolicy::LRU)
+      : KVCache(CacheConfig{cap, false, num_shards, policy, false}) {}
+
+  size_t shard_count() const { return shards.size(); }
+  EvictionPolicy eviction_policy() const { return config.policy; }
+  const CacheConfig &configuration() const { return config; }
+
+  bool get(int key, std::string &value) { return shard_for(key).get(key, value); }
+
+  // Like get(), but a miss is not counted, for a fast path that falls back
+  // to the full request handler (which calls get() again).
+  bool try_get(int key, std::string &value) {
+    return shard_for(key).get(key, value, false);
+  }
+
+  // Write path: the new value always replaces whatever is cached.
+  void put(int key, const std::string &value) {
+    shard_for(key).put(key, value, InsertMode::Replace);
+  }
+
+  // Read-miss path: with admission enabled the key is only inserted if the
+  // frequency sketch says it is hotter than what it would evict, so a single
+  // uniform scan cannot flush the hot set. Returns whether it was cached.
+  bool fill(int key, const std::string &value) {
+    InsertMode mode =
+        config.admission ? InsertMode::Admit : InsertMode::Replace;
+    return shard_for(key).put(key, value, mode);
+  }
+
+  // Warm-up path: stores the value only if the key is absent (a concurrent
+  // /save wins), fits without evicting anything, and has not been written,
+  // deleted or invalidated since begin_warmup().
+  bool warm(int key, const std::string &value) {
+    return shard_for(key).put(key, value, InsertMode::Warm);
+  }
+
+  // Bracket a warm-up: call begin_warmup() before its DB snapshot starts.
+  // Ids written in between are remembered until end_warmup().
+  void begin_warmup() {
+    for (auto &s : shards)
+      s->set_fence(true);
+  }
+
+  void end_warmup() {
+    for (auto &s : shards)
+      s->set_fence(false);
+  }
+
+  // Resident keys, hottest first: shards are interleaved so the order within
+  // each shard (its policy's idea of value) is kept.
+  std::vector<int> hot_keys() {
+    std::vector<std::vector<int>> per_shard(shards.size());
+    size_t total = 0;
+    for (size_t i = 0; i < shards.size(); i++) {
+      shards[i]->keys(per_shard[i]);
+      total += per_shard[i].size();
+    }
+    std::vector<int> out;
+    out.reserve(total);
+    for (size_t pos = 0; out.size() < total; pos++)
+      for (auto &keys : per_shard)
+        if (pos < keys.size())
+          out.push_back(keys[pos]);
+    return out;
+  }
+
+  void erase(int key) {
+    CacheSegment &s = shard_for(key);
+    s.note_write(key);
+    s.erase(key);
+  }
+
+  // Drops every entry (e.g. when invalidations may have been missed). Shard
+  // by shard, so concurrent requests keep being served.
+  void clear() {
+    std::vector<int> keys;
+    for (auto &s : shards) {
+      s->note_clear();
+      keys.clear();
+      s->keys(keys);
+      for (int k : keys)
+        s->erase(k);
+    }
+  }
+
+  CacheStats stats() {
+    CacheStats st;
+    for (auto &s : shards)
+      s->add_stats(st);
+    return st;
+  }
+
+  size_t size() { return stats().entries; }
+};
+
+// Remembers ids that are known to be missing from kv_store so repeated
+// lookups of deleted or never-written keys can be answered with 404 without
+// a DB round trip. Bounded by capacity (oldest entry goes first) and every
+// entry expires after ttl, which caps how long a row written by someone else
+// can stay hidden. capacity == 0 disables it.
+//
+// A read that found nothing must not mark the id missing if a write landed
+// while it ran: take stamp(id) before the read and insert(id, stamp) after.
+// erase() and clear() move the stamps of the ids they cover (ids share
+// kStripes counters, so an unrelated write only costs a skipped insert).
+class NegativeCache {
+  using Clock = std::chrono::steady_clock;
+  static const size_t kStripes = 256;
+
+  size_t capacity;
+  Clock::duration ttl;
+  std::list<std::pair<int, Clock::time_point>> items; // front = newest
+  std::unordered_map<int, std::list<std::pair<int, Clock::time_point>>::iterator> index;
+  std::mutex mtx;
+  std::atomic<uint64_t> hits{0};
+  // Writes per stripe and clears, under mtx; read without it by stamp()
+  std::atomic<uint64_t> writes[kStripes] = {};
+  std::atomic<uint64_t> clears{0};
+
+  static size_t stripe(int key) { return (unsigned)key % kStripes; }
+
+  void insert_locked(int key) {
+    auto it = index.find(key);
+    if (it != index.end()) {
+      items.erase(it->second);
+    } else if (items.size() >= capacity) {
+      index.erase(items.back().first);
+      items.pop_back();
+    }
+    items.emplace_front(key, Clock::now() + ttl);
+    index[key] = items.begin();
+  }
+
+public:
+  NegativeCache(size_t cap, std::chrono::milliseconds ttl)
+      : capacity(cap), ttl(ttl) {}
+
+  bool enabled() const { return capacity > 0; }
+
+  bool contains(int key) {
+    if (!enabled())
+      return false;
+    std::lock_guard<std::mutex> lock(mtx);
+    auto it = index.find(key);
+    if (it == index.end())
+      return false;
+    if (Clock::now() >= it->second->second) {
+      items.erase(it->second);
+      index.erase(it);
+      return false;
+    }
+    hits.fetch_add(1, std::memory_order_relaxed);
+    return true;
+  }
+
+  void insert(int key) {
+    if (!enabled())
+      return;
+    std::lock_guard<std::mutex> lock(mtx);
+    insert_locked(key);
+  }
+
+  // Taken before a DB read of key; changes when key is written or the
+  // cache is cleared.
+  uint64_t stamp(int key) const {
+    return writes[stripe(key)].load() + clears.load();
+  }
+
+  // Inserts key only if nothing wrote it since stamp was taken.
+  void insert(int key, uint64_t since) {
+    if (!enabled())
+      return;
+    std::lock_guard<std::mutex> lock(mtx);
+    if (stamp(key) == since)
+      insert_locked(key);
   }
 
   void erase(int key) {
+    if (!enabled())
+      return;
     std::lock_guard<std::mutex> lock(mtx);
-    if (index.count(key)) {
-      items.erase(index[key]);
-      index.erase(key);
+    writes[stripe(key)].fetch_add(1);
+    auto it = index.find(key);
+    if (it != index.end()) {
+      items.erase(it->second);
+      index.erase(it);
     }
-    // std::cout << "Cache delete: " << key << std::endl;
   }
+
+  void clear() {
+    std::lock_guard<std::mutex> lock(mtx);
+    clears.fetch_add(1);
+    items.clear();
+    index.clear();
+  }
+
+  size_t size() {
+    std::lock_guard<std::mutex> lock(mtx);
+    return items.size();
+  }
+
+  uint64_t hit_count() const { return hits.load(); }
 };
 
-#endif // KVCACHE_H
\ No newline at end of file
+#endif // KVCACHE_H
@@ -0,0 +1,40 @@
+#ifndef KVSTATEMENTS_H
+#define KVSTATEMENTS_H
+
+#include <string>
+#include <utility>
+#include <vector>
+
+#include "dbpool.h"
+
+// Named statements prepared once per pooled connection, so Postgres does not
+// parse and plan the same SQL on every request. Handlers run them with
+// txn.exec_prepared("kv_get", id).
+inline const std::vector<std::pair<std::string, std::string>> &kv_statements() {
+  static const std::vector<std::pair<std::string, std::string>> statements = {
+      {"kv_get", "SELECT value FROM kv_store WHERE id = $1"},
+      {"kv_upsert", "INSERT INTO kv_store (id, value) VALUES ($1, $2) "
+                    "ON CONFLICT (id) DO UPDATE SET value = $2"},
+      {"kv_delete", "DELETE FROM kv_store WHERE id = $1"},
+      // Batched forms; arrays come from PgArray.h.
+      {"kv_lock_many", "SELECT id FROM kv_store WHERE id = ANY($1::int[]) "
+                       "ORDER BY id FOR UPDATE"},
+      {"kv_get_many", "SELECT id, value FROM kv_store WHERE id = ANY($1::int[])"},
+      {"kv_delete_many", "DELETE FROM kv_store WHERE id = ANY($1::int[]) "
+                         "RETURNING id"},
+      {"kv_scan", "SELECT id, value FROM kv_store WHERE id BETWEEN $1 AND $2 "
+                  "ORDER BY id LIMIT $3"},
+      {"kv_upsert_many", "INSERT INTO kv_store (id, value) "
+                         "SELECT * FROM unnest($1::int[], $2::text[]) "
+                         "ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value"},
+  };
+  return statements;
+}
+
+// Needs kv_store to exist: Postgres checks the table when preparing.
+inline void prepare_kv_statements(LibpqxxPool &pool) {
+  for (auto &st : kv_statements())
+    pool.prepare(st.first, st.second);
+}
+
+#endif // KVSTATEMENTS_H
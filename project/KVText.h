@@ -0,0 +1,103 @@
+#ifndef KVTEXT_H
+#define KVTEXT_H
+
+#include <cstdlib>
+#include <string>
+#include <utility>
+#include <vector>
+
+// Line-based bodies for the multi-key endpoints. One record per line; a value
+// is separated from its id by a tab and escaped like Postgres COPY text
+// (\\, \t, \n, \r), so values may contain any byte.
+
+inline std::string escape_value(const std::string &v) {
+  std::string s;
+  s.reserve(v.size());
+  for (char c : v) {
+    switch (c) {
+    case '\\': s += "\\\\"; break;
+    case '\t': s += "\\t"; break;
+    case '\n': s += "\\n"; break;
+    case '\r': s += "\\r"; break;
+    default: s += c;
+    }
+  }
+  return s;
+}
+
+inline std::string unescape_value(const std::string &v) {
+  std::string s;
+  s.reserve(v.size());
+  for (size_t i = 0; i < v.size(); i++) {
+    if (v[i] != '\\' || i + 1 == v.size()) {
+      s += v[i];
+      continue;
+    }
+    char c = v[++i];
+    s += c == 't' ? '\t' : c == 'n' ? '\n' : c == 'r' ? '\r' : c;
+  }
+  return s;
+}
+
+// A non-negative int in plain digits: no sign or leading space, which
+// strtol would accept.
+inline bool parse_kv_id(const std::string &s, int &id) {
+  if (s.empty() || s.size() > 10 || s[0] < '0' || s[0] > '9')
+    return false;
+  char *end = nullptr;
+  long v = std::strtol(s.c_str(), &end, 10);
+  if (*end != '\0' || v < 0 || v > 2147483647L)
+    return false;
+  id = (int)v;
+  return true;
+}
+
+// Splits a body into lines, dropping a trailing \r and empty lines.
+inline std::vector<std::string> body_lines(const std::string &body) {
+  std::vector<std::string> lines;
+  size_t pos = 0;
+  while (pos < body.size()) {
+    size_t nl = body.find('\n', pos);
+    if (nl == std::string::npos)
+      nl = body.size();
+    std::string line = body.substr(pos, nl - pos);
+    if (!line.empty() && line.back() == '\r')
+      line.pop_back();
+    if (!line.empty())
+      lines.push_back(line);
+    pos = nl + 1;
+  }
+  return lines;
+}
+
+// "id\n" per line. Returns false (with the offending line in bad) on error.
+inline bool parse_id_lines(const std::string &body, std::vector<int> &ids,
+                           std::string &bad) {
+  for (auto &line : body_lines(body)) {
+    int id;
+    if (!parse_kv_id(line, id)) {
+      bad = line;
+      return false;
+    }
+    ids.push_back(id);
+  }
+  return true;
+}
+
+// "id\tescaped value\n" per line.
+inline bool parse_pair_lines(const std::string &body,
+                             std::vector<std::pair<int, std::string>> &pairs,
+                             std::string &bad) {
+  for (auto &line : body_lines(body)) {
+    size_t tab = line.find('\t');
+    int id;
+    if (tab == std::string::npos || !parse_kv_id(line.substr(0, tab), id)) {
+      bad = line;
+      return false;
+    }
+    pairs.emplace_back(id, unescape_value(line.substr(tab + 1)));
+  }
+  return true;
+}
+
+#endif // KVTEXT_H
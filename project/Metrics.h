@@ -0,0 +1,183 @@
+#ifndef METRICS_H
+#define METRICS_H
+
+#include <atomic>
+#include <cstddef>
+#include <cstdint>
+#include <cstdio>
+#include <initializer_list>
+#include <memory>
+#include <string>
+#include <vector>
+
+// Counters, gauges and histograms for the hot path. Every metric keeps one
+// cache-line-aligned cell per slot and each thread updates only its own slot
+// (threads are spread over kMetricSlots slots), so recording is a relaxed,
+// uncontended atomic add. Reading sums all slots; it is only done when
+// /metrics or /stats is scraped.
+
+static const size_t kMetricSlots = 64;
+
+inline size_t metric_slot() {
+  static std::atomic<size_t> next{0};
+  thread_local size_t slot =
+      next.fetch_add(1, std::memory_order_relaxed) % kMetricSlots;
+  return slot;
+}
+
+class Counter {
+  struct alignas(64) Cell {
+    std::atomic<uint64_t> v{0};
+  };
+  Cell cells[kMetricSlots];
+
+public:
+  void add(uint64_t n = 1) {
+    cells[metric_slot()].v.fetch_add(n, std::memory_order_relaxed);
+  }
+
+  uint64_t value() const {
+    uint64_t sum = 0;
+    for (auto &c : cells)
+      sum += c.v.load(std::memory_order_relaxed);
+    return sum;
+  }
+};
+
+// Up/down value (queue depth, connections in use). Increments and decrements
+// may happen on different threads; only the sum is meaningful.
+class Gauge {
+  struct alignas(64) Cell {
+    std::atomic<int64_t> v{0};
+  };
+  Cell cells[kMetricSlots];
+
+public:
+  void add(int64_t n) {
+    cells[metric_slot()].v.fetch_add(n, std::memory_order_relaxed);
+  }
+
+  int64_t value() const {
+    int64_t sum = 0;
+    for (auto &c : cells)
+      sum += c.v.load(std::memory_order_relaxed);
+    return sum;
+  }
+};
+
+struct HistogramSnapshot {
+  std::vector<uint64_t> bounds_us; // upper bounds; +Inf bucket is implied
+  std::vector<uint64_t> counts;    // per bucket (bounds + 1), not cumulative
+  uint64_t count = 0;
+  uint64_t sum_us = 0;
+};
+
+// Fixed-bucket histogram of durations in microseconds.
+class Histogram {
+  struct alignas(64) Line {
+    std::atomic<uint64_t> v[8];
+  };
+  std::vector<uint64_t> bounds;
+  size_t lines; // cache lines per slot: one counter per bucket, then the sum
+  std::unique_ptr<Line[]> cells;
+
+  std::atomic<uint64_t> &at(size_t slot, size_t i) const {
+    return cells[slot * lines + i / 8].v[i % 8];
+  }
+
+public:
+  explicit Histogram(std::initializer_list<uint64_t> bounds_us)
+      : bounds(bounds_us) {
+    lines = (bounds.size() + 2 + 7) / 8;
+    cells.reset(new Line[lines * kMetricSlots]);
+    for (size_t slot = 0; slot < kMetricSlots; slot++)
+      for (size_t i = 0; i < lines * 8; i++)
+        at(slot, i).store(0, std::memory_order_relaxed);
+  }
+
+  void observe_us(uint64_t us) {
+    size_t b = 0;
+    while (b < bounds.size() && us > bounds[b])
+      b++;
+    size_t slot = metric_slot();
+    at(slot, b).fetch_add(1, std::memory_order_relaxed);
+    at(slot, bounds.size() + 1).fetch_add(us, std::memory_order_relaxed);
+  }
+
+  HistogramSnapshot snapshot() const {
+    HistogramSnapshot s;
+    s.bounds_us = bounds;
+    s.counts.assign(bounds.size() + 1, 0);
+    for (size_t slot = 0; slot < kMetricSlots; slot++) {
+      for (size_t b = 0; b <= bounds.size(); b++)
+        s.counts[b] += at(slot, b).load(std::memory_order_relaxed);
+      s.sum_us += at(slot, bounds.size() + 1).load(std::memory_order_relaxed);
+    }
+    for (uint64_t c : s.counts)
+      s.count += c;
+    return s;
+  }
+};
+
+// Prometheus text exposition format (version 0.0.4).
+class MetricsWriter {
+  std::string out;
+
+  // Bucket bounds: short, they are fixed values like 0.0005 or 2.5.
+  static std::string seconds(uint64_t us) {
+    char buf[32];
+    snprintf(buf, sizeof(buf), "%.6g", us / 1e6);
+    return buf;
+  }
+
+  // Sums: exact, so rate() over a large cumulative total doesn't step.
+  static std::string exact_seconds(uint64_t us) {
+    char buf[32];
+    snprintf(buf, sizeof(buf), "%llu.%06llu",
+             (unsigned long long)(us / 1000000),
+             (unsigned long long)(us % 1000000));
+    return buf;
+  }
+
+  static std::string with_label(const std::string &labels,
+                                const std::string &extra) {
+    if (labels.empty())
+      return "{" + extra + "}";
+    return "{" + labels + "," + extra + "}";
+  }
+
+public:
+  // Starts a metric family; type is counter, gauge or histogram.
+  void family(const std::string &name, const std::string &type,
+              const std::string &help) {
+    out += "# HELP " + name + " " + help + "\n";
+    out += "# TYPE " + name + " " + type + "\n";
+  }
+
+  // labels: `route="/val",code="2xx"` (already quoted), or empty.
+  void sample(const std::string &name, const std::string &labels,
+              double value) {
+    char buf[32];
+    snprintf(buf, sizeof(buf), "%.17g", value);
+    out += name + (labels.empty() ? "" : "{" + labels + "}") + " " + buf + "\n";
+  }
+
+  void histogram(const std::string &name, const std::string &labels,
+                 const HistogramSnapshot &h) {
+    uint64_t cumulative = 0;
+    for (size_t b = 0; b < h.counts.size(); b++) {
+      cumulative += h.counts[b];
+      std::string le =
+          b < h.bounds_us.size() ? seconds(h.bounds_us[b]) : "+Inf";
+      out += name + "_bucket" + with_label(labels, "le=\"" + le + "\"") + " " +
+             std::to_string(cumulative) + "\n";
+    }
+    std::string l = labels.empty() ? "" : "{" + labels + "}";
+    out += name + "_sum" + l + " " + exact_seconds(h.sum_us) + "\n";
+    out += name + "_count" + l + " " + std::to_string(h.count) + "\n";
+  }
+
+  const std::string &text() const { return out; }
+};
+
+#endif // METRICS_H
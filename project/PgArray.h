@@ -0,0 +1,40 @@
+#ifndef PGARRAY_H
+#define PGARRAY_H
+
+#include <string>
+#include <vector>
+
+// Postgres array literals, so a whole batch of ids/values can be sent as one
+// parameter: WHERE id = ANY($1::int[]) or unnest($1::int[], $2::text[]).
+
+inline std::string pg_int_array(const std::vector<int> &ids) {
+  std::string s = "{";
+  for (size_t i = 0; i < ids.size(); i++) {
+    if (i)
+      s += ',';
+    s += std::to_string(ids[i]);
+  }
+  s += '}';
+  return s;
+}
+
+// Every element is double-quoted, with backslashes and quotes escaped, so
+// commas, braces, spaces and the word NULL inside values stay literal.
+inline std::string pg_text_array(const std::vector<std::string> &values) {
+  std::string s = "{";
+  for (size_t i = 0; i < values.size(); i++) {
+    if (i)
+      s += ',';
+    s += '"';
+    for (char c : values[i]) {
+      if (c == '"' || c == '\\')
+        s += '\\';
+      s += c;
+    }
+    s += '"';
+  }
+  s += '}';
+  return s;
+}
+
+#endif // PGARRAY_H
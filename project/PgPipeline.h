@@ -0,0 +1,306 @@
+#ifndef PGPIPELINE_H
+#define PGPIPELINE_H
+
+#include <libpq-fe.h>
+#include <poll.h>
+#include <sys/eventfd.h>
+#include <unistd.h>
+
+#include <atomic>
+#include <chrono>
+#include <deque>
+#include <functional>
+#include <future>
+#include <memory>
+#include <mutex>
+#include <stdexcept>
+#include <string>
+#include <thread>
+#include <utility>
+#include <vector>
+
+// Result of one pipelined statement. Values are in text format; SQL NULL
+// comes back as an empty string (kv_store has no nullable columns).
+struct PgReply {
+  bool ok = false;
+  std::string error;
+  std::vector<std::vector<std::string>> rows;
+  long affected_rows = 0;
+};
+
+// Runs prepared statements on a few libpq connections in pipeline mode
+// (PostgreSQL 14+ libpq). Each connection has one I/O thread that keeps up
+// to max_in_flight statements outstanding: requests are written as soon as
+// they arrive, without waiting for earlier results, and replies are matched
+// back to requests by order. So a handful of connections can serve the
+// concurrency that otherwise needs one backend per waiting HTTP thread.
+//
+// Every statement is followed by its own sync point, so each runs as its own
+// implicit transaction (autocommit) and an error only fails that request.
+class PgPipeline {
+public:
+  using Callback = std::function<void(PgReply)>;
+  using Statements = std::vector<std::pair<std::string, std::string>>;
+
+  PgPipeline(const std::string &conninfo, int connections,
+             const Statements &statements, size_t max_in_flight = 256)
+      : conninfo(conninfo), statements(statements),
+        max_in_flight(max_in_flight ? max_in_flight : 1) {
+    if (connections < 1)
+      connections = 1;
+    for (int i = 0; i < connections; i++) {
+      std::unique_ptr<Lane> lane(new Lane);
+      lane->wake_fd = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+      if (lane->wake_fd < 0)
+        throw std::runtime_error("eventfd failed");
+      lanes.push_back(std::move(lane));
+    }
+    for (auto &lane : lanes) {
+      Lane *l = lane.get();
+      l->thread = std::thread([this, l] { run(*l); });
+    }
+  }
+
+  ~PgPipeline() {
+    stopping = true;
+    for (auto &lane : lanes)
+      wake(*lane);
+    for (auto &lane : lanes) {
+      lane->thread.join();
+      close(lane->wake_fd);
+    }
+  }
+
+  // Queues a prepared statement; done is called on a pipeline I/O thread
+  // once its result (or error) is in. Keep callbacks short.
+  void submit(const std::string &statement, std::vector<std::string> params,
+              Callback done) {
+    Lane &lane = *lanes[next_lane.fetch_add(1, std::memory_order_relaxed) %
+                        lanes.size()];
+    {
+      std::lock_guard<std::mutex> lock(lane.mtx);
+      lane.queue.push_back({statement, std::move(params), std::move(done), {}});
+    }
+    wake(lane);
+  }
+
+  // Blocking convenience wrapper around submit().
+  PgReply query(const std::string &statement, std::vector<std::string> params) {
+    auto done = std::make_shared<std::promise<PgReply>>();
+    std::future<PgReply> reply = done->get_future();
+    submit(statement, std::move(params),
+           [done](PgReply r) { done->set_value(std::move(r)); });
+    return reply.get();
+  }
+
+  size_t connection_count() const { return lanes.size(); }
+  uint64_t completed_count() const { return completed.load(); }
+
+private:
+  struct Request {
+    std::string statement;
+    std::vector<std::string> params;
+    Callback done;
+    PgReply reply;
+  };
+
+  struct Lane {
+    std::mutex mtx;
+    std::deque<Request> queue;   // submitted, not yet sent
+    std::deque<Request> in_flight; // sent, in pipeline order (I/O thread only)
+    int wake_fd = -1;
+    std::thread thread;
+  };
+
+  std::string conninfo;
+  Statements statements;
+  size_t max_in_flight;
+  std::vector<std::unique_ptr<Lane>> lanes;
+  std::atomic<size_t> next_lane{0};
+  std::atomic<bool> stopping{false};
+  std::atomic<uint64_t> completed{0};
+
+  static void wake(Lane &lane) {
+    uint64_t one = 1;
+    ssize_t n = write(lane.wake_fd, &one, sizeof(one));
+    (void)n;
+  }
+
+  static void drain_wake(Lane &lane) {
+    uint64_t v;
+    ssize_t n = read(lane.wake_fd, &v, sizeof(v));
+    (void)n;
+  }
+
+  void finish(Request &req) {
+    completed.fetch_add(1, std::memory_order_relaxed);
+    req.done(std::move(req.reply));
+  }
+
+  // Fails everything sent on a dead connection (and, when stopping, all
+  // queued work as well).
+  void fail_all(Lane &lane, const std::string &error, bool queued_too) {
+    for (auto &req : lane.in_flight) {
+      req.reply = PgReply();
+      req.reply.error = error;
+      finish(req);
+    }
+    lane.in_flight.clear();
+    if (!queued_too)
+      return;
+    std::deque<Request> queued;
+    {
+      std::lock_guard<std::mutex> lock(lane.mtx);
+      queued.swap(lane.queue);
+    }
+    for (auto &req : queued) {
+      req.reply.error = error;
+      finish(req);
+    }
+  }
+
+  PGconn *connect(std::string &error) {
+    PGconn *conn = PQconnectdb(conninfo.c_str());
+    if (PQstatus(conn) != CONNECTION_OK) {
+      error = PQerrorMessage(conn);
+      PQfinish(conn);
+      return nullptr;
+    }
+    for (auto &st : statements) {
+      PGresult *r = PQprepare(conn, st.first.c_str(), st.second.c_str(), 0, nullptr);
+      bool ok = PQresultStatus(r) == PGRES_COMMAND_OK;
+      if (!ok)
+        error = PQresultErrorMessage(r);
+      PQclear(r);
+      if (!ok) {
+        PQfinish(conn);
+        return nullptr;
+      }
+    }
+    if (PQsetnonblocking(conn, 1) != 0 || PQenterPipelineMode(conn) != 1) {
+      error = PQerrorMessage(conn);
+      PQfinish(conn);
+      return nullptr;
+    }
+    return conn;
+  }
+
+  // Sends queued requests while there is room in the pipeline. Returns
+  // false if the connection failed while sending.
+  bool send_queued(Lane &lane, PGconn *conn) {
+    std::deque<Request> batch;
+    {
+      std::lock_guard<std::mutex> lock(lane.mtx);
+      while (!lane.queue.empty() &&
+             lane.in_flight.size() + batch.size() < max_in_flight) {
+        batch.push_back(std::move(lane.queue.front()));
+        lane.queue.pop_front();
+      }
+    }
+    bool ok = true;
+    for (auto &req : batch) {
+      std::vector<const char *> values;
+      for (auto &p : req.params)
+        values.push_back(p.c_str());
+      // After a failed send the pipeline is out of step with in_flight;
+      // the caller drops the connection and fails everything sent on it.
+      if (ok)
+        ok = PQsendQueryPrepared(conn, req.statement.c_str(), (int)values.size(),
+                                 values.data(), nullptr, nullptr, 0) &&
+             PQpipelineSync(conn);
+      lane.in_flight.push_back(std::move(req));
+    }
+    return ok;
+  }
+
+  // Reads every result that is complete. Pipeline order: for each request
+  // its result(s), a NULL, and then the PGRES_PIPELINE_SYNC of its sync.
+  bool read_results(Lane &lane, PGconn *conn) {
+    if (!PQconsumeInput(conn))
+      return false;
+    while (!lane.in_flight.empty() && !PQisBusy(conn)) {
+      PGresult *r = PQgetResult(conn);
+      if (!r)
+        continue; // end of one statement's results
+      Request &req = lane.in_flight.front();
+      switch (PQresultStatus(r)) {
+      case PGRES_PIPELINE_SYNC:
+        finish(req);
+        lane.in_flight.pop_front();
+        break;
+      case PGRES_TUPLES_OK:
+      case PGRES_COMMAND_OK: {
+        req.reply.ok = true;
+        const char *n = PQcmdTuples(r);
+        req.reply.affected_rows = (n && *n) ? std::stol(n) : 0;
+        int cols = PQnfields(r);
+        for (int i = 0; i < PQntuples(r); i++) {
+          std::vector<std::string> row;
+          for (int c = 0; c < cols; c++)
+            row.emplace_back(PQgetvalue(r, i, c), PQgetlength(r, i, c));
+          req.reply.rows.push_back(std::move(row));
+        }
+        break;
+      }
+      case PGRES_PIPELINE_ABORTED:
+        req.reply.ok = false;
+        req.reply.error = "statement aborted in pipeline";
+        break;
+      default:
+        req.reply.ok = false;
+        req.reply.error = PQresultErrorMessage(r);
+      }
+      PQclear(r);
+    }
+    return true;
+  }
+
+  void run(Lane &lane) {
+    PGconn *conn = nullptr;
+    auto backoff = std::chrono::milliseconds(50);
+
+    while (!stopping) {
+      if (!conn) {
+        std::string error;
+        conn = connect(error);
+        if (!conn) {
+          // Nobody can be served until the DB is back: fail queued work
+          // rather than letting it wait forever.
+          fail_all(lane, "DB connection failed: " + error, true);
+          std::this_thread::sleep_for(backoff);
+          backoff = std::min(backoff * 2, std::chrono::milliseconds(2000));
+          continue;
+        }
+        backoff = std::chrono::milliseconds(50);
+      }
+
+      bool sent = send_queued(lane, conn);
+      int flush = sent ? PQflush(conn) : -1; // 1 = more to write later
+
+      pollfd fds[2];
+      fds[0] = {lane.wake_fd, POLLIN, 0};
+      fds[1] = {PQsocket(conn), POLLIN, 0};
+      if (flush == 1)
+        fds[1].events |= POLLOUT;
+      poll(fds, 2, 100);
+
+      if (fds[0].revents & POLLIN)
+        drain_wake(lane);
+      bool alive = flush >= 0 && PQstatus(conn) == CONNECTION_OK;
+      if (alive && (fds[1].revents & (POLLIN | POLLERR | POLLHUP)))
+        alive = read_results(lane, conn);
+      if (!alive || PQstatus(conn) != CONNECTION_OK) {
+        std::string error = PQerrorMessage(conn);
+        PQfinish(conn);
+        conn = nullptr;
+        fail_all(lane, "DB connection lost: " + error, false);
+      }
+    }
+
+    if (conn)
+      PQfinish(conn);
+    fail_all(lane, "DB pipeline shut down", true);
+  }
+};
+
+#endif // PGPIPELINE_H
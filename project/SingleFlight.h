@@ -0,0 +1,110 @@
+#ifndef SINGLEFLIGHT_H
+#define SINGLEFLIGHT_H
+
+#include <atomic>
+#include <cstdint>
+#include <exception>
+#include <functional>
+#include <future>
+#include <mutex>
+#include <unordered_map>
+#include <utility>
+#include <vector>
+
+// Collapses concurrent calls for the same key into one. The first caller
+// (the leader) runs the function; callers arriving while it is in flight wait
+// for the leader's result, or get its exception rethrown. Once the leader
+// finishes the key is forgotten, so the next call runs the function again.
+template <typename K, typename V>
+class SingleFlight {
+  std::unordered_map<K, std::shared_future<V>> calls;
+  std::mutex mtx;
+  std::atomic<uint64_t> executed{0}, coalesced{0};
+
+public:
+  template <typename F>
+  V run(const K &key, F &&fn) {
+    std::promise<V> done;
+    {
+      std::unique_lock<std::mutex> lock(mtx);
+      auto it = calls.find(key);
+      if (it != calls.end()) {
+        std::shared_future<V> pending = it->second;
+        lock.unlock();
+        coalesced.fetch_add(1, std::memory_order_relaxed);
+        return pending.get();
+      }
+      calls.emplace(key, done.get_future().share());
+    }
+
+    executed.fetch_add(1, std::memory_order_relaxed);
+    try {
+      V result = fn();
+      forget(key);
+      done.set_value(result);
+      return result;
+    } catch (...) {
+      forget(key);
+      done.set_exception(std::current_exception());
+      throw;
+    }
+  }
+
+  // Number of calls that ran the function / were served by another call's
+  // result (i.e. work that coalescing saved).
+  uint64_t executed_count() const { return executed.load(); }
+  uint64_t coalesced_count() const { return coalesced.load(); }
+
+private:
+  void forget(const K &key) {
+    std::lock_guard<std::mutex> lock(mtx);
+    calls.erase(key);
+  }
+};
+
+// The same without blocking, for callers that must not wait (the epoll front
+// end's async routes). join() registers a callback; the first caller for a
+// key is the leader and must start the work and call finish() once, which
+// passes its result to everyone who joined meanwhile (the leader included).
+template <typename K, typename V>
+class AsyncSingleFlight {
+public:
+  using Callback = std::function<void(const V &)>;
+
+  // Returns true if the caller is the leader.
+  bool join(const K &key, Callback done) {
+    std::lock_guard<std::mutex> lock(mtx);
+    std::vector<Callback> &waiting = calls[key];
+    waiting.push_back(std::move(done));
+    if (waiting.size() > 1) {
+      coalesced.fetch_add(1, std::memory_order_relaxed);
+      return false;
+    }
+    executed.fetch_add(1, std::memory_order_relaxed);
+    return true;
+  }
+
+  void finish(const K &key, const V &result) {
+    std::vector<Callback> waiting;
+    {
+      std::lock_guard<std::mutex> lock(mtx);
+      auto it = calls.find(key);
+      if (it == calls.end())
+        return;
+      waiting.swap(it->second);
+      calls.erase(it);
+    }
+    for (auto &done : waiting)
+      done(result);
+  }
+
+  uint64_t executed_count() const { return executed.load(); }
+  uint64_t coalesced_count() const { return coalesced.load(); }
+
+private:
+  std::unordered_map<K, std::vector<Callback>> calls;
+  std::mutex mtx;
+  std::atomic<uint64_t> executed{0}, coalesced{0};
+};
+
+#endif // SINGLEFLIGHT_H
@@ -0,0 +1,249 @@
+#ifndef WORKERPROCESSES_H
+#define WORKERPROCESSES_H
+
+#include <sched.h>
+#include <signal.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <iostream>
+#include <map>
+#include <memory>
+#include <sstream>
+#include <string>
+#include <vector>
+
+#include "httplib.h"
+#include "Metrics.h"
+
+// Multi-process mode: N worker processes accept on the same port
+// (SO_REUSEPORT, the kernel spreads connections over them), each pinned to
+// its own CPUs, with its own pool and its own part of the key space.
+
+// "0-3,6" -> {0, 1, 2, 3, 6}.
+inline bool parse_cpu_list(const std::string &spec, std::vector<int> &cpus) {
+  std::stringstream ss(spec);
+  std::string item;
+  while (std::getline(ss, item, ',')) {
+    if (item.empty())
+      continue;
+    int lo, hi;
+    char dash;
+    std::stringstream range(item);
+    if (!(range >> lo))
+      return false;
+    hi = lo;
+    if (range >> dash && (dash != '-' || !(range >> hi)))
+      return false;
+    if (lo < 0 || hi < lo || hi >= CPU_SETSIZE)
+      return false;
+    for (int c = lo; c <= hi; c++)
+      cpus.push_back(c);
+  }
+  return !cpus.empty();
+}
+
+// KV_WORKER_CPUS: "0-1;2-3" gives each worker one ';'-separated group;
+// without ';' ("0-3") every CPU is a group of its own. Worker i gets group
+// i % groups.
+inline bool parse_cpu_sets(const std::string &spec,
+                           std::vector<std::vector<int>> &sets) {
+  if (spec.find(';') == std::string::npos) {
+    std::vector<int> cpus;
+    if (!parse_cpu_list(spec, cpus))
+      return false;
+    for (int c : cpus)
+      sets.push_back({c});
+    return true;
+  }
+  std::stringstream ss(spec);
+  std::string group;
+  while (std::getline(ss, group, ';')) {
+    std::vector<int> cpus;
+    if (!parse_cpu_list(group, cpus))
+      return false;
+    sets.push_back(cpus);
+  }
+  return !sets.empty();
+}
+
+// Pins the calling process (threads started later inherit the mask).
+inline bool pin_to_cpus(const std::vector<int> &cpus) {
+  cpu_set_t set;
+  CPU_ZERO(&set);
+  for (int c : cpus)
+    CPU_SET(c, &set);
+  return sched_setaffinity(0, sizeof(set), &set) == 0;
+}
+
+namespace worker_detail {
+
+inline int become_worker(int index, const std::vector<std::vector<int>> &sets,
+                         const sigset_t &mask) {
+  sigprocmask(SIG_SETMASK, &mask, nullptr);
+  if (!sets.empty()) {
+    const std::vector<int> &cpus = sets[index % sets.size()];
+    if (!pin_to_cpus(cpus))
+      perror("sched_setaffinity");
+    std::cout << "Worker " << index << " (pid " << getpid() << ") on CPUs";
+    for (int c : cpus)
+      std::cout << " " << c;
+    std::cout << std::endl;
+  }
+  return index;
+}
+
+inline void stop_all(const std::vector<pid_t> &pids) {
+  for (pid_t pid : pids)
+    if (pid > 0)
+      kill(pid, SIGTERM);
+}
+
+} // namespace worker_detail
+
+// Forks `workers` processes and returns the worker index (0..workers-1) in
+// each of them. The parent never returns: it stays as a supervisor that
+// passes SIGINT/SIGTERM on to the workers, restarts a worker that crashed
+// after running for a while, and exits once all workers are gone. Call
+// with SIGINT/SIGTERM blocked and before any thread is started. With one
+// worker nothing is forked; the process is only pinned.
+inline int fork_workers(int workers,
+                        const std::vector<std::vector<int>> &sets) {
+  using Clock = std::chrono::steady_clock;
+  sigset_t mask, wait_set;
+  sigprocmask(SIG_SETMASK, nullptr, &mask);
+  if (workers <= 1)
+    return worker_detail::become_worker(0, sets, mask);
+
+  sigemptyset(&wait_set);
+  sigaddset(&wait_set, SIGINT);
+  sigaddset(&wait_set, SIGTERM);
+  sigaddset(&wait_set, SIGCHLD);
+  sigprocmask(SIG_BLOCK, &wait_set, nullptr);
+
+  std::vector<pid_t> pids(workers, 0);
+  std::vector<Clock::time_point> started(workers);
+  int alive = 0, exit_code = 0;
+  bool stopping = false;
+  auto spawn = [&](int i) {
+    pid_t pid = fork();
+    if (pid < 0) {
+      perror("fork");
+      stopping = true;
+      exit_code = 1;
+      worker_detail::stop_all(pids);
+      return pid;
+    }
+    if (pid > 0) {
+      pids[i] = pid;
+      started[i] = Clock::now();
+      alive++;
+    }
+    return pid;
+  };
+  for (int i = 0; i < workers && !stopping; i++)
+    if (spawn(i) == 0)
+      return worker_detail::become_worker(i, sets, mask);
+
+  while (alive > 0) {
+    int sig = 0;
+    sigwait(&wait_set, &sig);
+    if (sig != SIGCHLD) {
+      if (!stopping)
+        std::cout << "\nStopping " << alive << " workers..." << std::endl;
+      stopping = true;
+      worker_detail::stop_all(pids);
+      continue;
+    }
+    int status;
+    pid_t pid;
+    while ((pid = waitpid(-1, &status, WNOHANG)) > 0) {
+      int i = 0;
+      while (i < workers && pids[i] != pid)
+        i++;
+      if (i == workers)
+        continue;
+      pids[i] = 0;
+      alive--;
+      if (stopping)
+        continue;
+      bool crashed = !WIFEXITED(status) || WEXITSTATUS(status) != 0;
+      if (crashed && Clock::now() - started[i] >= std::chrono::seconds(5)) {
+        std::cerr << "Worker " << i << " died, restarting it" << std::endl;
+        if (spawn(i) == 0)
+          return worker_detail::become_worker(i, sets, mask);
+        continue;
+      }
+      // Failed at startup (or stopped on its own): take the others down.
+      std::cerr << "Worker " << i << " exited, stopping the server"
+                << std::endl;
+      stopping = true;
+      exit_code = crashed ? 1 : 0;
+      worker_detail::stop_all(pids);
+    }
+  }
+  exit(exit_code);
+}
+
+// Key ownership between workers. Each worker caches only its own keys, so
+// a request for another worker's key is sent on to that worker's peer port
+// (127.0.0.1, base_port + worker), over a keep-alive connection per thread.
+class PeerRouter {
+public:
+  PeerRouter(int self, int workers, int base_port)
+      : self(self), workers(workers), base_port(base_port) {}
+
+  // On the unsigned value, so even a negative id maps to a real worker.
+  int owner(int id) const {
+    return (int)((unsigned)id % (unsigned)workers);
+  }
+  bool is_local(int id) const { return owner(id) == self; }
+  int worker_count() const { return workers; }
+  int self_index() const { return self; }
+  int port(int worker) const { return base_port + worker; }
+
+  // Sends req (with the given body) to a worker's peer port and copies the
+  // reply into res. Returns false if that worker could not be reached.
+  bool forward(int worker, const httplib::Request &req,
+               const std::string &body, httplib::Response &res) {
+    httplib::Request fwd;
+    fwd.method = req.method;
+    fwd.path = req.target;
+    fwd.body = body;
+    std::string type = req.get_header_value("Content-Type");
+    if (!type.empty())
+      fwd.set_header("Content-Type", type);
+    httplib::Result r = client(worker).send(fwd);
+    if (!r) {
+      errors.add();
+      return false;
+    }
+    forwarded.add();
+    res.status = r->status;
+    if (r->has_header("Retry-After"))
+      res.set_header("Retry-After", r->get_header_value("Retry-After"));
+    res.set_content(r->body, r->get_header_value("Content-Type"));
+    return true;
+  }
+
+  Counter forwarded; // requests answered by another worker
+  Counter errors;    // peers that could not be reached
+
+private:
+  const int self, workers, base_port;
+
+  httplib::Client &client(int worker) {
+    thread_local std::map<int, std::unique_ptr<httplib::Client>> clients;
+    std::unique_ptr<httplib::Client> &c = clients[port(worker)];
+    if (!c) {
+      c.reset(new httplib::Client("127.0.0.1", port(worker)));
+      c->set_keep_alive(true);
+    }
+    return *c;
+  }
+};
+
+#endif // WORKERPROCESSES_H
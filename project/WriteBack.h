@@ -0,0 +1,507 @@
+#ifndef WRITEBACK_H
+#define WRITEBACK_H
+
+#include <dirent.h>
+#include <fcntl.h>
+#include <unistd.h>
+
+#include <pqxx/pqxx>
+#include <algorithm>
+#include <cerrno>
+#include <chrono>
+#include <condition_variable>
+#include <cstdint>
+#include <cstdio>
+#include <cstring>
+#include <functional>
+#include <iostream>
+#include <map>
+#include <mutex>
+#include <optional>
+#include <stdexcept>
+#include <string>
+#include <thread>
+#include <vector>
+
+#include "dbpool.h"
+#include "PgArray.h"
+#include "KVStatements.h"
+
+struct WriteBackStats {
+  uint64_t appended = 0;       // records written to the log
+  uint64_t syncs = 0;          // fdatasync calls on the log
+  uint64_t flushes = 0;        // batches applied to kv_store
+  uint64_t flushed_keys = 0;
+  uint64_t flush_failures = 0;
+  uint64_t pending = 0;        // keys whose last write is not in kv_store yet
+};
+
+// Write-back mode: writes are appended to a local log and acknowledged
+// without waiting for Postgres; a flusher thread applies them to kv_store
+// every flush_every, one transaction per batch, with repeated writes to a
+// key merged into the last one. Until then lookup() has the value, so
+// readers of this server never see kv_store lag behind.
+//
+// With sync_every = 0 a write returns once its record is fdatasync'ed
+// (writers arriving during a sync share the next one); otherwise it returns
+// once the record is written, and the log is synced every sync_every.
+//
+// The log is a series of segments (path.00000001, ...). Each flush starts a
+// new segment and deletes the older ones once its transaction committed, so
+// whatever is on disk has not reached kv_store for sure; replay() applies
+// it at startup. A record is [op][id][length][value][checksum], so a write
+// torn by a crash ends the replay of that segment.
+class WriteBackLog {
+public:
+  enum Pending { NONE, VALUE, DELETED };
+  // Latest write per key; nullopt is a delete.
+  using Changes = std::map<int, std::optional<std::string>>;
+  // Called on the flusher thread with the ids each flush committed.
+  using Flushed = std::function<void(const std::vector<int> &)>;
+
+  // Replays segments left at path by an earlier run of this process (a
+  // worker restarted after a crash), then opens a new one. Throws if the
+  // log cannot be written or replayed.
+  WriteBackLog(LibpqxxPool &pool, const std::string &path,
+               std::chrono::milliseconds sync_every,
+               std::chrono::milliseconds flush_every, size_t max_batch,
+               Flushed flushed = nullptr)
+      : pool(pool), path(path), sync_every(sync_every),
+        flush_every(std::max(flush_every, std::chrono::milliseconds(1))),
+        max_batch(std::max<size_t>(1, max_batch)), flushed(flushed) {
+    pqxx::connection *conn = pool.acquire();
+    try {
+      replay(*conn, path, this->max_batch, false);
+      pool.release(conn);
+    } catch (...) {
+      pool.release(conn);
+      throw;
+    }
+    open_segment(1);
+    flusher = std::thread([this] { run(); });
+  }
+
+  ~WriteBackLog() { stop(); }
+
+  // Logs the changes and returns once they are as durable as sync_every
+  // says. Throws if the log could not be written; after that every write
+  // fails, as acknowledging it would break the guarantee.
+  void apply(const Changes &changes) {
+    std::unique_lock<std::mutex> lock(mtx);
+    if (stopping)
+      throw std::runtime_error("write-back log is closed");
+    for (auto &c : changes) {
+      encode(buf, c.first, c.second);
+      dirty[c.first] = c.second;
+    }
+    appended += changes.size();
+    totals.appended += changes.size();
+    uint64_t mine = appended;
+    // One caller writes (and syncs) what everyone has buffered.
+    while (written < mine) {
+      if (!io_error.empty())
+        throw std::runtime_error("write-back log: " + io_error);
+      if (writing) {
+        written_cv.wait(lock);
+        continue;
+      }
+      writing = true;
+      std::string out;
+      out.swap(buf);
+      uint64_t upto = appended;
+      int to = fd;
+      bool sync = sync_every.count() == 0;
+      lock.unlock();
+      std::string error;
+      if (!write_all(to, out))
+        error = std::string("write failed: ") + strerror(errno);
+      else if (sync && fdatasync(to) != 0)
+        error = std::string("fdatasync failed: ") + strerror(errno);
+      lock.lock();
+      writing = false;
+      if (error.empty()) {
+        written = upto;
+        if (sync)
+          totals.syncs++;
+      } else {
+        io_error = error;
+      }
+      written_cv.notify_all();
+    }
+    if (dirty.size() >= max_batch)
+      flush_cv.notify_one();
+  }
+
+  void save(int id, const std::string &value) { apply({{id, value}}); }
+  void remove(int id) { apply({{id, std::nullopt}}); }
+
+  // The write to id that kv_store does not have yet, if any.
+  Pending lookup(int id, std::string &value) {
+    std::lock_guard<std::mutex> lock(mtx);
+    auto it = dirty.find(id);
+    if (it == dirty.end()) {
+      it = flushing.find(id);
+      if (it == flushing.end())
+        return NONE;
+    }
+    if (!it->second)
+      return DELETED;
+    value = *it->second;
+    return VALUE;
+  }
+
+  // Waits until every write logged before the call is in kv_store, asking
+  // the flusher to flush now. Returns false if a flush fails first (the DB
+  // is down) or the log is closed; the writes are then still pending.
+  bool drain() {
+    std::unique_lock<std::mutex> lock(mtx);
+    uint64_t target = appended, failures = totals.flush_failures;
+    draining++;
+    flush_cv.notify_one();
+    applied_cv.wait(lock, [&] {
+      return applied >= target || totals.flush_failures != failures ||
+             stopping;
+    });
+    draining--;
+    return applied >= target;
+  }
+
+  // Flushes what is left and closes the log. Writes still unflushed (the DB
+  // is down) stay in the log for the next start.
+  void stop() {
+    {
+      std::lock_guard<std::mutex> lock(mtx);
+      if (stopping)
+        return;
+      stopping = true;
+    }
+    flush_cv.notify_all();
+    applied_cv.notify_all();
+    flusher.join();
+  }
+
+  WriteBackStats stats() {
+    std::lock_guard<std::mutex> lock(mtx);
+    WriteBackStats s = totals;
+    s.pending = dirty.size() + flushing.size();
+    return s;
+  }
+
+  // Applies every segment under path (path.N, and path.<worker>.N in
+  // multi-process mode) to kv_store in one transaction and deletes them.
+  // Returns the number of records replayed.
+  static size_t replay(pqxx::connection &conn, const std::string &path,
+                       size_t max_batch, bool prepare = true) {
+    std::vector<std::string> files = segment_files(path);
+    if (files.empty())
+      return 0;
+    Changes changes;
+    size_t records = 0;
+    for (auto &f : files)
+      records += read_segment(f, changes);
+    if (prepare)
+      for (auto &st : kv_statements())
+        conn.prepare(st.first, st.second);
+    pqxx::work txn{conn};
+    write_rows(txn, changes, max_batch);
+    txn.commit();
+    for (auto &f : files)
+      std::remove(f.c_str());
+    return records;
+  }
+
+private:
+  using Clock = std::chrono::steady_clock;
+
+  LibpqxxPool &pool;
+  const std::string path;
+  const std::chrono::milliseconds sync_every, flush_every;
+  const size_t max_batch;
+  Flushed flushed;
+
+  std::mutex mtx; // guards the state below
+  std::condition_variable written_cv, flush_cv, applied_cv;
+  Changes dirty;    // logged, not yet taken by the flusher
+  Changes flushing; // being applied (read without the lock by the flusher)
+  std::string buf;  // records not yet written
+  uint64_t appended = 0, written = 0, synced = 0; // records
+  uint64_t taken = 0, applied = 0; // records in flushing / in kv_store
+  int draining = 0; // callers waiting in drain()
+  bool writing = false, stopping = false;
+  std::string io_error;
+  int fd = -1;
+  uint64_t segment = 0;
+  std::vector<uint64_t> unflushed; // closed segments still needed
+  WriteBackStats totals;
+  std::thread flusher;
+
+  static const char kSave = 'S', kDelete = 'D';
+
+  std::string segment_name(uint64_t n) const {
+    char seq[16];
+    snprintf(seq, sizeof(seq), "%08llu", (unsigned long long)n);
+    return path + "." + seq;
+  }
+
+  static uint32_t checksum(const char *p, size_t n) { // FNV-1a
+    uint32_t h = 2166136261u;
+    for (size_t i = 0; i < n; i++)
+      h = (h ^ (unsigned char)p[i]) * 16777619u;
+    return h;
+  }
+
+  static void put32(std::string &out, uint32_t v) {
+    out.append(reinterpret_cast<const char *>(&v), 4);
+  }
+
+  static void encode(std::string &out, int id,
+                     const std::optional<std::string> &value) {
+    size_t start = out.size();
+    out += value ? kSave : kDelete;
+    put32(out, (uint32_t)id);
+    put32(out, value ? (uint32_t)value->size() : 0);
+    if (value)
+      out += *value;
+    put32(out, checksum(out.data() + start, out.size() - start));
+  }
+
+  // Adds a segment's records to changes; stops at the first damaged one.
+  static size_t read_segment(const std::string &file, Changes &changes) {
+    std::string data;
+    FILE *f = fopen(file.c_str(), "rb");
+    if (!f)
+      throw std::runtime_error("cannot read " + file);
+    char chunk[65536];
+    size_t n;
+    while ((n = fread(chunk, 1, sizeof(chunk), f)) > 0)
+      data.append(chunk, n);
+    fclose(f);
+
+    size_t pos = 0, records = 0;
+    while (data.size() - pos >= 13) {
+      uint32_t id, len, sum;
+      memcpy(&id, &data[pos + 1], 4);
+      memcpy(&len, &data[pos + 5], 4);
+      if (data.size() - pos - 13 < len)
+        break;
+      memcpy(&sum, &data[pos + 9 + len], 4);
+      char op = data[pos];
+      if ((op != kSave && op != kDelete) ||
+          sum != checksum(&data[pos], 9 + len))
+        break;
+      if (op == kSave)
+        changes[(int)id] = data.substr(pos + 9, len);
+      else
+        changes[(int)id] = std::nullopt;
+      pos += 13 + len;
+      records++;
+    }
+    if (pos < data.size())
+      std::cerr << file << ": ignoring " << data.size() - pos
+                << " bytes after the last complete record" << std::endl;
+    return records;
+  }
+
+  // path.00000001 or path.<anything>.00000001, oldest first.
+  static std::vector<std::string> segment_files(const std::string &path) {
+    size_t slash = path.rfind('/');
+    std::string dir = slash == std::string::npos ? "." : path.substr(0, slash);
+    std::string base =
+        (slash == std::string::npos ? path : path.substr(slash + 1)) + ".";
+    std::vector<std::string> files;
+    DIR *d = opendir(dir.c_str());
+    if (!d)
+      return files;
+    while (dirent *e = readdir(d)) {
+      std::string name = e->d_name;
+      size_t dot = name.rfind('.');
+      if (name.compare(0, base.size(), base) != 0 || dot < base.size() - 1 ||
+          name.size() - dot - 1 != 8 ||
+          name.find_first_not_of("0123456789", dot + 1) != std::string::npos)
+        continue;
+      files.push_back(slash == std::string::npos ? name : dir + "/" + name);
+    }
+    closedir(d);
+    std::sort(files.begin(), files.end());
+    return files;
+  }
+
+  static bool write_all(int to, const std::string &data) {
+    size_t off = 0;
+    while (off < data.size()) {
+      ssize_t n = write(to, data.data() + off, data.size() - off);
+      if (n < 0 && errno == EINTR)
+        continue;
+      if (n <= 0)
+        return false;
+      off += n;
+    }
+    return true;
+  }
+
+  // Also syncs the directory, so the new segment survives a crash.
+  void open_segment(uint64_t n) {
+    int next = open(segment_name(n).c_str(),
+                    O_WRONLY | O_CREAT | O_APPEND | O_CLOEXEC, 0644);
+    if (next < 0)
+      throw std::runtime_error("cannot open " + segment_name(n) + ": " +
+                               strerror(errno));
+    size_t slash = path.rfind('/');
+    std::string dir = slash == std::string::npos ? "." : path.substr(0, slash);
+    int dfd = open(dir.c_str(), O_RDONLY | O_DIRECTORY | O_CLOEXEC);
+    if (dfd >= 0) {
+      fsync(dfd);
+      close(dfd);
+    }
+    fd = next;
+    segment = n;
+  }
+
+  // Deletes are sent before upserts; within a batch a key appears once.
+  static void write_rows(pqxx::work &txn, const Changes &changes,
+                         size_t max_batch) {
+    std::vector<int> del, ups;
+    std::vector<std::string> vals;
+    auto send = [&] {
+      if (!del.empty())
+        txn.exec_prepared("kv_delete_many", pg_int_array(del));
+      if (!ups.empty())
+        txn.exec_prepared("kv_upsert_many", pg_int_array(ups),
+                          pg_text_array(vals));
+      del.clear();
+      ups.clear();
+      vals.clear();
+    };
+    for (auto &kv : changes) {
+      if (kv.second) {
+        ups.push_back(kv.first);
+        vals.push_back(*kv.second);
+      } else {
+        del.push_back(kv.first);
+      }
+      if (del.size() + ups.size() >= max_batch)
+        send();
+    }
+    send();
+  }
+
+  void run() {
+    auto last_sync = Clock::now(), last_flush = Clock::now();
+    auto tick = sync_every.count() ? std::min(sync_every, flush_every)
+                                   : flush_every;
+    std::unique_lock<std::mutex> lock(mtx);
+    while (!stopping) {
+      flush_cv.wait_for(lock, tick, [this] {
+        return stopping || dirty.size() >= max_batch ||
+               (draining && !dirty.empty());
+      });
+      bool full = dirty.size() >= max_batch || (draining && !dirty.empty());
+      lock.unlock();
+      auto now = Clock::now();
+      if (sync_every.count() && now - last_sync >= sync_every) {
+        sync_log();
+        last_sync = now;
+      }
+      if (full || now - last_flush >= flush_every) {
+        flush();
+        last_flush = now;
+      }
+      lock.lock();
+    }
+    lock.unlock();
+    if (flush()) { // nothing left: the last segment is not needed either
+      close(fd);
+      std::remove(segment_name(segment).c_str());
+    } else {
+      sync_log();
+      close(fd);
+    }
+  }
+
+  // Periodic sync; only the flusher closes fd, so it stays valid here.
+  void sync_log() {
+    {
+      std::lock_guard<std::mutex> lock(mtx);
+      if (written == synced)
+        return;
+      synced = written;
+      totals.syncs++;
+    }
+    fdatasync(fd);
+  }
+
+  // Applies everything logged so far. Returns false if the transaction
+  // failed; the changes are then retried with the next flush.
+  bool flush() {
+    int old_fd;
+    {
+      std::unique_lock<std::mutex> lock(mtx);
+      if (dirty.empty()) {
+        applied = appended;
+        applied_cv.notify_all();
+        return true;
+      }
+      // The old segment must get no more writes. Records still in buf go
+      // to the new one and are in this batch too: replaying them is
+      // harmless.
+      written_cv.wait(lock, [this] { return !writing; });
+      old_fd = fd;
+      try {
+        open_segment(segment + 1);
+      } catch (const std::exception &e) {
+        std::cerr << "Write-back: " << e.what() << std::endl;
+        totals.flush_failures++;
+        applied_cv.notify_all();
+        return false;
+      }
+      unflushed.push_back(segment - 1);
+      flushing.swap(dirty);
+      taken = appended;
+    }
+    if (sync_every.count())
+      fdatasync(old_fd);
+    close(old_fd);
+
+    pqxx::connection *conn = nullptr;
+    bool ok = true;
+    try {
+      conn = pool.acquire();
+      pqxx::work txn{*conn};
+      write_rows(txn, flushing, max_batch);
+      txn.commit();
+    } catch (const std::exception &e) {
+      std::cerr << "Write-back flush failed: " << e.what() << std::endl;
+      ok = false;
+    }
+    if (conn)
+      pool.release(conn);
+
+    std::vector<uint64_t> done;
+    std::vector<int> ids;
+    if (ok && flushed)
+      for (auto &kv : flushing)
+        ids.push_back(kv.first);
+    {
+      std::lock_guard<std::mutex> lock(mtx);
+      if (ok) {
+        totals.flushes++;
+        totals.flushed_keys += flushing.size();
+        done.swap(unflushed);
+        applied = taken;
+      } else {
+        totals.flush_failures++;
+        for (auto &kv : flushing) // newer writes in dirty win
+          dirty.emplace(kv.first, std::move(kv.second));
+      }
+      flushing.clear();
+      applied_cv.notify_all();
+    }
+    for (uint64_t n : done)
+      std::remove(segment_name(n).c_str());
+    if (!ids.empty())
+      flushed(ids);
+    return ok;
+  }
+};
+
+#endif // WRITEBACK_H
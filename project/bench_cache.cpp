@@ -0,0 +1,189 @@
+// g++ -O2 bench_cache.cpp -lpthread -o bench_cache
+// ./bench_cache [keys] [seconds_per_run] [shards] [policy_threads]
+//
+// Microbenchmarks for KVCache.
+//
+// 1. Hit scaling: the cache is pre-filled so every get() is a hit, then 1, 8,
+//    32 and 128 threads hammer it with random keys. Each thread count is run
+//    once with a single shard (the old single-lock LRU) and once sharded.
+//
+// 2. Eviction policies: the cache holds 10% of the keys and every miss is
+//    followed by a fill(), like the /val handler. For LRU, CLOCK and S3-FIFO
+//    it reports hit ratio and ops/s on the key distributions the load
+//    generators model: uniform, 80/20 (20% of keys get 80% of requests, as
+//    in loadgen.py's get_popular) and Zipf (s = 0.99), with and without
+//    TinyLFU admission.
+
+#include "KVCache.h"
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <cmath>
+#include <iomanip>
+#include <iostream>
+#include <random>
+#include <string>
+#include <thread>
+#include <vector>
+
+using namespace std;
+
+struct RunResult {
+  double ops_per_s;
+  double hit_ratio;
+};
+
+// Every thread walks the pre-generated key trace from its own offset, so key
+// generation cost is not part of the measurement.
+RunResult run(KVCache &cache, const vector<int> &trace, int threads,
+              double seconds, bool fill_on_miss) {
+  atomic<bool> go{false}, stop{false};
+  vector<long long> ops(threads, 0), hits(threads, 0);
+  vector<thread> workers;
+
+  for (int t = 0; t < threads; t++) {
+    workers.emplace_back([&, t] {
+      size_t pos = (trace.size() / threads) * t;
+      string value;
+      long long n = 0, h = 0;
+      while (!go.load())
+        this_thread::yield();
+      while (!stop.load(memory_order_relaxed)) {
+        for (int i = 0; i < 256; i++) {
+          int key = trace[pos];
+          pos = pos + 1 == trace.size() ? 0 : pos + 1;
+          if (cache.get(key, value))
+            h++;
+          else if (fill_on_miss)
+            cache.fill(key, "value_" + to_string(key));
+        }
+        n += 256;
+      }
+      ops[t] = n;
+      hits[t] = h;
+    });
+  }
+
+  auto start = chrono::steady_clock::now();
+  go = true;
+  this_thread::sleep_for(chrono::duration<double>(seconds));
+  stop = true;
+  for (auto &w : workers)
+    w.join();
+  double elapsed =
+      chrono::duration<double>(chrono::steady_clock::now() - start).count();
+
+  long long total = 0, total_hits = 0;
+  for (int t = 0; t < threads; t++) {
+    total += ops[t];
+    total_hits += hits[t];
+  }
+  return {total / elapsed, total ? double(total_hits) / total : 0.0};
+}
+
+vector<int> uniform_trace(int keys, size_t n, mt19937 &gen) {
+  uniform_int_distribution<> distrib(0, keys - 1);
+  vector<int> trace(n);
+  for (auto &k : trace)
+    k = distrib(gen);
+  return trace;
+}
+
+vector<int> popular_trace(int keys, size_t n, mt19937 &gen) {
+  int hot = max(1, keys / 5);
+  uniform_int_distribution<> hot_d(0, hot - 1), cold_d(hot, keys - 1);
+  bernoulli_distribution pick_hot(0.8);
+  vector<int> trace(n);
+  for (auto &k : trace)
+    k = pick_hot(gen) || hot == keys ? hot_d(gen) : cold_d(gen);
+  return trace;
+}
+
+vector<int> zipf_trace(int keys, size_t n, mt19937 &gen, double s = 0.99) {
+  vector<double> cdf(keys);
+  double sum = 0;
+  for (int i = 0; i < keys; i++) {
+    sum += 1.0 / pow(i + 1, s);
+    cdf[i] = sum;
+  }
+  // Scatter ranks over the key space so hot keys are not all adjacent ids.
+  vector<int> rank_to_key(keys);
+  for (int i = 0; i < keys; i++)
+    rank_to_key[i] = i;
+  shuffle(rank_to_key.begin(), rank_to_key.end(), gen);
+
+  uniform_real_distribution<> u(0.0, sum);
+  vector<int> trace(n);
+  for (auto &k : trace) {
+    size_t rank = lower_bound(cdf.begin(), cdf.end(), u(gen)) - cdf.begin();
+    k = rank_to_key[min(rank, cdf.size() - 1)];
+  }
+  return trace;
+}
+
+int main(int argc, char **argv) {
+  int keys = argc > 1 ? stoi(argv[1]) : 10000;
+  double seconds = argc > 2 ? stod(argv[2]) : 2.0;
+  size_t shards = argc > 3 ? stoul(argv[3]) : 16;
+  int policy_threads = argc > 4 ? stoi(argv[4]) : 8;
+
+  mt19937 gen(42);
+  const size_t trace_len = 1 << 20;
+
+  cout << "== Hit scaling: keys=" << keys << " seconds=" << seconds
+       << " shards=" << shards << endl;
+  cout << setw(8) << "threads" << setw(18) << "1 shard (ops/s)" << setw(18)
+       << "sharded (ops/s)" << setw(10) << "speedup" << endl;
+
+  vector<int> hit_trace = uniform_trace(keys, trace_len, gen);
+  for (int threads : {1, 8, 32, 128}) {
+    double rates[2];
+    size_t configs[2] = {1, shards};
+    for (int c = 0; c < 2; c++) {
+      // Headroom so uneven shard fill never evicts: every get() is a hit.
+      KVCache cache(2 * keys, configs[c]);
+      for (int k = 0; k < keys; k++)
+        cache.put(k, "value_" + to_string(k));
+      rates[c] = run(cache, hit_trace, threads, seconds, false).ops_per_s;
+    }
+    cout << setw(8) << threads << setw(18) << fixed << setprecision(0)
+         << rates[0] << setw(18) << rates[1] << setw(9) << setprecision(2)
+         << rates[1] / rates[0] << "x" << endl;
+  }
+
+  size_t cache_size = max(1, keys / 10);
+  cout << endl
+       << "== Eviction policies: keys=" << keys << " cache=" << cache_size
+       << " shards=" << shards << " threads=" << policy_threads << endl;
+  cout << setw(10) << "dist" << setw(8) << "policy" << setw(10) << "tinylfu"
+       << setw(12) << "hit_ratio" << setw(16) << "ops/s" << endl;
+
+  struct Dist {
+    const char *name;
+    vector<int> trace;
+  };
+  vector<Dist> dists;
+  dists.push_back({"uniform", uniform_trace(keys, trace_len, gen)});
+  dists.push_back({"80/20", popular_trace(keys, trace_len, gen)});
+  dists.push_back({"zipf", zipf_trace(keys, trace_len, gen)});
+
+  for (auto &d : dists) {
+    for (EvictionPolicy p : {EvictionPolicy::LRU, EvictionPolicy::CLOCK,
+                             EvictionPolicy::S3FIFO}) {
+      for (bool admission : {false, true}) {
+        CacheConfig cfg;
+        cfg.capacity = cache_size;
+        cfg.shards = shards;
+        cfg.policy = p;
+        cfg.admission = admission;
+        KVCache cache(cfg);
+        RunResult r = run(cache, d.trace, policy_threads, seconds, true);
+        cout << setw(10) << d.name << setw(8) << eviction_policy_name(p)
+             << setw(10) << (admission ? "on" : "off") << setw(12)
+             << setprecision(4) << r.hit_ratio << setw(16) << setprecision(0)
+             << r.ops_per_s << endl;
+      }
+    }
+  }
+  return 0;
+}
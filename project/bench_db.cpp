@@ -0,0 +1,114 @@
+// g++ -O2 bench_db.cpp -lpqxx -lpq -o bench_db
+//
+// Per-query latency of the cache-miss read and the write path, before and
+// after prepared statements:
+//   before: db::work + exec_params      (BEGIN, parse/plan + execute, COMMIT)
+//   after:  db::nontransaction + exec_prepared (one round trip, no planning)
+// Runs against the same kv_store table the server uses.
+
+#include <pqxx/pqxx>
+#include <algorithm>
+#include <chrono>
+#include <functional>
+#include <iomanip>
+#include <iostream>
+#include <string>
+#include <vector>
+
+#include "dbpool.h"
+#include "KVStatements.h"
+
+using namespace std;
+namespace db = pqxx;
+
+void report(const string &name, vector<double> &us) {
+  sort(us.begin(), us.end());
+  double sum = 0;
+  for (double v : us)
+    sum += v;
+  auto pct = [&](double p) { return us[min(us.size() - 1, size_t(p * us.size()))]; };
+  cout << setw(28) << left << name << right << fixed << setprecision(1)
+       << setw(10) << sum / us.size() << setw(10) << pct(0.50) << setw(10)
+       << pct(0.99) << endl;
+}
+
+vector<double> measure(int iterations, const function<void(int)> &query) {
+  vector<double> us;
+  us.reserve(iterations);
+  for (int i = 0; i < iterations; i++) {
+    auto t0 = chrono::steady_clock::now();
+    query(i);
+    us.push_back(chrono::duration<double, micro>(chrono::steady_clock::now() - t0).count());
+  }
+  return us;
+}
+
+int main() {
+  string db_host;
+  cout << "Enter DB Host IP (e.g., 172.23.32.1): ";
+  cin >> db_host;
+  int iterations;
+  cout << "Enter iterations per query: ";
+  cin >> iterations;
+  const string conn_str =
+      "dbname=decs user=postgres password=kali host=" + db_host;
+
+  LibpqxxPool pool(1, conn_str);
+  db::connection *conn = pool.acquire();
+  {
+    db::work txn{*conn};
+    txn.exec("CREATE TABLE IF NOT EXISTS kv_store ("
+             "  id INT PRIMARY KEY,"
+             "  value TEXT NOT NULL"
+             ");");
+    txn.exec_params("INSERT INTO kv_store (id, value) VALUES ($1, $2) "
+                    "ON CONFLICT (id) DO NOTHING",
+                    1, "bench");
+    txn.commit();
+  }
+  pool.release(conn);
+  prepare_kv_statements(pool);
+  conn = pool.acquire();
+
+  // Keys the benchmark may overwrite: far above what the load generators use.
+  const int write_base = 2000000000 - iterations;
+
+  cout << setw(28) << left << "query (us)" << right << setw(10) << "avg"
+       << setw(10) << "p50" << setw(10) << "p99" << endl;
+
+  auto get_before = measure(iterations, [&](int) {
+    db::work txn{*conn};
+    txn.exec_params("SELECT value FROM kv_store WHERE id = $1", 1);
+    txn.commit();
+  });
+  report("GET  work + exec_params", get_before);
+
+  auto get_after = measure(iterations, [&](int) {
+    db::nontransaction txn{*conn};
+    txn.exec_prepared("kv_get", 1);
+  });
+  report("GET  nontx + exec_prepared", get_after);
+
+  auto put_before = measure(iterations, [&](int i) {
+    db::work txn{*conn};
+    txn.exec_params("INSERT INTO kv_store (id, value) VALUES ($1, $2) "
+                    "ON CONFLICT (id) DO UPDATE SET value = $2",
+                    write_base + i, "bench");
+    txn.commit();
+  });
+  report("SAVE work + exec_params", put_before);
+
+  auto put_after = measure(iterations, [&](int i) {
+    db::nontransaction txn{*conn};
+    txn.exec_prepared("kv_upsert", write_base + i, "bench");
+  });
+  report("SAVE nontx + exec_prepared", put_after);
+
+  {
+    db::work txn{*conn};
+    txn.exec_params("DELETE FROM kv_store WHERE id >= $1", write_base);
+    txn.commit();
+  }
+  pool.release(conn);
+  return 0;
+}
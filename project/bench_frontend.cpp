@@ -0,0 +1,345 @@
+// Front-end benchmark: httplib's thread-per-connection ThreadPool vs the epoll
+// front end (EpollServer.h) with 100, 1,000 and 10,000 keep-alive
+// connections. The server runs in a child process with a simulated workload:
+// a share of requests are cache hits (a map lookup, answered inline by the
+// epoll front end), the rest sleep for db_us like a DB round trip and go to
+// the worker threads. Every connection sends one request at a time (closed
+// loop), like a k6 VU.
+//
+// g++ -O2 bench_frontend.cpp -lpthread -o bench_frontend
+// ./bench_frontend [seconds=5] [http_threads=16] [db_us=1000] [hit_pct=90]
+#include <arpa/inet.h>
+#include <netinet/in.h>
+#include <netinet/tcp.h>
+#include <signal.h>
+#include <sys/epoll.h>
+#include <sys/resource.h>
+#include <sys/socket.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+#include <algorithm>
+#include <atomic>
+#include <cerrno>
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <mutex>
+#include <random>
+#include <string>
+#include <thread>
+#include <unordered_map>
+#include <vector>
+
+#include "httplib.h"
+#include "EpollServer.h"
+
+using namespace std;
+using Clock = chrono::steady_clock;
+
+static const int kPort = 18234;
+static const int kHitKeys = 1000; // ids below this are cache hits
+
+struct Workload {
+  int threads;
+  int db_us;
+  unordered_map<int, string> cache;
+};
+
+bool cache_hit(const Workload &w, const httplib::Request &req,
+               httplib::Response &res) {
+  auto it = w.cache.find(atoi(req.get_param_value("id").c_str()));
+  if (it == w.cache.end())
+    return false;
+  res.set_content(it->second, "text/plain");
+  return true;
+}
+
+void full_handler(const Workload &w, const httplib::Request &req,
+                  httplib::Response &res) {
+  if (cache_hit(w, req, res))
+    return;
+  this_thread::sleep_for(chrono::microseconds(w.db_us));
+  res.set_content("value from db", "text/plain");
+}
+
+[[noreturn]] void serve(const string &frontend, const Workload &w) {
+  auto h = [&w](const httplib::Request &req, httplib::Response &res) {
+    full_handler(w, req, res);
+  };
+  if (frontend == "epoll") {
+    TaskQueueStats stats;
+    EpollServer srv(2, w.threads, 0, stats);
+    srv.Get("/val", h);
+    srv.serve_inline("GET", "/val",
+                     [&w](const httplib::Request &req, httplib::Response &res) {
+                       return cache_hit(w, req, res);
+                     });
+    if (!srv.bind_to_port("127.0.0.1", kPort))
+      _exit(1);
+    srv.listen_after_bind();
+  } else {
+    httplib::Server srv;
+    int n = w.threads;
+    srv.new_task_queue = [n] { return new httplib::ThreadPool(n); };
+    srv.set_tcp_nodelay(true); // as server.cpp; else Nagle adds ~40 ms
+    srv.Get("/val", h);
+    srv.listen("127.0.0.1", kPort);
+  }
+  _exit(0);
+}
+
+// Non-blocking connect; completion is reported as EPOLLOUT. SO_LINGER 0
+// closes with a reset, so thousands of closed connections leave no
+// TIME_WAIT behind between runs.
+int start_connect() {
+  int fd = socket(AF_INET, SOCK_STREAM | SOCK_NONBLOCK, 0);
+  sockaddr_in addr{};
+  addr.sin_family = AF_INET;
+  addr.sin_port = htons(kPort);
+  inet_pton(AF_INET, "127.0.0.1", &addr.sin_addr);
+  int one = 1;
+  setsockopt(fd, IPPROTO_TCP, TCP_NODELAY, &one, sizeof(one));
+  linger lg{1, 0};
+  setsockopt(fd, SOL_SOCKET, SO_LINGER, &lg, sizeof(lg));
+  if (connect(fd, (sockaddr *)&addr, sizeof(addr)) < 0 &&
+      errno != EINPROGRESS) {
+    close(fd);
+    return -1;
+  }
+  return fd;
+}
+
+bool server_up() {
+  int fd = socket(AF_INET, SOCK_STREAM, 0);
+  sockaddr_in addr{};
+  addr.sin_family = AF_INET;
+  addr.sin_port = htons(kPort);
+  inet_pton(AF_INET, "127.0.0.1", &addr.sin_addr);
+  bool ok = connect(fd, (sockaddr *)&addr, sizeof(addr)) == 0;
+  close(fd);
+  return ok;
+}
+
+struct ClientConn {
+  int fd = -1;
+  bool connecting = false;
+  string in;
+  Clock::time_point sent;
+  uint64_t done = 0;
+};
+
+struct Results {
+  mutex mtx;
+  vector<uint32_t> latency_us;
+  uint64_t errors = 0, reconnects = 0, idle_conns = 0;
+  atomic<int> connected{0}; // client threads done connecting
+  atomic<bool> go{false};
+  Clock::time_point deadline;
+};
+
+// Response complete in in? Returns its length, or 0.
+size_t response_length(const string &in, bool &close) {
+  size_t head = in.find("\r\n\r\n");
+  if (head == string::npos)
+    return 0;
+  size_t body = 0;
+  size_t cl = in.find("Content-Length: ");
+  if (cl != string::npos && cl < head)
+    body = strtoul(in.c_str() + cl + 16, nullptr, 10);
+  size_t total = head + 4 + body;
+  if (in.size() < total)
+    return 0;
+  size_t conn = in.find("Connection: close");
+  close = conn != string::npos && conn < head;
+  return total;
+}
+
+// Opens conns connections, waits for the other client threads, then keeps
+// one request in flight per connection until the deadline.
+void client_thread(int conns, int hit_pct, Results &out, unsigned seed) {
+  mt19937 rng(seed);
+  uniform_int_distribution<int> pct(0, 99), hit(0, kHitKeys - 1),
+      miss(kHitKeys, 1000000);
+  int ep = epoll_create1(0);
+  vector<ClientConn> cs(conns);
+  vector<uint32_t> lat;
+  uint64_t errors = 0, reconnects = 0;
+  bool running = false;
+
+  auto send_next = [&](int i) {
+    ClientConn &c = cs[i];
+    int id = pct(rng) < hit_pct ? hit(rng) : miss(rng);
+    string req = "GET /val?id=" + to_string(id) +
+                 " HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n";
+    c.sent = Clock::now();
+    if (send(c.fd, req.data(), req.size(), MSG_NOSIGNAL) < 0)
+      errors++;
+  };
+  auto open_conn = [&](int i) {
+    ClientConn &c = cs[i];
+    c.in.clear();
+    c.fd = start_connect();
+    if (c.fd < 0) {
+      errors++;
+      return;
+    }
+    c.connecting = true;
+    epoll_event ev{};
+    ev.events = EPOLLOUT;
+    ev.data.u32 = i;
+    epoll_ctl(ep, EPOLL_CTL_ADD, c.fd, &ev);
+  };
+  auto drop_conn = [&](int i) {
+    ClientConn &c = cs[i];
+    epoll_ctl(ep, EPOLL_CTL_DEL, c.fd, nullptr);
+    close(c.fd);
+    c.fd = -1;
+  };
+  for (int i = 0; i < conns; i++)
+    open_conn(i);
+
+  int pending = conns;
+  auto connect_deadline = Clock::now() + chrono::seconds(30);
+  epoll_event events[512];
+  char buf[65536];
+  for (;;) {
+    if (!running && (pending == 0 || Clock::now() > connect_deadline)) {
+      // Everyone connected (or gave up): start together.
+      out.connected++;
+      while (!out.go)
+        this_thread::sleep_for(chrono::milliseconds(1));
+      running = true;
+      for (int i = 0; i < conns; i++)
+        if (cs[i].fd >= 0 && !cs[i].connecting)
+          send_next(i);
+    }
+    if (running && Clock::now() >= out.deadline)
+      break;
+    int n = epoll_wait(ep, events, 512, 50);
+    for (int e = 0; e < n; e++) {
+      int i = events[e].data.u32;
+      ClientConn &c = cs[i];
+      if (c.connecting) {
+        int err = 0;
+        socklen_t len = sizeof(err);
+        getsockopt(c.fd, SOL_SOCKET, SO_ERROR, &err, &len);
+        c.connecting = false;
+        pending -= !running;
+        if (err) {
+          errors++;
+          drop_conn(i);
+          continue;
+        }
+        epoll_event ev{};
+        ev.events = EPOLLIN;
+        ev.data.u32 = i;
+        epoll_ctl(ep, EPOLL_CTL_MOD, c.fd, &ev);
+        if (running)
+          send_next(i);
+        continue;
+      }
+      ssize_t r = recv(c.fd, buf, sizeof(buf), 0);
+      bool reopen = r <= 0;
+      if (r > 0) {
+        c.in.append(buf, r);
+        bool close_conn = false;
+        size_t len = response_length(c.in, close_conn);
+        if (len) {
+          lat.push_back(chrono::duration_cast<chrono::microseconds>(
+                            Clock::now() - c.sent)
+                            .count());
+          c.done++;
+          c.in.erase(0, len);
+          if (close_conn)
+            reopen = true;
+          else
+            send_next(i);
+        }
+      }
+      if (reopen) {
+        drop_conn(i);
+        reconnects++;
+        open_conn(i);
+      }
+    }
+  }
+  uint64_t idle = 0;
+  for (int i = 0; i < conns; i++) {
+    idle += cs[i].done == 0;
+    if (cs[i].fd >= 0)
+      close(cs[i].fd);
+  }
+  close(ep);
+  lock_guard<mutex> lock(out.mtx);
+  out.latency_us.insert(out.latency_us.end(), lat.begin(), lat.end());
+  out.errors += errors;
+  out.reconnects += reconnects;
+  out.idle_conns += idle;
+}
+
+void run(const string &frontend, int conns, int seconds, int hit_pct,
+         const Workload &w) {
+  pid_t pid = fork();
+  if (pid == 0)
+    serve(frontend, w);
+  for (int i = 0; i < 100 && !server_up(); i++) // wait for the listener
+    this_thread::sleep_for(chrono::milliseconds(20));
+
+  Results res;
+  int client_threads = 4;
+  vector<thread> threads;
+  for (int t = 0; t < client_threads; t++) {
+    int share = conns / client_threads + (t < conns % client_threads);
+    threads.emplace_back(client_thread, share, hit_pct, ref(res), 1234u + t);
+  }
+  while (res.connected < client_threads)
+    this_thread::sleep_for(chrono::milliseconds(1));
+  res.deadline = Clock::now() + chrono::seconds(seconds);
+  res.go = true;
+  for (auto &t : threads)
+    t.join();
+  kill(pid, SIGKILL);
+  waitpid(pid, nullptr, 0);
+
+  auto &lat = res.latency_us;
+  sort(lat.begin(), lat.end());
+  auto pct = [&](double p) {
+    return lat.empty() ? 0.0 : lat[size_t(p * (lat.size() - 1))] / 1000.0;
+  };
+  printf("%-8s %6d %10.0f %8.2f %8.2f %9.2f %6llu %6llu %6llu\n",
+         frontend.c_str(), conns, lat.size() / double(seconds), pct(0.50),
+         pct(0.99), lat.empty() ? 0.0 : lat.back() / 1000.0,
+         (unsigned long long)res.idle_conns,
+         (unsigned long long)res.reconnects, (unsigned long long)res.errors);
+  fflush(stdout);
+  this_thread::sleep_for(chrono::milliseconds(500)); // let TIME_WAITs settle
+}
+
+int main(int argc, char **argv) {
+  int seconds = argc > 1 ? atoi(argv[1]) : 5;
+  Workload w;
+  w.threads = argc > 2 ? atoi(argv[2]) : 16;
+  w.db_us = argc > 3 ? atoi(argv[3]) : 1000;
+  int hit_pct = argc > 4 ? atoi(argv[4]) : 90;
+  for (int i = 0; i < kHitKeys; i++)
+    w.cache[i] = "value" + to_string(i);
+
+  // 10,000 connections need 10,000 descriptors on each side.
+  rlimit rl;
+  getrlimit(RLIMIT_NOFILE, &rl);
+  rl.rlim_cur = rl.rlim_max;
+  setrlimit(RLIMIT_NOFILE, &rl);
+  signal(SIGPIPE, SIG_IGN);
+
+  printf("%d s per run, %d HTTP/worker threads, %d us per DB request, "
+         "%d%% cache hits, fd limit %llu\n",
+         seconds, w.threads, w.db_us, hit_pct,
+         (unsigned long long)rl.rlim_cur);
+  printf("%-8s %6s %10s %8s %8s %9s %6s %6s %6s\n", "frontend", "conns",
+         "req/s", "p50_ms", "p99_ms", "max_ms", "idle", "reconn", "errors");
+  for (int conns : {100, 1000, 10000})
+    for (const char *frontend : {"httplib", "epoll"})
+      run(frontend, conns, seconds, hit_pct, w);
+  return 0;
+}
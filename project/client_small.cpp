@@ -3,6 +3,7 @@
 // HTTPS ->  #define CPPHTTPLIB_OPENSSL_SUPPORT
 
 #include "httplib.h"
+#include <fstream>
 #include <iostream>
 #include <string>
 #include <thread>
@@ -60,30 +61,120 @@ void fill_all(int tno) {
   }
 }
 
-void get_all(int tno) {
+// Reads the whole table through /scan. The rows arrive as one streamed
+// response; if it breaks off, the scan resumes after the last row received.
+void get_all() {
   Client cli("localhost", 1234);
   cli.set_keep_alive(true);
 
-  for (int i = tno * 100; i < (tno + 1) * 100; i++) {
-
-    httplib::Result res;
-    string path;
-    path = "/val?id=" + to_string(i);
-    try {
-      res = cli.Get(path);
-      if (!res) {
-        cout << "E";
-      }else{
-        cout<<res->body<<endl;
+  int next = 0;
+  bool done = false;
+  for (int failures = 0; !done && failures < 3;) {
+    string partial;
+    auto res = cli.Get(
+        "/scan?from=" + to_string(next),
+        [](const Response &r) { return r.status == 200; },
+        [&](const char *data, size_t len) {
+      partial.append(data, len);
+      size_t nl;
+      while ((nl = partial.find('\n')) != string::npos) {
+        string line = partial.substr(0, nl);
+        partial.erase(0, nl + 1);
+        if (line == "end") {
+          done = true;
+        } else if (line.compare(0, 5, "next\t") == 0) {
+          next = stoi(line.substr(5));
+        } else {
+          cout << line << endl;
+          next = stoi(line) + 1;
+        }
       }
+      return true;
+    });
+    if (!res) {
+      cout << "E";
+      failures++;
+    }
+  }
+}
+// Sends a body of the given size to /bulk/import, taking it from next(),
+// which appends the following piece to its argument.
+void bulk_import(size_t size, function<void(string &)> next) {
+  Client cli("localhost", 1234);
+  cli.set_read_timeout(600, 0);
+  string piece;
+  size_t sent = 0;
+  auto res = cli.Post(
+      "/bulk/import", size,
+      [&](size_t offset, size_t length, DataSink &sink) {
+        if (offset < sent)
+          return false; // the upload was restarted; pieces are gone
+        if (piece.empty())
+          next(piece);
+        size_t n = min(piece.size(), size - sent);
+        sink.write(piece.data(), n);
+        piece.erase(0, n);
+        sent += n;
+        return n > 0;
+      },
+      "text/plain");
+  if (!res)
+    cout << "E" << endl;
+  else
+    cout << res->body << endl;
+}
 
-    } catch (const std::exception &e) {
-      cout << "X";
+// Seeds ids 0 .. count-1 (value = id) with one streamed /bulk/import.
+void bulk_fill(int count) {
+  size_t size = 0;
+  for (int i = 0; i < count; i++)
+    size += 2 * to_string(i).size() + 2;
+  int i = 0;
+  bulk_import(size, [&](string &piece) {
+    while (i < count && piece.size() < 64 * 1024) {
+      string id = to_string(i++);
+      piece += id + "\t" + id + "\n";
     }
+  });
+}
 
-    cout.flush();
+// Imports a file of "id<TAB>value" lines (e.g. one written by mode 9).
+void bulk_import_file(const string &path) {
+  ifstream in(path, ios::binary | ios::ate);
+  if (!in) {
+    cout << "Cannot open " << path << endl;
+    return;
   }
+  size_t size = in.tellg();
+  in.seekg(0);
+  bulk_import(size, [&](string &piece) {
+    char buf[64 * 1024];
+    in.read(buf, sizeof(buf));
+    piece.append(buf, in.gcount());
+  });
+}
+
+// Writes the whole table to a file through /bulk/export.
+void bulk_export_file(const string &path) {
+  ofstream out(path, ios::binary);
+  Client cli("localhost", 1234);
+  cli.set_read_timeout(600, 0);
+  size_t bytes = 0;
+  auto res = cli.Get(
+      "/bulk/export", [](const Response &r) { return r.status == 200; },
+      [&](const char *data, size_t len) {
+        out.write(data, len);
+        bytes += len;
+        return true;
+      });
+  if (!res)
+    cout << "E: export incomplete after " << bytes << " bytes" << endl;
+  else if (res->status != 200)
+    cout << res->status << " " << res->body << endl;
+  else
+    cout << "Exported " << bytes << " bytes to " << path << endl;
 }
+
 void get(int key) {
   Client cli("localhost", 1234);
   cli.set_keep_alive(true);
@@ -152,6 +243,9 @@ int main() {
   cout << "  4: CLEAR DATABASE" << endl;
   cout << "  5: GET DATABASE" << endl;
   cout << "  6: FILL DATABASE" << endl;
+  cout << "  7: BULK FILL DATABASE" << endl;
+  cout << "  8: BULK IMPORT FILE" << endl;
+  cout << "  9: BULK EXPORT FILE" << endl;
   cout << "Choice: ";
   cin >> mode;
 
@@ -189,17 +283,7 @@ int main() {
     }
   }
   if (mode == 5) {
-    vector<thread> threads;
-    auto start_time = chrono::high_resolution_clock::now();
-
-    for (int i = 0; i < 10; i++) {
-      threads.push_back(thread(get_all, i ));
-    }
-
-    // Wait for all threads to finish
-    for (auto &t : threads) {
-      t.join();
-    }
+    get_all();
   }
   if (mode == 6) {
     vector<thread> threads;
@@ -213,6 +297,21 @@ int main() {
       t.join();
     }
   }
+  if (mode == 7) {
+    cout << "Enter number of keys: ";
+    int count;
+    cin >> count;
+    bulk_fill(count);
+  }
+  if (mode == 8 || mode == 9) {
+    cout << "Enter file: ";
+    string path;
+    cin >> path;
+    if (mode == 8)
+      bulk_import_file(path);
+    else
+      bulk_export_file(path);
+  }
 
   return 0;
 }
\ No newline at end of file
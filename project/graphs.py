@@ -2,12 +2,13 @@ import requests
 import time
 import random
 import threading
-import numpy as np
 import csv
 import sys
 import matplotlib.pyplot as plt
 from concurrent.futures import ThreadPoolExecutor, wait
 
+from load_gen.hdr import Histogram
+
 # ================= CONFIGURATION =================
 # The Target Server
 BASE_URL = "http://localhost:1234"
@@ -33,16 +34,16 @@ def get_next_id():
         global_counter += 1
         return global_counter
 
-def run_worker(duration, results_list):
+def run_worker(duration):
     """
     Simulates a single Virtual User (VU).
-    Loops until duration expires.
+    Loops until duration expires; returns its own latency histogram.
     """
     session = requests.Session() # Use session for Keep-Alive
     start_time = time.time()
     end_time = start_time + duration
     
-    latencies = []
+    latencies = Histogram()
 
     while time.time() < end_time:
         req_start = time.time()
@@ -57,26 +58,22 @@ def run_worker(duration, results_list):
                 resp = session.post(f"{BASE_URL}/save?id={current_id}&val=hello_1234")
                 _ = resp.content
 
-            # Record latency in milliseconds
             req_end = time.time()
-            latencies.append((req_end - req_start) * 1000)
+            latencies.record(req_end - req_start)
 
         except requests.RequestException:
             pass
     
-    results_list.extend(latencies)
+    return latencies
 
 def calculate_metrics(vus, latencies, duration):
-    if not latencies:
+    if not latencies.count:
         return [vus, 0, 0, 0, 0, 0, 0]
 
-    count = len(latencies)
-    tps = count / duration
-    avg = np.mean(latencies)
-    p50 = np.percentile(latencies, 50)
-    p90 = np.percentile(latencies, 90)
-    p95 = np.percentile(latencies, 95)
-    p99 = np.percentile(latencies, 99)
+    tps = latencies.count / duration
+    # Latencies in milliseconds
+    avg = latencies.mean() * 1000
+    p50, p90, p95, p99 = (v * 1000 for v in latencies.values_at([50, 90, 95, 99]))
 
     return [vus, tps, avg, p50, p90, p95, p99]
 
@@ -158,14 +155,14 @@ def main():
         for vus in VUS_LIST:
             print(f"Running test with {vus} VUs for {DURATION_PER_TEST}s...", end=" ", flush=True)
             
-            all_latencies = []
-            
             with ThreadPoolExecutor(max_workers=vus) as executor:
                 futures = []
                 for _ in range(vus):
-                    futures.append(executor.submit(run_worker, DURATION_PER_TEST, all_latencies))
+                    futures.append(executor.submit(run_worker, DURATION_PER_TEST))
                 wait(futures)
 
+            all_latencies = Histogram.merged(f.result() for f in futures)
+
             metrics = calculate_metrics(vus, all_latencies, DURATION_PER_TEST)
             writer.writerow(metrics)
             
@@ -1,10 +1,41 @@
 #!/usr/bin/env python3
 # python3 load_gen.py --host localhost --thread-steps 10,50,100,200,500,1000 --duration 30 --csv benchmark.csv
 # taskset -c 3-11 python3 load_gen.py --host localhost --port 1234 --workload get_all --key-space 10000 --thread-steps 10,50,100,200,250,350 --csv getpop_o.csv
+# taskset -c 3-11 python3 load_gen.py --host localhost --engine procs --procs 8 --thread-steps 100,1000,5000 --csv procs.csv
+# taskset -c 3-11 python3 load_gen.py --host localhost --workload get_all --rate 5000,10000,20000 --connections 512 --csv open.csv
+# taskset -c 3-11 python3 load_gen.py --host localhost --workload get_all --slo-p99 10 --rate 5000 --csv slo.csv
+# taskset -c 3-11 python3 load_gen.py --host localhost --workload get_all --key-dist zipf --zipf-s 1.1 --hot-shift 30 --csv zipf.csv
+# taskset -c 3-11 python3 load_gen.py --host localhost --workload mixed --trace kv.trace --thread-steps 100 --csv replay.csv
+# taskset -c 3-11 python3 load_gen.py --host localhost --engine procs --thread-steps 100,1000 --duration 60 --timeseries ts.csv  (then python3 plot_timeseries.py ts.csv)
 """
 Automated Benchmark Runner.
 Runs the load test multiple times with different thread counts and logs all results to CSV.
 
+Engines:
+  threads  one thread per VU with a blocking requests.Session (the GIL caps it near one core)
+  procs    --procs worker processes, each an asyncio loop with one keep-alive
+           connection per VU (load_gen/engine.py)
+Both report the CPU the generator used, so a saturated client can be told
+from a saturated server.
+
+Both are closed loop: a VU waits for each response before sending again, so a
+stalling server also slows the generator and its latencies look too good.
+--rate runs open loop instead (procs engine): send times are scheduled ahead
+at a fixed, stepped or ramped rate, and latency is measured from the scheduled
+time (coordinated-omission corrected) as well as from the actual send.
+--slo-p99 searches for the highest rate whose corrected p99 meets the SLO.
+
+Keys: --key-dist sequential (default) walks the key space, one offset per
+VU; uniform, zipf and hotspot draw from load_gen/keygen.py, optionally with
+the hot set moving every --hot-shift seconds and --scan-prob scans.
+--trace replays a trace the server recorded with KV_TRACE: the keys, and
+for single-key workloads their operations too.
+
+--timeseries FILE also appends one row per second of every step: throughput,
+errors and latency percentiles, plus per-core CPU, disk and the CPU, context
+switches and RSS of the server and Postgres processes (load_gen/timeseries.py,
+from /proc, so only when they run on this host).
+
 Usage:
   python3 benchmark.py --host localhost --port 1234 --thread-steps 10,50,100,200,500 --duration 20 --csv benchmark_results.csv
 """
@@ -13,12 +44,20 @@ import argparse
 import threading
 import time
 import random
-import requests
 import sys
-import statistics
 import csv
 import os
-from urllib.parse import urljoin
+from functools import partial
+from urllib.parse import urlencode, urljoin
+
+try:
+    import requests
+except ImportError:
+    requests = None  # only the threads engine needs it
+
+from load_gen.engine import Request, Results, default_procs, run as run_procs
+from load_gen.keygen import DISTRIBUTIONS, KeyGen, TraceReplay, read_trace, tables as keygen_tables
+from load_gen import timeseries
 
 # ---- Config / CLI ----
 parser = argparse.ArgumentParser(description="Automated Load Test Benchmark")
@@ -26,52 +65,98 @@ parser.add_argument("--host", required=True, help="Server host (IP or hostname)"
 parser.add_argument("--port", type=int, default=1234, help="Server port")
 parser.add_argument("--thread-steps", type=str, default="10,50,100", help="Comma-separated list of thread counts to test (e.g. '10,50,100')")
 parser.add_argument("--duration", type=int, default=20, help="Duration of EACH test run in seconds")
-parser.add_argument("--workload", choices=["put_all", "get_all", "get_popular", "mixed"], default="mixed")
+parser.add_argument("--workload", choices=["put_all", "get_all", "get_popular", "mixed", "mget", "mset"], default="mixed")
 parser.add_argument("--csv", type=str, default="benchmark.csv", help="CSV file to save results")
 parser.add_argument("--key-space", type=int, default=10000, help="Number of distinct keys")
 parser.add_argument("--popular-size", type=int, default=10, help="Number of keys in 'popular' set")
+parser.add_argument("--batch-size", type=int, default=100, help="Keys per request for mget/mset")
+parser.add_argument("--key-dist", choices=("sequential",) + DISTRIBUTIONS, default="sequential", help="How keys are picked (get_popular always uses its popular set)")
+parser.add_argument("--zipf-s", type=float, default=1.0, help="zipf: skew exponent")
+parser.add_argument("--hot-share", type=float, default=0.8, help="hotspot: fraction of requests for the hot set")
+parser.add_argument("--hot-size", type=float, default=0.2, help="hotspot: hot set size as a fraction of --key-space")
+parser.add_argument("--hot-shift", type=float, default=0.0, help="Move the popular keys every this many seconds (zipf/hotspot)")
+parser.add_argument("--scan-prob", type=float, default=0.0, help="Chance a request starts a scan of --scan-len consecutive keys")
+parser.add_argument("--scan-len", type=int, default=100, help="Keys per scan")
+parser.add_argument("--timeseries", type=str, default=None, help="Append a per-second time series of every step (load and /proc resource use) to this CSV")
+parser.add_argument("--sample-procs", type=str, default="server=server*,postgres=postgres", help="Process groups sampled for --timeseries: label=name pattern, comma-separated")
+parser.add_argument("--trace", type=str, default=None, help="Replay the keys (and ops) of these comma-separated KV_TRACE files")
 parser.add_argument("--timeout", type=float, default=5.0, help="Request timeout")
+parser.add_argument("--engine", choices=["threads", "procs"], default=None, help="threads (default): one thread per VU; procs: asyncio worker processes")
+parser.add_argument("--procs", type=int, default=default_procs(), help="Worker processes for --engine procs (default: CPUs available)")
+parser.add_argument("--hdr-digits", type=int, default=3, help="Significant digits kept by the latency histograms (1-5)")
+parser.add_argument("--hist-dir", type=str, default=None, help="Save each step's latency histogram here as JSON (merge with python3 -m load_gen.hdr)")
+parser.add_argument("--rate", type=str, default=None, help="Open loop at this many req/s instead of --thread-steps: '5000', stepped '1000,2000,4000' or ramped '1000-8000'")
+parser.add_argument("--connections", type=int, default=256, help="Open loop: connections the requests are sent over")
+parser.add_argument("--slo-p99", type=float, default=None, help="Open loop: find the highest rate whose corrected p99 is at most this many ms (starts at the first --rate, default 1000)")
+parser.add_argument("--slo-max-errors", type=float, default=0.01, help="SLO search: largest failed-request fraction a passing rate may have")
+parser.add_argument("--slo-probes", type=int, default=8, help="SLO search: most rates to try")
 
 args = parser.parse_args()
+open_loop = args.rate is not None or args.slo_p99 is not None
+if open_loop and args.engine == "threads":
+    parser.error("open loop (--rate/--slo-p99) runs on the procs engine")
+if args.engine is None:
+    args.engine = "procs" if open_loop else "threads"
+if args.engine == "threads" and requests is None:
+    parser.error("--engine threads needs the requests package (pip install requests)")
+
+# Memory-mapped before the workers fork, so they share the pages
+trace = read_trace(args.trace.split(",")) if args.trace else None
+if trace is not None and len(trace) == 0:
+    parser.error(f"--trace {args.trace}: no records")
+# Likewise the key permutation and zipf CDF, which every VU shares; built
+# here, outside any measured window
+if trace is None and args.key_dist != "sequential":
+    keygen_tables(args.key_space, zipf_s=args.zipf_s if args.key_dist == "zipf" else None)
 
 BASE = f"http://{args.host}:{args.port}/"
 GET_PATH = "val"
 POST_PATH = "save"
 DEL_PATH = "delete"
+MGET_PATH = "mget"
+MSET_PATH = "mset"
 
-# ---- Global State (Reset for each run) ----
+# ---- Global State ----
 stop_event = threading.Event()
-stats_lock = threading.Lock()
-total_success = 0
-total_fail = 0
-response_times = []
 
 # ---- Core Functions ----
 def now_s():
     return time.monotonic()
 
-def record_result(success: bool, resp_time: float):
-    global total_success, total_fail, response_times
-    with stats_lock:
-        if success:
-            total_success += 1
-            response_times.append(resp_time)
-        else:
-            total_fail += 1
+class VirtualUser:
+    """One VU's stream of requests; both engines send the same ones."""
 
-def client_thread_fn(tid: int, id_start: int):
-    session = requests.Session()
-    local_counter = 0
-    rng = random.Random(tid + int(time.time()))
-    popular_keys = [id_start + i for i in range(args.popular_size)]
+    def __init__(self, tid: int, id_start: int = 1, vus: int = 1):
+        self.tid = tid
+        self.id_start = id_start
+        self.local_counter = 0
+        self.rng = random.Random(tid + int(time.time()))
+        self.popular_keys = [id_start + i for i in range(args.popular_size)]
+        self.keys = self.replay = None
+        if trace is not None:
+            # The VUs share the trace out between them in order
+            self.replay = TraceReplay(trace, tid - 1, vus)
+        elif args.key_dist != "sequential":
+            self.keys = KeyGen(args.key_space, args.key_dist, id_start, args.zipf_s,
+                               args.hot_share, args.hot_size, args.hot_shift,
+                               args.scan_prob, args.scan_len,
+                               seed=self.rng.getrandbits(64))
+
+    def next_key(self):
+        if self.replay is not None:
+            return self.replay.next()[0]
+        return self.keys.next()
+
+    def next(self) -> Request:
+        tid, id_start, rng = self.tid, self.id_start, self.rng
+        self.local_counter += 1
+        local_counter = self.local_counter
 
-    while not stop_event.is_set():
-        local_counter += 1
-        
         # Workload Selection
         if args.workload == "put_all": op = "write"
         elif args.workload == "get_all": op = "read"
         elif args.workload == "get_popular": op = "read_popular"
+        elif args.workload in ("mget", "mset"): op = args.workload
         else: # mixed
             r = rng.random()
             if r < 0.7: op = "read"
@@ -80,121 +165,298 @@ def client_thread_fn(tid: int, id_start: int):
 
         # Key Selection
         if op == "read_popular":
-            key = rng.choice(popular_keys)
+            key = rng.choice(self.popular_keys)
+        elif self.replay is not None:
+            key, trace_op = self.replay.next()
+            if op in ("read", "write", "delete"):
+                op = ("read", "write", "delete")[trace_op]
+        elif self.keys is not None:
+            key = self.keys.next()
         else:
             key = id_start + ((tid * 1000000 + local_counter) % args.key_space)
 
-        success = False
-        resp_time = 0.0
+        if op in ("read", "read_popular"):
+            return Request("GET", f"/{GET_PATH}?id={key}", None, None, 1, (200, 404))
+        if op == "write":
+            body = urlencode({"id": str(key), "val": f"val_{tid}_{local_counter}"})
+            return Request("POST", f"/{POST_PATH}", body, "application/x-www-form-urlencoded", 1, (200, 409))
+        if op == "delete":
+            return Request("DELETE", f"/{DEL_PATH}?id={key}", None, None, 1, (200, 404))
+
+        # Sequential batches cover a run of consecutive keys starting at key;
+        # the others draw every key from the distribution or trace
+        if self.replay is None and self.keys is None:
+            batch = [id_start + ((key - id_start + i) % args.key_space) for i in range(args.batch_size)]
+        else:
+            batch = [key] + [self.next_key() for _ in range(args.batch_size - 1)]
+        if op == "mget":
+            body = "".join(f"{k}\n" for k in batch)
+            return Request("POST", f"/{MGET_PATH}", body, None, len(batch), (200,))
+        body = "".join(f"{k}\tval_{tid}_{local_counter}\n" for k in batch)
+        return Request("POST", f"/{MSET_PATH}", body, None, len(batch), (200,))
+
+def client_thread_fn(tid: int, id_start: int, vus: int, results: Results):
+    # results belongs to this thread alone (bar its shared series);
+    # run_threads merges them after join
+    session = requests.Session()
+    user = VirtualUser(tid, id_start, vus)
+
+    while not stop_event.is_set():
+        req = user.next()
+        headers = {"Content-Type": req.content_type} if req.content_type else None
         t0 = now_s()
-        
+
         try:
-            if op in ("read", "read_popular"):
-                url = urljoin(BASE, GET_PATH)
-                r = session.get(url, params={"id": str(key)}, timeout=args.timeout)
-                resp_time = now_s() - t0
-                success = (r.status_code in (200, 404))
-            
-            elif op == "write":
-                url = urljoin(BASE, POST_PATH)
-                payload = {"id": str(key), "val": f"val_{tid}_{local_counter}"}
-                r = session.post(url, data=payload, timeout=args.timeout)
-                resp_time = now_s() - t0
-                success = (r.status_code in (200, 409))
-            
-            elif op == "delete":
-                url = urljoin(BASE, DEL_PATH)
-                r = session.delete(url, params={"id": str(key)}, timeout=args.timeout)
-                resp_time = now_s() - t0
-                success = (r.status_code in (200, 404))
+            r = session.request(req.method, urljoin(BASE, req.target), data=req.body,
+                                headers=headers, timeout=args.timeout)
+            success = (r.status_code in req.ok)
         except requests.exceptions.RequestException:
             success = False
-            resp_time = now_s() - t0
-        
-        record_result(success, resp_time)
 
-def run_single_test(num_threads):
-    global total_success, total_fail, response_times, stop_event
-    
-    # 1. Reset State
-    stop_event.clear()
-    with stats_lock:
-        total_success = 0
-        total_fail = 0
-        response_times = []
+        now = now_s()
+        if success:
+            results.ok(now, now - t0, req.keys)
+        else:
+            results.failed(now)
 
-    print(f"--> Running: {num_threads} threads for {args.duration}s...")
+def run_threads(num_threads):
+    stop_event.clear()
+    # One per-second series for all the threads, not one each
+    series = timeseries.SharedSeries() if args.timeseries is not None else None
+    per_thread = [Results(args.hdr_digits, series) for _ in range(num_threads)]
 
-    # 2. Start Threads
+    # 1. Start Threads
     threads = []
     start_time = now_s()
+    cpu_start = time.process_time()
     for i in range(num_threads):
-        t = threading.Thread(target=client_thread_fn, args=(i+1, 1), daemon=True)
+        t = threading.Thread(target=client_thread_fn, args=(i+1, 1, num_threads, per_thread[i]), daemon=True)
         threads.append(t)
         t.start()
 
-    # 3. Wait
+    # 2. Wait
     time.sleep(args.duration)
     stop_event.set()
 
-    # 4. Join
+    # 3. Join
     for t in threads:
         t.join(timeout=2.0)
-    
+
     elapsed = now_s() - start_time
+    cpu = time.process_time() - cpu_start
+
+    merged = Results(args.hdr_digits, series)
+    for r in per_thread:
+        merged.merge(r)
+    return merged, elapsed, [cpu]
+
+def run_single_test(num_threads, rate=None):
+    """One step: closed loop with num_threads VUs, or open loop at rate=(r0, r1)
+    req/s over num_threads connections."""
+    engine = args.engine
+    make_user = partial(VirtualUser, vus=num_threads)
+    series = args.timeseries is not None
+    sampler = timeseries.ProcSampler(timeseries.parse_groups(args.sample_procs)).start() if series else None
+    if rate:
+        procs = min(args.procs, num_threads)
+        print(f"--> Running: {rate_label(rate)} req/s open loop over {num_threads} connections "
+              f"in {procs} processes for {args.duration}s...")
+        res, elapsed, cpu = run_procs(args.host, args.port, num_threads, args.duration,
+                                      procs, make_user, args.timeout, args.hdr_digits, rate, series)
+    elif engine == "procs":
+        procs = min(args.procs, num_threads)
+        print(f"--> Running: {num_threads} VUs in {procs} processes for {args.duration}s...")
+        res, elapsed, cpu = run_procs(args.host, args.port, num_threads, args.duration,
+                                      procs, make_user, args.timeout, args.hdr_digits, series=series)
+    else:
+        print(f"--> Running: {num_threads} threads for {args.duration}s...")
+        res, elapsed, cpu = run_threads(num_threads)
+    rows = None
+    if series:
+        end = time.monotonic()
+        rows = timeseries.rows(res.series, sampler.stop(), end - elapsed - res.drain, end)
 
-    # 5. Calculate Metrics
-    with stats_lock:
-        succ = total_success
-        fail = total_fail
-        rts = list(response_times)
+    succ, fail, keys = res.success, res.fail, res.keys
+    # Open loop: replies after the schedule ended are not throughput
+    throughput = (succ - res.late) / elapsed if elapsed > 0 else 0.0
+    key_throughput = (keys - res.late_keys) / elapsed if elapsed > 0 else 0.0
+    p95, p99 = res.hist.values_at([95, 99])
 
-    total_req = succ + fail
-    throughput = succ / elapsed if elapsed > 0 else 0.0
-    avg_lat = statistics.mean(rts) if rts else 0.0
-    p50 = statistics.median(rts) if rts else 0.0
-    p95 = statistics.quantiles(rts, n=20)[-1] if rts and len(rts) >= 20 else 0.0
+    # Client CPU: cores used in total, and the busiest process as a share of
+    # one core (a thread-engine run can't go much past 100%)
+    ran = elapsed + res.drain  # the CPU was used while draining too
+    client_cores = sum(cpu) / ran if ran > 0 else 0.0
+    busiest = max(cpu) / ran if ran > 0 else 0.0
 
-    print(f"    Done. Throughput: {throughput:.2f} req/s | P95: {p95:.4f}s")
+    print(f"    Done. Throughput: {throughput:.2f} req/s ({key_throughput:.2f} keys/s) | P95: {p95:.4f}s")
+    if rate:
+        # Corrected: from the scheduled send time; uncorrected: from the actual send
+        print(f"    Latency (corrected):   {res.hist.summary()}")
+        print(f"    Latency (uncorrected): {res.uncorrected.summary()}")
+        if res.drain >= 0.1:
+            print(f"    {res.late} replies came in the {res.drain:.1f}s after the schedule ended "
+                  "(the server is behind); throughput counts only those before")
+    else:
+        print(f"    Latency: {res.hist.summary()}")
+    print(f"    Client CPU: {client_cores:.2f} cores in {len(cpu)} process(es), busiest at {busiest * 100:.0f}% of a core")
+    if busiest > 0.9:
+        print("    Warning: the load generator is CPU-bound; the throughput above is a client limit"
+              + (" (try --engine procs)" if engine == "threads" else " (try more --procs)"))
 
     return {
         "timestamp": time.strftime("%H:%M:%S"),
         "threads": num_threads,
         "throughput": throughput,
+        "key_throughput": key_throughput,
         "p95": p95,
+        "p99": p99,
+        "p99_uncorrected": res.uncorrected.value_at(99) if rate else None,
         "success": succ,
-        "fail": fail
+        "fail": fail,
+        "engine": engine,
+        "rate": rate,
+        "client_cores": client_cores,
+        "hist": res.hist,
+        "series": rows
     }
 
+def rate_label(rate):
+    r0, r1 = rate
+    return f"{r0:g}" if r0 == r1 else f"{r0:g}-{r1:g}"
+
+def parse_rates(spec):
+    """--rate: '5000' (fixed), '1000,2000,4000' (one step each) or
+    '1000-8000' (ramped over one step)."""
+    rates = []
+    for part in spec.split(","):
+        lo, _, hi = part.partition("-")
+        r0 = float(lo)
+        r1 = float(hi) if hi else r0
+        if r0 <= 0 or r1 <= 0:
+            parser.error("--rate values must be positive")
+        rates.append((r0, r1))
+    return rates
+
+def slo_met(result):
+    total = result["success"] + result["fail"]
+    errors = result["fail"] / total if total else 1.0
+    return result["p99"] * 1000 <= args.slo_p99 and errors <= args.slo_max_errors
+
+def slo_search(start_rate, record):
+    """Highest fixed rate whose corrected p99 meets --slo-p99: doubles the rate
+    until a step fails, then bisects until the bounds are within 5%."""
+    good, bad = None, None
+    rate = start_rate
+    for _ in range(args.slo_probes):
+        result = record(run_single_test(args.connections, (rate, rate)))
+        ok = slo_met(result)
+        print(f"    p99 {result['p99'] * 1000:.2f} ms at {rate:g} req/s: "
+              + ("meets" if ok else "misses") + f" the {args.slo_p99:g} ms SLO\n")
+        if ok:
+            good = rate
+        else:
+            bad = rate
+        if good is not None and bad is not None and bad - good <= 0.05 * good:
+            break
+        if bad is None:
+            rate = good * 2
+        elif good is None:
+            rate = bad / 2
+        else:
+            rate = round((good + bad) / 2)
+            if rate in (good, bad):  # no whole rate left between the bounds
+                break
+        time.sleep(5)  # cooldown between probes
+    return good
+
+def key_label():
+    """The key distribution, as the banner and CSV show it."""
+    if args.trace:
+        return f"trace:{args.trace}"
+    label = args.key_dist
+    if args.key_dist == "zipf":
+        label += f"(s={args.zipf_s:g})"
+    elif args.key_dist == "hotspot":
+        label += f"({args.hot_share:g}/{args.hot_size:g})"
+    if args.hot_shift and args.key_dist in ("zipf", "hotspot"):
+        label += f" shift={args.hot_shift:g}s"
+    if args.scan_prob and args.key_dist != "sequential":
+        label += f" scans={args.scan_prob:g}x{args.scan_len}"
+    return label
+
 def main():
     # Parse thread steps (e.g., "10,50,100")
     steps = [int(x) for x in args.thread_steps.split(",")]
+    rates = parse_rates(args.rate) if args.rate else None
     
     print(f"=== Starting Benchmark Suite ===")
     print(f"Host: {args.host}:{args.port}")
     print(f"Workload: {args.workload}")
-    print(f"Steps (VUs): {steps}\n")
+    print(f"Keys: {key_label()}")
+    if args.slo_p99 is not None:
+        print(f"Mode: open loop, searching for the highest rate with p99 <= {args.slo_p99:g} ms "
+              f"({args.connections} connections, {args.procs} processes)\n")
+    elif rates:
+        print(f"Mode: open loop over {args.connections} connections ({args.procs} processes)")
+        print(f"Steps (req/s): {[rate_label(r) for r in rates]}\n")
+    else:
+        print(f"Engine: {args.engine}" + (f" ({args.procs} processes)" if args.engine == "procs" else ""))
+        print(f"Steps (VUs): {steps}\n")
 
-    # Initialize CSV
-    file_exists = os.path.isfile(args.csv)
-    with open(args.csv, mode='a', newline='') as f:
-        writer = csv.writer(f)
-        if not file_exists:
-            writer.writerow(["Timestamp", "Workload", "Threads", "Throughput", "P95_Latency", "Success_Count", "Fail_Count"])
+    # Initialize CSV. Files started with fewer columns (before Engine,
+    # Client_CPU_Cores, Target_Rate, ...) keep their layout.
+    header = ["Timestamp", "Workload", "Threads", "Throughput", "P95_Latency", "Success_Count", "Fail_Count", "Keys_Per_Sec",
+              "Engine", "Client_CPU_Cores", "Target_Rate", "P99_Latency", "P99_Uncorrected", "Keys"]
+    if os.path.isfile(args.csv):
+        with open(args.csv, newline='') as f:
+            columns = len(next(csv.reader(f), header))
+    else:
+        columns = len(header)
+        with open(args.csv, mode='a', newline='') as f:
+            csv.writer(f).writerow(header)
 
-    # Run Loop
-    for n_threads in steps:
-        result = run_single_test(n_threads)
-        
+    def record(result):
         # Save to CSV immediately
         with open(args.csv, mode='a', newline='') as f:
             writer = csv.writer(f)
             writer.writerow([
                 result["timestamp"], args.workload, result["threads"], 
                 f"{result['throughput']:.2f}", f"{result['p95']:.6f}", 
-                result["success"], result["fail"]
-            ])
-        
+                result["success"], result["fail"], f"{result['key_throughput']:.2f}",
+                result["engine"], f"{result['client_cores']:.2f}",
+                rate_label(result["rate"]) if result["rate"] else "", f"{result['p99']:.6f}",
+                f"{result['p99_uncorrected']:.6f}" if result["rate"] else "",
+                key_label()
+            ][:columns])
+
+        if result["series"]:
+            timeseries.write_csv(args.timeseries, result["series"], {
+                "Workload": args.workload, "Threads": result["threads"], "Engine": result["engine"],
+                "Target_Rate": rate_label(result["rate"]) if result["rate"] else "", "Keys": key_label()})
+
+        if args.hist_dir:
+            os.makedirs(args.hist_dir, exist_ok=True)
+            name = (f"{args.workload}-open-{rate_label(result['rate'])}" if result["rate"]
+                    else f"{args.workload}-{result['engine']}-{result['threads']}")
+            path = os.path.join(args.hist_dir, f"{name}.json")
+            result["hist"].save(path)
+            print(f"    Histogram saved to {path}")
+        return result
+
+    if args.slo_p99 is not None:
+        best = slo_search(rates[0][0] if rates else 1000.0, record)
+        if best is None:
+            print(f"=== No rate tried met p99 <= {args.slo_p99:g} ms ===")
+        else:
+            print(f"=== Highest rate meeting p99 <= {args.slo_p99:g} ms: {best:g} req/s ===")
+        print(f"=== Results saved to {args.csv} ===")
+        return
+
+    # Run Loop
+    runs = [(args.connections, r) for r in rates] if rates else [(n, None) for n in steps]
+    for n_threads, rate in runs:
+        record(run_single_test(n_threads, rate))
+
         # Cooldown to let server recover/drain
         print("    Cooling down (5s)...\n")
         time.sleep(5)
@@ -205,4 +467,4 @@ if __name__ == "__main__":
     try:
         main()
     except KeyboardInterrupt:
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
@@ -0,0 +1,325 @@
+"""
+Multi-process asyncio load engine.
+
+The virtual users are split across N worker processes. Each process runs
+one asyncio event loop, and each of its VUs keeps one keep-alive HTTP/1.1
+connection. The parent forks the workers and waits until every connection
+is open. It then gives all of them the same start time and merges their
+results. Nothing is shared between processes while the test runs, so there
+is no lock on the request path.
+
+Closed loop (rate=None): each VU sends its next request when the previous
+one returns, so a stalled server also slows the generator down.
+
+Open loop (rate=(r0, r1)): send times are fixed in advance, for a rate
+going linearly from r0 to r1 req/s over the run (r0 == r1 for a constant
+rate). Each process takes every procs-th send time, and its connections
+take the due requests from a queue. A request waiting for a free connection
+is still due at its scheduled time, and latency is measured from then.
+This corrects for coordinated omission. Results.uncorrected keeps the
+latency from the actual send, for comparison.
+
+The HTTP client is a minimal one on asyncio streams. It sends a request and
+reads a Content-Length framed response, which covers every endpoint the
+workloads use. aiohttp costs several times more CPU per request. uvloop is
+used when it is installed.
+"""
+
+import asyncio
+import math
+import multiprocessing
+import os
+import time
+from collections import namedtuple
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from load_gen.hdr import Histogram
+from load_gen.timeseries import Series
+
+# One request as a workload describes it. target is the path with its query
+# string; body is a str or None; the request succeeds if the response
+# status is in ok; keys is how many keys it covers.
+Request = namedtuple("Request", "method target body content_type keys ok")
+
+
+class Connection:
+    """One keep-alive connection; reconnects on the next request after an error."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def open(self):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def request(self, req):
+        """Sends req and reads the whole response; returns the status code."""
+        await self.open()
+        head = f"{req.method} {req.target} HTTP/1.1\r\nHost: {self.host}\r\n"
+        body = b""
+        if req.body is not None:
+            body = req.body.encode()
+            if req.content_type:
+                head += f"Content-Type: {req.content_type}\r\n"
+            head += f"Content-Length: {len(body)}\r\n"
+        self.writer.write(head.encode() + b"\r\n" + body)
+
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("connection closed by server")
+        status = int(line.split()[1])
+        length = 0
+        close = False
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                length = int(value)
+            elif name == b"connection":
+                close = value.strip().lower() == b"close"
+        if length:
+            await self.reader.readexactly(length)
+        if close:
+            self.close()
+        return status
+
+
+class Results:
+    """
+    What one worker (process or thread) measured. series=True keeps a
+    per-second Series of its own; a Series object is shared with other
+    Results (the threads of one process), and merge() counts it once.
+    """
+
+    def __init__(self, digits=3, series=False):
+        self.success = 0
+        self.fail = 0
+        self.keys = 0
+        self.hist = Histogram(digits)  # seconds, successful requests only
+        self.uncorrected = Histogram(digits)  # open loop: from the actual send
+        self.cpu = 0.0  # CPU seconds the process used while running
+        self.drain = 0.0  # open loop: seconds past the schedule's end
+        self.late = self.late_keys = 0  # open loop: successes in the drain
+        self.series = Series() if series is True else series or None
+
+    def merge(self, other):
+        self.success += other.success
+        self.fail += other.fail
+        self.keys += other.keys
+        self.hist.merge(other.hist)
+        self.uncorrected.merge(other.uncorrected)
+        self.cpu += other.cpu
+        self.drain = max(self.drain, other.drain)
+        self.late += other.late
+        self.late_keys += other.late_keys
+        if other.series is not None and other.series is not self.series:
+            if self.series is None:
+                self.series = Series()
+            self.series.merge(other.series)
+        return self
+
+    def ok(self, now, latency, keys):
+        self.success += 1
+        self.keys += keys
+        self.hist.record(latency)
+        if self.series is not None:
+            self.series.record(now, latency)
+
+    def failed(self, now):
+        self.fail += 1
+        if self.series is not None:
+            self.series.fail(now)
+
+
+async def _send(conn, req, timeout):
+    """Sends req; True if the status is one req accepts."""
+    try:
+        return await asyncio.wait_for(conn.request(req), timeout) in req.ok
+    except (OSError, asyncio.TimeoutError, ValueError, IndexError,
+            asyncio.IncompleteReadError):
+        conn.close()
+        return False
+
+
+async def _vu(conn, user, stop_at, timeout, results):
+    while time.monotonic() < stop_at:
+        req = user.next()
+        t0 = time.monotonic()
+        if await _send(conn, req, timeout):
+            now = time.monotonic()
+            results.ok(now, now - t0, req.keys)
+        else:
+            results.failed(time.monotonic())
+
+
+def arrival(n, duration, r0, r1):
+    """Seconds from the start at which request n (from 0) is due."""
+    if r0 == r1:
+        return n / r0
+    # Solve r0 t + (r1 - r0) t^2 / (2 duration) = n for t
+    a = (r1 - r0) / (2.0 * duration)
+    return (math.sqrt(r0 * r0 + 4.0 * a * n) - r0) / (2.0 * a)
+
+
+async def _open_sender(conn, user, queue, end, give_up, timeout, results):
+    while True:
+        due = await queue.get()
+        if due is None:
+            return
+        if time.monotonic() > give_up:
+            results.failed(time.monotonic())  # never sent: the run is over
+            continue
+        req = user.next()
+        t0 = time.monotonic()
+        if await _send(conn, req, timeout):
+            now = time.monotonic()
+            results.ok(now, now - due, req.keys)
+            results.uncorrected.record(now - t0)
+            if now > end:
+                results.late += 1
+                results.late_keys += req.keys
+        else:
+            results.failed(time.monotonic())
+
+
+async def _open_loop(conns, users, start, duration, rate, index, procs,
+                     timeout, results):
+    r0, r1 = rate
+    queue = asyncio.Queue()
+    # Requests still queued when the run ends are sent until give_up; the
+    # rest count as failures.
+    give_up = start + duration + timeout
+    senders = [asyncio.create_task(
+        _open_sender(c, u, queue, start + duration, give_up, timeout,
+                     results))
+        for c, u in zip(conns, users)]
+
+    n = index
+    due = arrival(n, duration, r0, r1)
+    while due < duration:
+        now = time.monotonic() - start
+        while due <= now and due < duration:
+            queue.put_nowait(start + due)
+            n += procs
+            due = arrival(n, duration, r0, r1)
+        await asyncio.sleep(max(due - (time.monotonic() - start), 0))
+    for _ in senders:
+        queue.put_nowait(None)
+    await asyncio.gather(*senders)
+
+
+async def _worker_main(pipe, host, port, tids, make_user, timeout, digits,
+                       duration, rate, series, index, procs):
+    conns = [Connection(host, port) for _ in tids]
+    # Connect before the clock starts; a VU whose connect failed retries
+    # on its first request.
+    await asyncio.gather(*(c.open() for c in conns), return_exceptions=True)
+    users = [make_user(tid) for tid in tids]
+    loop = asyncio.get_running_loop()
+    pipe.send("ready")
+    start = await loop.run_in_executor(None, pipe.recv)
+
+    results = Results(digits, series)
+    cpu0 = time.process_time()
+    if rate is None:
+        await asyncio.gather(*(_vu(c, u, start + duration, timeout, results)
+                               for c, u in zip(conns, users)))
+    else:
+        await _open_loop(conns, users, start, duration, rate, index, procs,
+                         timeout, results)
+    results.cpu = time.process_time() - cpu0
+    for c in conns:
+        c.close()
+    return results
+
+
+def _worker(pipe, *args):
+    if uvloop is not None:
+        uvloop.install()
+    pipe.send(asyncio.run(_worker_main(pipe, *args)))
+    pipe.close()
+
+
+def run(host, port, vus, duration, procs, make_user, timeout=5.0, digits=3,
+        rate=None, series=False):
+    """
+    Runs vus virtual users for duration seconds across procs processes.
+    make_user(tid) is called in the worker process with tid = 1..vus and
+    returns an object whose next() gives the VU's next Request. Latencies
+    go into Histograms with the given significant digits.
+
+    With rate=(r0, r1) the run is open loop and vus is the number of
+    connections the requests are sent over. series=True also collects the
+    per-second Series (load_gen/timeseries.py).
+
+    Returns (merged Results, elapsed seconds, per-process CPU seconds).
+    Open loop, elapsed is the scheduled duration, so throughput does not
+    drop by the time spent waiting for late replies; that time is in the
+    Results' drain, and the replies that came in it are counted in late
+    (and late_keys).
+    """
+    procs = max(1, min(procs, vus))
+    # fork: the workers inherit make_user and the caller's parsed arguments
+    ctx = multiprocessing.get_context("fork")
+    pipes, workers = [], []
+    first = 1
+    for i in range(procs):
+        n = vus // procs + (1 if i < vus % procs else 0)
+        ours, theirs = ctx.Pipe()
+        p = ctx.Process(target=_worker, daemon=True,
+                        args=(theirs, host, port, range(first, first + n),
+                              make_user, timeout, digits, duration, rate,
+                              series, i, procs))
+        p.start()
+        theirs.close()
+        pipes.append(ours)
+        workers.append(p)
+        first += n
+
+    try:
+        for pipe in pipes:
+            pipe.recv()  # "ready"
+        start = time.monotonic()
+        for pipe in pipes:
+            pipe.send(start)
+        parts = [pipe.recv() for pipe in pipes]
+        elapsed = time.monotonic() - start
+    except EOFError:
+        raise RuntimeError("a load worker process exited early") from None
+    finally:
+        for p in workers:
+            p.join(timeout=2.0)
+            if p.is_alive():
+                p.kill()
+
+    merged = Results(digits)
+    for r in parts:
+        merged.merge(r)
+    if rate is not None:
+        merged.drain = max(0.0, elapsed - duration)
+        elapsed = duration
+    return merged, elapsed, [r.cpu for r in parts]
+
+
+def default_procs():
+    """The CPUs this process may run on (respects taskset)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
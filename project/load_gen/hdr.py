@@ -0,0 +1,209 @@
+"""
+Log-bucketed latency histograms (the HdrHistogram layout) on NumPy arrays.
+
+Values are whole multiples of `unit` seconds (1 us by default). Each power
+of two is split into 2^(sub_bits - 1) equal buckets, with sub_bits chosen
+so that every value is known to within 10^-digits of itself: digits=3
+reports p99.99 = 12.34 ms as somewhere in [12.33, 12.35] ms. Memory is
+bounded by the range actually recorded (about 90 KB for latencies up to
+100 ms at 3 digits, 8 KB more for buffered samples), however many samples
+there are.
+
+A Histogram is not thread-safe: give every worker (thread, VU task or
+process) its own, and merge() them when the workers are done. to_dict()
+and from_dict() give a JSON form, so runs saved to disk can be combined
+later:
+
+  python3 -m load_gen.hdr run1.json run2.json     # merged percentiles
+"""
+
+import json
+import math
+import sys
+from array import array
+
+import numpy as np
+
+PERCENTILES = (50, 90, 95, 99, 99.9, 99.99)
+
+
+class Histogram:
+    # Samples are buffered and bucketed this many at a time with NumPy
+    # (a Python-level bucket update per sample costs ~10x more).
+    BATCH = 1024
+
+    def __init__(self, digits=3, unit=1e-6, highest=3600.0):
+        if not 1 <= digits <= 5:
+            raise ValueError("digits must be between 1 and 5")
+        self.digits = digits
+        self.unit = unit
+        self.highest = highest
+        self._max_value = int(highest / unit)  # larger values clamp
+        self._sub_bits = math.ceil(math.log2(2 * 10 ** digits))
+        self._half = self._sub_bits - 1
+        self._counts = np.zeros(2 << self._half, dtype=np.int64)
+        self._pending = array("d")
+        self._count = 0
+        self._sum = 0.0
+        self._min = math.inf
+        self._max = -math.inf
+
+    # ---- recording ----
+
+    def record(self, seconds):
+        self._pending.append(seconds)
+        if len(self._pending) >= self.BATCH:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        x = np.frombuffer(self._pending, dtype=np.float64)
+        v = np.clip((x / self.unit).astype(np.int64), 0, self._max_value)
+        # bucket b holds [2^(b + sub_bits - 1), 2^(b + sub_bits)) in steps
+        # of 2^b; frexp's exponent is the bit length
+        b = np.maximum(np.frexp(v)[1] - self._sub_bits, 0)
+        index = (b << self._half) + (v >> b)
+        top = int(index.max()) + 1
+        if top > len(self._counts):
+            self._grow(top)
+        self._counts[:top] += np.bincount(index, minlength=top)
+        self._count += len(x)
+        self._sum += float(x.sum())
+        self._min = min(self._min, float(x.min()))
+        self._max = max(self._max, float(x.max()))
+        self._pending = array("d")
+
+    def _grow(self, size):
+        size = max(size, len(self._counts) + (1 << self._half))
+        counts = np.zeros(size, dtype=np.int64)
+        counts[:len(self._counts)] = self._counts
+        self._counts = counts
+
+    def _lowest(self, index):
+        # Smallest value (in units) stored at index, and the bucket width
+        b = max((index >> self._half) - 1, 0)
+        return (index - (b << self._half)) << b, 1 << b
+
+    def __getstate__(self):
+        self._flush()
+        return self.__dict__
+
+    # ---- combining ----
+
+    def merge(self, other):
+        """Adds other's samples to this histogram; returns self."""
+        if (other.digits, other.unit) != (self.digits, self.unit):
+            raise ValueError("histograms with different digits/unit")
+        self._flush()
+        other._flush()
+        if len(other._counts) > len(self._counts):
+            self._grow(len(other._counts))
+        self._counts[:len(other._counts)] += other._counts
+        self._count += other._count
+        self._sum += other._sum
+        self._min = min(self._min, other._min)
+        self._max = max(self._max, other._max)
+        return self
+
+    @classmethod
+    def merged(cls, histograms, **kwargs):
+        h = cls(**kwargs)
+        for other in histograms:
+            h.merge(other)
+        return h
+
+    # ---- queries (seconds) ----
+
+    @property
+    def count(self):
+        self._flush()
+        return self._count
+
+    @property
+    def min(self):
+        return self._min if self.count else 0.0
+
+    @property
+    def max(self):
+        return self._max if self.count else 0.0
+
+    def mean(self):
+        return self._sum / self.count if self.count else 0.0
+
+    def value_at(self, percentile):
+        return self.values_at([percentile])[0]
+
+    def values_at(self, percentiles):
+        """The highest value each percentile could be; 0.0 when empty."""
+        if not self.count:
+            return [0.0 for _ in percentiles]
+        cum = np.cumsum(self._counts)
+        out = []
+        for p in percentiles:
+            rank = max(1, math.ceil(p / 100.0 * self._count))
+            lo, width = self._lowest(int(np.searchsorted(cum, rank)))
+            # The top of the bucket can exceed anything recorded
+            value = (lo + width - 1) * self.unit
+            out.append(min(max(value, self._min), self._max))
+        return out
+
+    def percentiles(self, percentiles=PERCENTILES):
+        return dict(zip(percentiles, self.values_at(percentiles)))
+
+    def summary(self, scale=1000.0, suffix="ms"):
+        """One line: count, mean and the standard percentiles."""
+        parts = [f"n={self.count}", f"mean={self.mean() * scale:.3f}{suffix}"]
+        for p, v in self.percentiles().items():
+            parts.append(f"p{p:g}={v * scale:.3f}{suffix}")
+        return " ".join(parts)
+
+    # ---- serialization ----
+
+    def to_dict(self):
+        count = self.count
+        nz = np.nonzero(self._counts)[0]
+        return {
+            "digits": self.digits,
+            "unit": self.unit,
+            "highest": self.highest,
+            "count": count,
+            "sum": self._sum,
+            "min": self.min,
+            "max": self.max,
+            # sparse: [index, count] for the non-empty buckets
+            "buckets": [[int(i), int(self._counts[i])] for i in nz],
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        h = cls(d["digits"], d["unit"], d["highest"])
+        if d["buckets"]:
+            h._grow(d["buckets"][-1][0] + 1)
+            for i, c in d["buckets"]:
+                h._counts[i] = c
+        h._count = d["count"]
+        h._sum = d["sum"]
+        if h._count:
+            h._min = d["min"]
+            h._max = d["max"]
+        return h
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python3 -m load_gen.hdr <histogram.json> [...]")
+        sys.exit(1)
+    parts = [Histogram.load(p) for p in sys.argv[1:]]
+    total = Histogram.merged(parts, digits=parts[0].digits, unit=parts[0].unit,
+                             highest=parts[0].highest)
+    print(total.summary())
@@ -0,0 +1,265 @@
+"""
+Key distributions for the load generators, drawn with NumPy in blocks.
+
+KeyGen draws keys id_start .. id_start + key_space - 1 from one of:
+
+  uniform  every key equally likely
+  zipf     the key of popularity rank r has weight 1 / r^s (s = zipf_s;
+           s near 1 is typical of caches, larger is more skewed)
+  hotspot  hot_share of the draws go to a hot set of hot_size * key_space
+           keys, the rest to the other keys (0.8 / 0.2 is the 80-20 rule)
+
+Which keys are popular is a permutation of the key space seeded with
+map_seed, so every VU and process agrees on the hot keys while drawing its
+own sequence. The permutation and the zipf CDF are built once per process
+by tables() and shared, read-only, by every KeyGen in it; build them
+before forking or starting threads and the workers share them too. With
+shift_secs the popular keys move: every shift_secs of wall-clock time the
+whole mapping rotates by a fixed stride, so caches see their hot set go
+cold at once. With scan_prob, each draw starts a scan with that
+probability: the next scan_len draws are consecutive keys.
+
+Draws are made block keys at a time (one NumPy call per block), so next()
+is a list index (and, with shift_secs, a clock read and a modulo).
+
+Traces
+------
+A trace is the sequence of keys (and operations) some traffic touched, as
+the server writes it with KV_TRACE (see AccessTrace.h): the 8 bytes
+"KVTRACE1", then one record per key, a little-endian uint32 id and an op
+byte (READ, WRITE or DELETE). TraceReplay plays one back;
+write_trace() writes synthetic ones.
+
+  python3 -m load_gen.keygen info trace.bin [...]         # what is in it
+  python3 -m load_gen.keygen gen out.bin 1000000 zipf 10000 [s]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+MAGIC = b"KVTRACE1"
+RECORD = np.dtype([("key", "<u4"), ("op", "u1")])
+READ, WRITE, DELETE = 0, 1, 2
+OP_NAMES = ("read", "write", "delete")
+
+DISTRIBUTIONS = ("uniform", "zipf", "hotspot")
+
+_tables = {}  # (key_space, map_seed, zipf_s or None) -> (map, cdf or None)
+
+
+def tables(key_space, map_seed=0, zipf_s=None):
+    """
+    The rank -> key offset permutation for map_seed and, given zipf_s, the
+    zipf CDF over ranks: built on first use, then the same arrays for every
+    caller in the process (read-only, so forked workers keep sharing them).
+    """
+    key = (key_space, map_seed, zipf_s)
+    t = _tables.get(key)
+    if t is None:
+        perm = np.random.default_rng(map_seed).permutation(key_space)
+        perm.flags.writeable = False
+        cdf = None
+        if zipf_s is not None:
+            weights = np.arange(1, key_space + 1, dtype=np.float64) ** -zipf_s
+            cdf = np.cumsum(weights)
+            cdf /= cdf[-1]
+            cdf.flags.writeable = False
+        t = _tables[key] = (perm, cdf)
+    return t
+
+
+class KeyGen:
+    def __init__(self, key_space, dist="uniform", id_start=1, zipf_s=1.0,
+                 hot_share=0.8, hot_size=0.2, shift_secs=0.0, scan_prob=0.0,
+                 scan_len=100, seed=None, map_seed=0, block=1024):
+        if dist not in DISTRIBUTIONS:
+            raise ValueError(f"unknown key distribution: {dist}")
+        if key_space < 1:
+            raise ValueError("key_space must be at least 1")
+        self.key_space = key_space
+        self.dist = dist
+        self.id_start = id_start
+        self.hot_share = hot_share
+        self.hot_keys = min(max(1, int(hot_size * key_space)), key_space)
+        self.shift_secs = shift_secs
+        self.scan_prob = scan_prob
+        self.scan_len = max(1, scan_len)
+        self.block = block
+        self.rng = np.random.default_rng(seed)
+
+        # Rank -> key offset, the same in every generator with this map_seed
+        self._map, self._cdf = tables(key_space, map_seed,
+                                      zipf_s if dist == "zipf" else None)
+        # Consecutive epochs are this far apart, so a shift moves every hot
+        # key well away from where it was
+        self._stride = max(1, int(key_space * 0.381966))  # 1 - 1/phi
+        self._keys = np.empty(0, dtype=np.int64)
+        self._list = []
+        self._pos = 0
+
+    def _ranks(self, n):
+        rng = self.rng
+        if self.dist == "uniform":
+            return rng.integers(0, self.key_space, n)
+        if self.dist == "zipf":
+            return np.searchsorted(self._cdf, rng.random(n), side="right")
+        hot = rng.random(n) < self.hot_share
+        cold = self.key_space - self.hot_keys
+        ranks = rng.integers(0, self.hot_keys, n)
+        if cold > 0:
+            ranks[~hot] = self.hot_keys + rng.integers(0, cold, (~hot).sum())
+        return ranks
+
+    def _fill(self):
+        n = self.block
+        offsets = self._map[np.minimum(self._ranks(n), self.key_space - 1)]
+        if self.scan_prob > 0:
+            steps = np.arange(self.scan_len)
+            for s in np.nonzero(self.rng.random(n) < self.scan_prob)[0]:
+                run = offsets[s:s + self.scan_len]
+                run[:] = (offsets[s] + steps[:len(run)]) % self.key_space
+        self._keys = offsets
+        self._list = offsets.tolist()  # next() is faster on Python ints
+        self._pos = 0
+
+    def _offset(self):
+        if self.shift_secs <= 0:
+            return 0
+        epoch = int(time.time() / self.shift_secs)
+        return epoch * self._stride
+
+    def next(self):
+        """The next key."""
+        if self._pos >= len(self._list):
+            self._fill()
+        key = self._list[self._pos]
+        self._pos += 1
+        if self.shift_secs > 0:
+            key = (key + self._offset()) % self.key_space
+        return self.id_start + key
+
+    def take(self, n):
+        """The next n keys, as a list."""
+        return [self.next() for _ in range(n)]
+
+    def draw(self, n):
+        """n fresh keys as a NumPy array, in one go (ignores shift_secs)."""
+        out = []
+        while n > 0:
+            self._fill()
+            out.append(self._keys[:n])
+            n -= len(out[-1])
+        self._pos = len(self._list)  # the rest of the block was not used
+        return self.id_start + np.concatenate(out or [self._keys[:0]])
+
+
+def read_trace(paths):
+    """The records of one or more trace files, in order (memory-mapped)."""
+    if isinstance(paths, str):
+        paths = [paths]
+    parts = []
+    for path in paths:
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path}: not a key trace")
+        # A file cut short by a crash may end in a partial record
+        n = (os.path.getsize(path) - len(MAGIC)) // RECORD.itemsize
+        if n:
+            parts.append(np.memmap(path, dtype=RECORD, mode="r",
+                                   offset=len(MAGIC), shape=(n,)))
+    if not parts:
+        return np.empty(0, dtype=RECORD)
+    return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+def write_trace(path, keys, ops=READ):
+    """Writes keys (and ops: one for all, or one per key) as a trace."""
+    records = np.empty(len(keys), dtype=RECORD)
+    records["key"] = keys
+    records["op"] = ops
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        records.tofile(f)
+
+
+class TraceReplay:
+    """
+    Plays back a trace: next() gives (key, op). With several VUs replaying
+    one trace, VU i of n takes records i, i + n, i + 2n, ..., so together
+    they send it in order; each starts over when it runs out.
+    """
+
+    def __init__(self, records, index=0, step=1):
+        if len(records) == 0:
+            raise ValueError("empty trace")
+        self.records = records
+        self.step = step
+        self._start = index % len(records)
+        self._pos = self._start
+        self._keys = self._ops = None
+        self._base = 0
+
+    def _fill(self):
+        # Copy a block out of the memory map at a time
+        end = min(self._pos + 65536 * self.step, len(self.records))
+        chunk = np.asarray(self.records[self._pos:end:self.step])
+        self._keys = chunk["key"].tolist()
+        self._ops = chunk["op"].tolist()
+        self._base = self._pos
+
+    def next(self):
+        i = (self._pos - self._base) // self.step
+        if self._keys is None or i >= len(self._keys):
+            if self._pos >= len(self.records):
+                self._pos = self._start
+            self._fill()
+            i = 0
+        self._pos += self.step
+        return self._keys[i], self._ops[i]
+
+
+def describe(records, top=10):
+    """Lines summarizing a trace: size, op mix and how skewed the keys are."""
+    n = len(records)
+    keys, counts = np.unique(np.asarray(records["key"]), return_counts=True)
+    order = np.argsort(counts)[::-1]
+    lines = [f"records: {n}", f"distinct keys: {len(keys)}"]
+    if n == 0:
+        return lines
+    lines.append(f"key range: {keys[0]} - {keys[-1]}")
+    ops = np.bincount(np.asarray(records["op"]), minlength=len(OP_NAMES))
+    lines.append("ops: " + ", ".join(
+        f"{name} {c / n:.1%}" for name, c in zip(OP_NAMES, ops) if c))
+    cum = np.cumsum(counts[order])
+    for share in (0.01, 0.1):
+        k = max(1, int(share * len(keys)))
+        lines.append(f"top {share:.0%} of keys ({k}): {cum[k - 1] / n:.1%} "
+                     "of accesses")
+    lines.append("hottest: " + ", ".join(
+        f"{keys[i]} ({counts[i]})" for i in order[:top]))
+    return lines
+
+
+def main(argv):
+    if len(argv) >= 2 and argv[0] == "info":
+        for line in describe(read_trace(argv[1:])):
+            print(line)
+        return 0
+    if len(argv) >= 5 and argv[0] == "gen":
+        path, n, dist, key_space = argv[1], int(argv[2]), argv[3], int(argv[4])
+        s = float(argv[5]) if len(argv) > 5 else 1.0
+        gen = KeyGen(key_space, dist, zipf_s=s)
+        write_trace(path, gen.draw(n))
+        print(f"Wrote {n} {dist} keys to {path}")
+        return 0
+    print("Usage: python3 -m load_gen.keygen info <trace> [...]\n"
+          "       python3 -m load_gen.keygen gen <out> <count> "
+          "<uniform|zipf|hotspot> <key_space> [zipf_s]")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -6,164 +6,208 @@ import argparse
 import csv
 from collections import Counter
 
+from hdr import Histogram
+from keygen import DISTRIBUTIONS, KeyGen
+
 
 class Stats:
-    def __init__(self):
-        self.latencies = []
+    # All workers run on one event loop, so they can share one histogram.
+    def __init__(self, digits=3):
+        self.latencies = Histogram(digits)
+        self.uncorrected = Histogram(digits)  # open loop: from the actual send
         self.total_requests = 0
         self.successes = 0
         self.failures = 0
+        self.keys = 0
 
-    def record(self, latency, success):
+    def record(self, latency, success, keys=1):
         self.total_requests += 1
         if success:
             self.successes += 1
-            self.latencies.append(latency)
+            self.keys += keys
+            self.latencies.record(latency)
         else:
             self.failures += 1
 
 
-def choose_key_uniform(keyspace_size):
-    # Keys from 1..keyspace_size
-    return random.randint(1, keyspace_size)
-
-
-def build_popular_key_distribution(keyspace_size):
+def make_keygen(args):
     """
-    80-20 rule: 20% "hot" keys get 80% of traffic.
-    We prebuild a list we can sample uniformly from.
+    Where keys come from: --key-dist over 1..keyspace_size. get_popular is
+    the 80-20 rule: 20% "hot" keys get 80% of traffic.
     """
-    hot_keys = int(0.2 * keyspace_size) or 1
-    cold_keys = keyspace_size - hot_keys
-
-    population = []
-    # 80% of entries are hot keys
-    hot_weight = 0.8
-    cold_weight = 0.2
+    dist = "hotspot" if args.workload == "get_popular" else args.key_dist
+    return KeyGen(args.keyspace_size, dist, zipf_s=args.zipf_s,
+                  hot_share=0.8, hot_size=0.2, shift_secs=args.hot_shift)
 
-    hot_count = int(1000 * hot_weight)
-    cold_count = int(1000 * cold_weight)
 
-    for _ in range(hot_count):
-        population.append(random.randint(1, hot_keys))
+def choose_batch(keygen, keyspace_size, batch_size):
+    # A run of consecutive keys, wrapping around the keyspace
+    start = keygen.next()
+    return [(start + i - 1) % keyspace_size + 1 for i in range(batch_size)]
 
-    for _ in range(cold_count):
-        population.append(random.randint(hot_keys + 1, keyspace_size))
 
-    return population
-
-
-def choose_key_popular(population):
-    return random.choice(population)
+def build_request(base_url, workload, keyspace_size, mixed_get_ratio,
+                  keygen, batch_size):
+    """
+    The next request of a workload: (method, url, params, data, keys).
+    """
+    keys = 1
+    if workload == "get_all":
+        key = keygen.next()
+        return "GET", f"{base_url}/get", {"id": key}, None, keys
+
+    elif workload == "put_all":
+        key = keygen.next()
+        value = f"val-{random.randint(1, 1_000_000)}"
+        return "POST", f"{base_url}/set", {"id": key}, value, keys
+
+    elif workload == "get_popular":
+        key = keygen.next()
+        return "GET", f"{base_url}/get", {"id": key}, None, keys
+
+    elif workload == "mixed":
+        # Decide GET or PUT based on ratio
+        key = keygen.next()
+        if random.random() < mixed_get_ratio:  # GET
+            return "GET", f"{base_url}/get", {"id": key}, None, keys
+        value = f"val-{random.randint(1, 1_000_000)}"  # PUT
+        return "POST", f"{base_url}/set", {"id": key}, value, keys
+
+    elif workload == "mget":
+        # Body: one id per line
+        batch = choose_batch(keygen, keyspace_size, batch_size)
+        data = "".join(f"{k}\n" for k in batch)
+        return "POST", f"{base_url}/mget", None, data, len(batch)
+
+    elif workload == "mset":
+        # Body: one "id<TAB>value" per line
+        batch = choose_batch(keygen, keyspace_size, batch_size)
+        data = "".join(f"{k}\tval-{random.randint(1, 1_000_000)}\n"
+                       for k in batch)
+        return "POST", f"{base_url}/mset", None, data, len(batch)
+
+    raise ValueError(f"Unknown workload: {workload}")
+
+
+async def send(session, method, url, params, data):
+    if method == "GET":
+        async with session.get(url, params=params) as resp:
+            await resp.text()  # read body to completion
+    else:
+        async with session.post(url, params=params, data=data) as resp:
+            await resp.text()
 
 
 async def worker(session, base_url, workload, keyspace_size,
-                 mixed_get_ratio, popular_population, stats, stop_event):
+                 mixed_get_ratio, keygen, stats, stop_event,
+                 batch_size=1):
     """
     Repeatedly send requests until stop_event is set.
     """
     while not stop_event.is_set():
+        keys = 1
         try:
-            # Choose workload
-            if workload == "get_all":
-                key = choose_key_uniform(keyspace_size)
-                url = f"{base_url}/get"
-                params = {"id": key}
-                method = "GET"
-                data = None
-
-            elif workload == "put_all":
-                key = choose_key_uniform(keyspace_size)
-                url = f"{base_url}/set"
-                params = {"id": key}
-                value = f"val-{random.randint(1, 1_000_000)}"
-                method = "POST"
-                data = value
-
-            elif workload == "get_popular":
-                key = choose_key_popular(popular_population)
-                url = f"{base_url}/get"
-                params = {"id": key}
-                method = "GET"
-                data = None
-
-            elif workload == "mixed":
-                # Decide GET or PUT based on ratio
-                r = random.random()
-                if r < mixed_get_ratio:  # GET
-                    key = choose_key_uniform(keyspace_size)
-                    url = f"{base_url}/get"
-                    params = {"id": key}
-                    method = "GET"
-                    data = None
-                else:  # PUT
-                    key = choose_key_uniform(keyspace_size)
-                    url = f"{base_url}/set"
-                    params = {"id": key}
-                    value = f"val-{random.randint(1, 1_000_000)}"
-                    method = "POST"
-                    data = value
-            else:
-                raise ValueError(f"Unknown workload: {workload}")
-
+            method, url, params, data, keys = build_request(
+                base_url, workload, keyspace_size, mixed_get_ratio,
+                keygen, batch_size)
             start = time.perf_counter()
-            if method == "GET":
-                async with session.get(url, params=params) as resp:
-                    await resp.text()  # read body to completion
-            else:
-                async with session.post(url, params=params, data=data) as resp:
-                    await resp.text()
-
+            await send(session, method, url, params, data)
             end = time.perf_counter()
-            stats.record((end - start), True)
+            stats.record((end - start), True, keys)
 
         except Exception as e:
             # You can optionally log e
             stats.record(0.0, False)
 
 
-async def run_load_test(args):
-    stats = Stats()
+async def open_loop(session, args, keygen, stats, duration):
+    """
+    Sends args.rate requests per second on a fixed schedule, whether or not
+    earlier ones have returned (at most args.concurrency in flight; the rest
+    wait). Latency counts from the scheduled send time, so a stalled server
+    shows up in it instead of slowing the schedule down; stats.uncorrected
+    keeps the latency from the actual send.
+    """
+    slots = asyncio.Semaphore(args.concurrency)
+    tasks = set()
+
+    async def one(due):
+        async with slots:
+            try:
+                method, url, params, data, keys = build_request(
+                    args.base_url, args.workload, args.keyspace_size,
+                    args.get_ratio, keygen, args.batch_size)
+                start = time.perf_counter()
+                await send(session, method, url, params, data)
+                end = time.perf_counter()
+                stats.record(end - due, True, keys)
+                stats.uncorrected.record(end - start)
+            except Exception:
+                stats.record(0.0, False)
+
+    begin = time.perf_counter()
+    n = 0
+    while n / args.rate < duration:
+        due = begin + n / args.rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.create_task(one(due))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        n += 1
+    await asyncio.gather(*tasks)
+
+
+async def closed_loop(session, args, keygen, stats):
     stop_event = asyncio.Event()
+    workers = [
+        asyncio.create_task(
+            worker(
+                session,
+                args.base_url,
+                args.workload,
+                args.keyspace_size,
+                args.get_ratio,
+                keygen,
+                stats,
+                stop_event,
+                args.batch_size,
+            )
+        )
+        for _ in range(args.concurrency)
+    ]
 
-    if args.workload == "get_popular":
-        popular_population = build_popular_key_distribution(args.keyspace_size)
-    else:
-        popular_population = None
+    start_time = time.time()
+    await asyncio.sleep(args.duration)
+    stop_event.set()
+    await asyncio.gather(*workers, return_exceptions=True)
+    end_time = time.time()
+    return start_time, end_time
+
+
+async def run_load_test(args):
+    stats = Stats(args.hdr_digits)
+
+    keygen = make_keygen(args)
 
     timeout = aiohttp.ClientTimeout(total=None, connect=None, sock_read=None)
     connector = aiohttp.TCPConnector(limit=None)
 
     async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
-        workers = [
-            asyncio.create_task(
-                worker(
-                    session,
-                    args.base_url,
-                    args.workload,
-                    args.keyspace_size,
-                    args.get_ratio,
-                    popular_population,
-                    stats,
-                    stop_event,
-                )
-            )
-            for _ in range(args.concurrency)
-        ]
-
-        start_time = time.time()
-        await asyncio.sleep(args.duration)
-        stop_event.set()
-        await asyncio.gather(*workers, return_exceptions=True)
-        end_time = time.time()
+        if args.rate:
+            start_time = time.time()
+            await open_loop(session, args, keygen, stats,
+                            args.duration)
+            end_time = time.time()
+        else:
+            start_time, end_time = await closed_loop(
+                session, args, keygen, stats)
 
     test_duration = end_time - start_time
     throughput = stats.total_requests / test_duration if test_duration > 0 else 0.0
-    avg_latency_ms = (
-        (sum(stats.latencies) / len(stats.latencies)) * 1000
-        if stats.latencies
-        else 0.0
-    )
+    key_throughput = stats.keys / test_duration if test_duration > 0 else 0.0
+    avg_latency_ms = stats.latencies.mean() * 1000
 
     print("=== Load Test Summary ===")
     print(f"Workload       : {args.workload}")
@@ -173,7 +217,20 @@ async def run_load_test(args):
     print(f"Successes      : {stats.successes}")
     print(f"Failures       : {stats.failures}")
     print(f"Throughput     : {throughput:.2f} req/s")
+    print(f"Key throughput : {key_throughput:.2f} keys/s")
     print(f"Avg latency    : {avg_latency_ms:.2f} ms")
+    if args.rate:
+        print(f"Target rate    : {args.rate:g} req/s (open loop)")
+        # Corrected: from the scheduled send time; uncorrected: from the actual send
+        uncorrected = stats.uncorrected.percentiles()
+        for p, v in stats.latencies.percentiles().items():
+            print(f"{'p' + format(p, 'g'):<15}: {v * 1000:.2f} ms"
+                  f" (uncorrected {uncorrected[p] * 1000:.2f} ms)")
+    else:
+        for p, v in stats.latencies.percentiles().items():
+            print(f"{'p' + format(p, 'g'):<15}: {v * 1000:.2f} ms")
+    if args.hist_out:
+        stats.latencies.save(args.hist_out)
 
     # Save summary to CSV
     if args.output:
@@ -192,6 +249,7 @@ async def run_load_test(args):
                         "failures",
                         "throughput_req_per_s",
                         "avg_latency_ms",
+                        "keys_per_s",
                     ]
                 )
             writer.writerow(
@@ -204,6 +262,7 @@ async def run_load_test(args):
                     stats.failures,
                     f"{throughput:.2f}",
                     f"{avg_latency_ms:.2f}",
+                    f"{key_throughput:.2f}",
                 ]
             )
 
@@ -213,17 +272,33 @@ def parse_args():
     parser.add_argument("--base-url", type=str, required=True,
                         help="Base URL, e.g. http://localhost:8080")
     parser.add_argument("--workload", type=str, required=True,
-                        choices=["get_all", "put_all", "get_popular", "mixed"])
+                        choices=["get_all", "put_all", "get_popular", "mixed",
+                                 "mget", "mset"])
     parser.add_argument("--concurrency", type=int, required=True,
-                        help="Number of concurrent workers")
+                        help="Number of concurrent workers (with --rate: most requests in flight)")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Open loop: send this many requests per second on a fixed schedule")
     parser.add_argument("--duration", type=int, default=300,
                         help="Test duration in seconds (default 300s)")
     parser.add_argument("--keyspace-size", type=int, default=1000,
                         help="Number of distinct keys to use (default 1000)")
+    parser.add_argument("--key-dist", type=str, default="uniform",
+                        choices=DISTRIBUTIONS,
+                        help="Key distribution (default uniform; get_popular is always 80-20)")
+    parser.add_argument("--zipf-s", type=float, default=1.0,
+                        help="Skew of --key-dist zipf (default 1.0)")
+    parser.add_argument("--hot-shift", type=float, default=0.0,
+                        help="Move the popular keys every this many seconds")
     parser.add_argument("--get-ratio", type=float, default=0.8,
                         help="Fraction of GETs in mixed workload (default 0.8)")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="Keys per request for mget/mset (default 100)")
     parser.add_argument("--output", type=str, default=None,
                         help="CSV file to append results to")
+    parser.add_argument("--hdr-digits", type=int, default=3,
+                        help="Significant digits kept by the latency histogram (default 3)")
+    parser.add_argument("--hist-out", type=str, default=None,
+                        help="Save the latency histogram to this JSON file")
     return parser.parse_args()
 
 
@@ -3,13 +3,15 @@ set -euo pipefail
 
 # run_all.sh
 # Replace your previous script with this file.
-# Requires: k6, jq, vmstat (procps), iostat (sysstat)
+# Requires: k6, jq, python3 (load_gen/timeseries.py samples /proc)
 # Usage: ./run_all.sh
 # Configure BASE_URL, DURATION, KEYSPACE via environment if desired.
 
 BASE_URL=${BASE_URL:-http://localhost:1234}
 DURATION=${DURATION:-30s}         # k6 duration (string). We pass to script via env.
 KEYSPACE=${KEYSPACE:-20000}
+# load_gen/timeseries.py is imported from the directory above this script
+SAMPLER=(env PYTHONPATH="$(cd "$(dirname "$0")/.." && pwd)" python3 -m load_gen.timeseries sample)
 
 # VU list (as requested)
 VUS_LIST=(1 25 50 100 250 500 800 1000 1300 1500 2000)
@@ -23,7 +25,7 @@ declare -A WORKLOAD_SCRIPTS=(
 )
 
 # Tools check
-for tool in k6 jq vmstat iostat awk; do
+for tool in k6 jq python3 awk; do
   if ! command -v "$tool" >/dev/null 2>&1; then
     echo "Error: required tool '$tool' not found in PATH. Install it and retry." >&2
     exit 1
@@ -38,10 +40,9 @@ for s in "${WORKLOAD_SCRIPTS[@]}"; do
   fi
 done
 
-# Cleanup function to kill monitors if script aborted
+# Cleanup function to kill the sampler if script aborted
 _cleanup() {
-  [[ -n "${CPU_PID:-}" ]] && kill "${CPU_PID}" 2>/dev/null || true
-  [[ -n "${DISK_PID:-}" ]] && kill "${DISK_PID}" 2>/dev/null || true
+  [[ -n "${SAMPLER_PID:-}" ]] && kill "${SAMPLER_PID}" 2>/dev/null || true
 }
 trap _cleanup EXIT
 
@@ -74,12 +75,10 @@ for workload in "${!WORKLOAD_SCRIPTS[@]}"; do
     VCOUNT=$((VCOUNT + 1))
     echo "  -> [$VCOUNT/$VTOTAL] VUs = $VUS"
 
-    # start vmstat and iostat; redirect to files
-    vmstat 1 > cpu.log 2>&1 &
-    CPU_PID=$!
-
-    iostat -dx 1 > disk.log 2>&1 &
-    DISK_PID=$!
+    # start the /proc sampler: one row per second in procs.csv
+    rm -f procs.csv
+    "${SAMPLER[@]}" procs.csv > sampler.log 2>&1 &
+    SAMPLER_PID=$!
 
     # run k6 (we pass environment variables used by your k6 scripts)
     # capture k6 output to k6_run.log; summary exported to summary.json by --summary-export
@@ -87,30 +86,21 @@ for workload in "${!WORKLOAD_SCRIPTS[@]}"; do
     # run k6 but don't abort the entire script if k6 returns non-zero (we still want the monitors processed)
     k6 run --summary-export=summary.json --env VUS="$VUS" --env BASE_URL="$BASE_URL" --env KEYSPACE="$KEYSPACE" --env DURATION="$DURATION" "$script" > k6_run.log 2>&1 || true
 
-    # stop monitors
-    if [[ -n "${CPU_PID:-}" ]]; then
-      kill "$CPU_PID" 2>/dev/null || true
-      wait "$CPU_PID" 2>/dev/null || true
-      unset CPU_PID
-    fi
-    if [[ -n "${DISK_PID:-}" ]]; then
-      kill "$DISK_PID" 2>/dev/null || true
-      wait "$DISK_PID" 2>/dev/null || true
-      unset DISK_PID
+    # stop the sampler; it writes procs.csv as it exits
+    if [[ -n "${SAMPLER_PID:-}" ]]; then
+      kill "$SAMPLER_PID" 2>/dev/null || true
+      wait "$SAMPLER_PID" 2>/dev/null || true
+      unset SAMPLER_PID
     fi
+    touch procs.csv
 
-    # compute MAX CPU util: 100 - min(idle) observed from vmstat logs
-    # vmstat idle column is field 15 (on typical vmstat output)
-    MIN_IDLE=$(awk 'NR>2 { if(min=="" || $15+0 < min+0) min=$15 } END { if(min=="") print 0; else print min }' cpu.log)
-    # convert to number and compute 100 - min_idle, with two decimals
-    if [[ -z "$MIN_IDLE" ]]; then
-      CPU_UTIL_MAX="0.00"
-    else
-      CPU_UTIL_MAX=$(awk -v minidle="$MIN_IDLE" 'BEGIN { printf("%.2f", 100 - (minidle+0)) }')
-    fi
+    # compute MAX CPU util: busy + iowait, as 100 - idle was with vmstat
+    CPU_UTIL_MAX=$(awk -F, 'NR==1 { for (i=1;i<=NF;i++) { if ($i=="CPU_Busy") b=i; if ($i=="CPU_IOWait") w=i }; next }
+      b && $b+$w > max+0 { max=$b+$w } END { printf("%.2f", max+0) }' procs.csv)
 
-    # compute MAX disk %util seen in iostat output (last column is %util)
-    DISK_UTIL_MAX=$(awk '/^Device/ {next} /^[a-z]/ { if($NF+0 > max+0) max=$NF } END { if(max=="") print "0.00"; else printf("%.2f", max) }' disk.log)
+    # compute MAX disk %util seen on any disk (the Disk_<name>_Util columns)
+    DISK_UTIL_MAX=$(awk -F, 'NR==1 { for (i=1;i<=NF;i++) if ($i ~ /^Disk_.*_Util$/) d[i]=1; next }
+      { for (i in d) if ($i+0 > max+0) max=$i } END { printf("%.2f", max+0) }' procs.csv)
 
     # parse summary.json, gracefully fallback if missing or missing fields
     if [[ -f summary.json ]]; then
@@ -0,0 +1,358 @@
+"""
+Per-second time series of a load test: what the load generator saw, and
+what the server and Postgres used, from /proc.
+
+Series collects the generator's side. Each process keeps one and records
+every request under the whole second of time.monotonic() it finished in;
+the threads of one process share a SharedSeries, so memory grows with
+seconds, not with VUs times seconds. The clock is the same in every
+process, so the processes' series merge second by second, histograms and
+all.
+
+ProcSampler reads /proc once a second from a background thread, on the
+same whole-second ticks:
+  /proc/stat            per-core busy %, iowait %, context switches
+  /proc/diskstats       per-disk utilization and MB/s read and written
+  /proc/<pid>/stat      CPU (in cores) of each process group ("server",
+                        "postgres": every process whose name matches)
+  /proc/<pid>/task/*/status  voluntary and involuntary context switches
+                        (summed over threads), RSS (summed over processes,
+                        so Postgres shared buffers count more than once)
+Only new PIDs have their name read, so a sample costs a few ms at most.
+
+write_csv() joins the two into one row per second, appended to a CSV that
+plot_timeseries.py reads.
+
+Run on its own, it samples /proc alone until SIGTERM or Ctrl-C, for load
+from other tools (load_gen/script.sh runs it around each k6 step):
+
+  python3 -m load_gen.timeseries sample out.csv [server=server*,...]
+"""
+
+import csv
+import fnmatch
+import os
+import signal
+import sys
+import threading
+import time
+
+from load_gen.hdr import Histogram
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Series:
+    """Requests per whole second of time.monotonic(): successes, failures and
+    a latency histogram (2 significant digits keep each one small)."""
+
+    def __init__(self, digits=2):
+        self.digits = digits
+        self.seconds = {}  # second -> [successes, failures, Histogram]
+        self._sec = None
+        self._cur = None
+
+    def _bucket(self, now):
+        sec = int(now)
+        if sec != self._sec:
+            self._sec = sec
+            self._cur = self.seconds.get(sec)
+            if self._cur is None:
+                self._cur = self.seconds[sec] = [0, 0, Histogram(self.digits)]
+        return self._cur
+
+    def record(self, now, latency):
+        b = self._bucket(now)
+        b[0] += 1
+        b[2].record(latency)
+
+    def fail(self, now):
+        self._bucket(now)[1] += 1
+
+    def merge(self, other):
+        for sec, (ok, failed, hist) in other.seconds.items():
+            b = self.seconds.get(sec)
+            if b is None:
+                b = self.seconds[sec] = [0, 0, Histogram(self.digits)]
+            b[0] += ok
+            b[1] += failed
+            b[2].merge(hist)
+        return self
+
+
+class SharedSeries(Series):
+    """A Series that several threads record into, under a lock."""
+
+    def __init__(self, digits=2):
+        super().__init__(digits)
+        self._lock = threading.Lock()
+
+    def record(self, now, latency):
+        with self._lock:
+            super().record(now, latency)
+
+    def fail(self, now):
+        with self._lock:
+            super().fail(now)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:  # the process exited, or no permission
+        return None
+
+
+def _disks():
+    # Whole disks only: partitions would count the same I/O twice
+    try:
+        names = os.listdir("/sys/block")
+    except OSError:
+        return set()
+    return {n for n in names if not n.startswith(("loop", "ram", "zram"))}
+
+
+class ProcSampler:
+    """
+    Samples /proc every second in a thread until stop(). groups maps a
+    label to a process-name pattern (fnmatch, against /proc/<pid>/comm).
+    """
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.available = os.path.exists("/proc/stat")
+        self.samples = {}  # second -> {column: value}
+        self._ticks = os.sysconf("SC_CLK_TCK") if self.available else 100
+        self._page_mb = (os.sysconf("SC_PAGE_SIZE") / 1e6
+                         if self.available else 0.004096)
+        self._disks = _disks()
+        self._labels = {}  # pid -> group label, or None
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ---- reading /proc ----
+
+    def _stat(self):
+        cpus, ctxt = {}, 0
+        for line in (_read("/proc/stat") or "").splitlines():
+            if line.startswith("cpu"):
+                f = line.split()
+                v = [int(x) for x in f[1:9]]
+                # busy, iowait, total (guest time is already in user)
+                cpus[f[0]] = (v[0] + v[1] + v[2] + v[5] + v[6] + v[7], v[4],
+                              sum(v))
+            elif line.startswith("ctxt "):
+                ctxt = int(line.split()[1])
+        return cpus, ctxt
+
+    def _diskstats(self):
+        out = {}
+        for line in (_read("/proc/diskstats") or "").splitlines():
+            f = line.split()
+            if len(f) >= 13 and f[2] in self._disks:
+                # sectors read, sectors written (512 bytes), ms doing I/O
+                out[f[2]] = (int(f[5]), int(f[9]), int(f[12]))
+        return out
+
+    def _pids(self):
+        pids = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            pid = int(name)
+            if pid not in self._labels:
+                comm = (_read(f"/proc/{pid}/comm") or "").strip()
+                self._labels[pid] = next(
+                    (label for label, pattern in self.groups.items()
+                     if fnmatch.fnmatchcase(comm, pattern)), None)
+            if self._labels[pid] is not None:
+                pids[pid] = self._labels[pid]
+        return pids
+
+    def _process(self, pid):
+        stat = _read(f"/proc/{pid}/stat")
+        if stat is None:
+            return None
+        f = stat[stat.rindex(")") + 2:].split()
+        cpu = int(f[11]) + int(f[12])  # utime + stime, all threads
+        rss = int(f[21])
+        vol = invol = 0
+        try:
+            tasks = os.listdir(f"/proc/{pid}/task")
+        except OSError:
+            tasks = []
+        for tid in tasks:
+            for line in (_read(f"/proc/{pid}/task/{tid}/status") or
+                         "").splitlines():
+                if line.startswith("voluntary_ctxt_switches"):
+                    vol += int(line.split()[1])
+                elif line.startswith("nonvoluntary_ctxt_switches"):
+                    invol += int(line.split()[1])
+        return cpu, vol, invol, rss
+
+    def _snapshot(self):
+        cpus, ctxt = self._stat()
+        procs = {}
+        for pid, label in self._pids().items():
+            p = self._process(pid)
+            if p is not None:
+                procs[pid] = (label, p)
+        return time.monotonic(), cpus, ctxt, self._diskstats(), procs
+
+    # ---- one row from two snapshots ----
+
+    def _row(self, a, b):
+        t0, cpus0, ctxt0, disks0, procs0 = a
+        t1, cpus1, ctxt1, disks1, procs1 = b
+        dt = max(t1 - t0, 1e-3)
+        row = {}
+        for name in sorted(cpus1, key=lambda n: (n != "cpu", len(n), n)):
+            if name not in cpus0:
+                continue
+            busy, iowait, total = (y - x for x, y in zip(cpus0[name],
+                                                        cpus1[name]))
+            total = max(total, 1)
+            if name == "cpu":
+                row["CPU_Busy"] = 100.0 * busy / total
+                row["CPU_IOWait"] = 100.0 * iowait / total
+            else:
+                row[f"CPU{name[3:]}_Busy"] = 100.0 * busy / total
+        row["Ctx_Switches"] = (ctxt1 - ctxt0) / dt
+        for label in self.groups:
+            row[f"{label}_Procs"] = 0
+            for col in ("CPU_Cores", "Ctx_Vol", "Ctx_Invol", "RSS_MB"):
+                row[f"{label}_{col}"] = 0.0
+        for pid, (label, (cpu, vol, invol, rss)) in procs1.items():
+            row[f"{label}_Procs"] += 1
+            row[f"{label}_RSS_MB"] += rss * self._page_mb
+            if pid in procs0:  # a process that just started counts next time
+                _, (cpu0, vol0, invol0, _) = procs0[pid]
+                row[f"{label}_CPU_Cores"] += (cpu - cpu0) / self._ticks / dt
+                row[f"{label}_Ctx_Vol"] += (vol - vol0) / dt
+                row[f"{label}_Ctx_Invol"] += (invol - invol0) / dt
+        for disk in sorted(disks1):
+            if disk not in disks0:
+                continue
+            rd, wr, ms = (y - x for x, y in zip(disks0[disk], disks1[disk]))
+            row[f"Disk_{disk}_Util"] = min(100.0, ms / (10.0 * dt))
+            row[f"Disk_{disk}_Read_MBps"] = rd * 512 / 1e6 / dt
+            row[f"Disk_{disk}_Write_MBps"] = wr * 512 / 1e6 / dt
+        return row
+
+    # ---- the thread ----
+
+    def _run(self):
+        last = self._snapshot()
+        while True:
+            # Wake on the next whole second, like Series' buckets
+            sec = int(last[0]) + 1
+            stopped = self._stop.wait(max(0.0, sec - time.monotonic()))
+            snap = self._snapshot()
+            # On stop, the rest of the last second (the rates are per second
+            # whatever the span)
+            self.samples[int(last[0]) if stopped else sec - 1] = \
+                self._row(last, snap)
+            if stopped:
+                return
+            last = snap
+
+    def start(self):
+        if self.available:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        return self.samples
+
+
+def parse_groups(spec):
+    """'server=server*,postgres=postgres' -> {label: pattern}."""
+    groups = {}
+    for part in spec.split(","):
+        label, _, pattern = part.partition("=")
+        if label.strip():
+            groups[label.strip()] = (pattern or label).strip()
+    return groups
+
+
+def rows(series, samples, start, end):
+    """One dict per whole second from start to end (time.monotonic())."""
+    wall = time.time() - time.monotonic()
+    out = []
+    for sec in range(int(start), int(end) + 1):
+        span = min(sec + 1, end) - max(sec, start)
+        if span <= 0.05:  # a sliver at either end would give wild rates
+            continue
+        ok, failed, hist = series.seconds.get(sec, (0, 0, None))
+        row = {
+            "Second": sec - int(start),
+            "Time": time.strftime("%H:%M:%S", time.localtime(wall + sec)),
+            "Requests_Per_Sec": ok / span,
+            "Errors_Per_Sec": failed / span,
+            "Error_Rate": failed / (ok + failed) if ok + failed else 0.0,
+        }
+        values = hist.values_at(PERCENTILES) if hist else [0.0] * 4
+        for p, v in zip(PERCENTILES, values):
+            row[f"P{p:g}_ms".replace(".", "")] = v * 1000
+        row["Max_ms"] = hist.max * 1000 if hist else 0.0
+        row.update(samples.get(sec, {}))
+        out.append(row)
+    return out
+
+
+def write_csv(path, rows, fixed):
+    """
+    Appends rows to path, each with the fixed columns (workload, step, ...)
+    first. A new file gets its header from the first row; an existing one
+    keeps its own, so runs with other cores or disks still line up.
+    """
+    if not rows:
+        return
+    if os.path.isfile(path) and os.path.getsize(path) > 0:
+        with open(path, newline="") as f:
+            header = next(csv.reader(f))
+        new = False
+    else:
+        header = list(fixed) + list(rows[0])
+        new = True
+    with open(path, "a", newline="") as f:
+        writer = csv.DictWriter(f, header, restval="", extrasaction="ignore")
+        if new:
+            writer.writeheader()
+        for row in rows:
+            writer.writerow({**fixed, **{k: _fmt(v) for k, v in row.items()}})
+
+
+def _fmt(v):
+    return f"{v:.3f}" if isinstance(v, float) else v
+
+
+def main(argv):
+    if len(argv) >= 2 and argv[0] == "sample":
+        spec = argv[2] if len(argv) > 2 else "server=server*,postgres=postgres"
+        done = threading.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: done.set())
+        sampler = ProcSampler(parse_groups(spec)).start()
+        while not done.wait(1.0):  # wake now and then to take the signal
+            pass
+        samples = sampler.stop()
+        wall = time.time() - time.monotonic()
+        first = min(samples, default=0)
+        write_csv(argv[1], [
+            {"Second": sec - first,
+             "Time": time.strftime("%H:%M:%S", time.localtime(wall + sec)),
+             **samples[sec]} for sec in sorted(samples)], {})
+        return 0
+    print("Usage: python3 -m load_gen.timeseries sample <out.csv> "
+          "[label=pattern,...]")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
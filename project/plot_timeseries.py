@@ -0,0 +1,87 @@
+import pandas as pd
+import matplotlib.pyplot as plt
+import sys
+
+# Plots a load_gen.py --timeseries file: one figure per step (workload, VUs
+# or target rate), with load, latency, CPU and context switches/disk
+# against seconds into the step.
+#   python3 plot_timeseries.py ts.csv          # show
+#   python3 plot_timeseries.py ts.csv out      # save out-<step>.png
+
+filename = sys.argv[1] if len(sys.argv) > 1 else 'timeseries.csv'
+prefix = sys.argv[2] if len(sys.argv) > 2 else None
+
+try:
+    df = pd.read_csv(filename, dtype={'Target_Rate': str})
+except FileNotFoundError:
+    print(f"Error: File '{filename}' not found.")
+    sys.exit(1)
+
+df['Target_Rate'] = df['Target_Rate'].fillna('')
+groups = sorted({c[:-len('_CPU_Cores')] for c in df.columns if c.endswith('_CPU_Cores')})
+cores = [c for c in df.columns if c.startswith('CPU') and c[3:-5].isdigit()]
+disks = [c for c in df.columns if c.startswith('Disk_') and c.endswith('_Util')]
+
+for (workload, threads, rate), step in df.groupby(['Workload', 'Threads', 'Target_Rate'], sort=False):
+    label = f"{workload}, {rate} req/s open loop" if rate else f"{workload}, {threads} VUs"
+    t = step['Second']
+    fig, (ax1, ax2, ax3, ax4) = plt.subplots(4, 1, figsize=(11, 12), sharex=True)
+
+    # Throughput and errors
+    ax1.plot(t, step['Requests_Per_Sec'], color='tab:blue', linewidth=2, label='Requests/s')
+    ax1.set_ylabel('Requests/s', color='tab:blue')
+    ax1.grid(True, linestyle='--', alpha=0.5)
+    err = ax1.twinx()
+    err.plot(t, step['Errors_Per_Sec'], color='tab:red', linestyle='--', label='Errors/s')
+    err.set_ylabel('Errors/s', color='tab:red')
+
+    # Latency percentiles
+    for col in ('P50_ms', 'P90_ms', 'P99_ms', 'P999_ms', 'Max_ms'):
+        ax2.plot(t, step[col], label=col[:-3].replace('P999', 'P99.9'))
+    ax2.set_yscale('log')
+    ax2.set_ylabel('Latency (ms)')
+    ax2.legend(loc='upper left', ncol=5, fontsize='small')
+    ax2.grid(True, which='both', linestyle='--', alpha=0.5)
+
+    # CPU: every core's busy %, and the cores each process group used
+    for col in cores:
+        ax3.plot(t, step[col], color='grey', alpha=0.4, linewidth=1)
+    if 'CPU_Busy' in step:
+        ax3.plot(t, step['CPU_Busy'], color='black', linewidth=2, label='All cores busy %')
+        ax3.plot(t, step['CPU_IOWait'], color='tab:brown', label='IO wait %')
+    ax3.set_ylabel('CPU busy % (grey: per core)')
+    ax3.set_ylim(0, 105)
+    ax3.legend(loc='upper left', fontsize='small')
+    ax3.grid(True, linestyle='--', alpha=0.5)
+    procs = ax3.twinx()
+    for g in groups:
+        procs.plot(t, step[f'{g}_CPU_Cores'], linestyle='--', label=f'{g} (cores)')
+    procs.set_ylabel('Process CPU (cores)')
+    procs.legend(loc='upper right', fontsize='small')
+
+    # Context switches and disk utilization
+    for g in groups:
+        ax4.plot(t, step[f'{g}_Ctx_Vol'] + step[f'{g}_Ctx_Invol'], label=f'{g} ctx switches/s')
+    ax4.set_ylabel('Context switches/s')
+    ax4.set_xlabel('Seconds into the step')
+    ax4.legend(loc='upper left', fontsize='small')
+    ax4.grid(True, linestyle='--', alpha=0.5)
+    disk = ax4.twinx()
+    for col in disks:
+        disk.plot(t, step[col], linestyle=':', label=col[5:-5])
+    disk.set_ylabel('Disk util %')
+    disk.set_ylim(0, 105)
+    if disks:
+        disk.legend(loc='upper right', fontsize='small')
+
+    fig.suptitle(f'Time series: {label}\nSource: {filename}')
+    fig.tight_layout()
+    if prefix:
+        name = f"{prefix}-{workload}-{rate or threads}.png"
+        fig.savefig(name)
+        plt.close(fig)
+        print(f"Saved {name}")
+
+if not prefix:
+    print("Displaying plots...")
+    plt.show()
@@ -1,14 +1,45 @@
-// g++ server.cpp -lpqxx -lpq -lpthread -o server
+// g++ server.cpp -I/usr/include/postgresql -lpqxx -lpq -lpthread -o server
 // grep nameserver /etc/resolv.conf
 // ip route | grep default | awk '{print $3}'
 #include "httplib.h"
+#include <csignal>
+#include <unistd.h>
+#include <algorithm>
+#include <chrono>
+#include <climits>
 #include <iostream>
+#include <deque>
+#include <exception>
+#include <functional>
+#include <future>
+#include <map>
+#include <optional>
 #include <pqxx/pqxx>
+#include <cstdlib>
 #include <stdexcept>
 #include <string>
+#include <thread>
+#include <unordered_map>
+#include <vector>
 
 #include "dbpool.h"
 #include "kvcache.h"
+#include "SingleFlight.h"
+#include "GroupCommit.h"
+#include "KVStatements.h"
+#include "PgPipeline.h"
+#include "PgArray.h"
+#include "KVText.h"
+#include "Metrics.h"
+#include "CountingTaskQueue.h"
+#include "AdmissionControl.h"
+#include "CacheWarmup.h"
+#include "WorkerProcesses.h"
+#include "EpollServer.h"
+#include "WriteBack.h"
+#include "CacheInvalidation.h"
+#include "BulkCopy.h"
+#include "AccessTrace.h"
 
 using namespace std;
 
@@ -23,6 +54,162 @@ int parse_id(const string &s) {
   }
 }
 
+// Optional tuning knobs are read from the environment so the interactive
+// prompts stay the same, e.g. KV_CACHE_SHARDS=32 ./server
+long env_or(const char *name, long def) {
+  const char *v = getenv(name);
+  if (!v || !*v)
+    return def;
+  try {
+    return stol(v);
+  } catch (...) {
+    return def;
+  }
+}
+
+string env_str(const char *name, const string &def) {
+  const char *v = getenv(name);
+  return (v && *v) ? string(v) : def;
+}
+
+// Runs one statement on the pipeline and turns a failed reply into an
+// exception, like pqxx does, so handlers keep a single error path.
+PgReply pipelined(PgPipeline &pipeline, const string &statement,
+                  vector<string> params) {
+  PgReply r = pipeline.query(statement, std::move(params));
+  if (!r.ok)
+    throw runtime_error(r.error);
+  return r;
+}
+
+void overloaded(Response &res, const string &why) {
+  res.status = 503;
+  res.set_header("Retry-After", "1");
+  res.set_content("Service busy: " + why, "text/plain");
+}
+
+// 503 + Retry-After when the request was not admitted or no DB connection
+// freed up in time (the client may retry), 500 for real database errors.
+void db_error(Response &res, const std::exception &e) {
+  if (dynamic_cast<const Overloaded *>(&e)) {
+    overloaded(res, "too many requests waiting for the database");
+    return;
+  }
+  if (dynamic_cast<const PoolTimeout *>(&e)) {
+    overloaded(res, "no DB connection available");
+    return;
+  }
+  res.status = 500;
+  res.set_content(string("Database error: ") + e.what(), "text/plain");
+}
+
+// Same for the error an asynchronous DB call hands to its callback.
+void db_error(Response &res, exception_ptr error) {
+  try {
+    rethrow_exception(error);
+  } catch (const std::exception &e) {
+    db_error(res, e);
+  }
+}
+
+// Outcome of a statement sent on the pipeline without waiting for it: the
+// reply, or what the blocking path would throw (Overloaded, a DB error).
+struct DbOutcome {
+  PgReply reply;
+  exception_ptr error;
+};
+
+// Request count by status class and latency for one route.
+struct RouteMetrics {
+  string route;
+  Counter ok, client_errors, server_errors; // <400, 4xx, 5xx
+  Histogram latency{100,    250,    500,     1000,    2500,    5000,
+                    10000,  25000,  50000,   100000,  250000,  500000,
+                    1000000, 2500000, 5000000, 10000000};
+
+  explicit RouteMetrics(const string &route) : route(route) {}
+
+  void record(int status, chrono::steady_clock::duration took) {
+    (status >= 500 ? server_errors : status >= 400 ? client_errors : ok).add();
+    latency.observe_us(
+        chrono::duration_cast<chrono::microseconds>(took).count());
+  }
+};
+
+// Wraps a handler so every request it serves is counted and timed.
+Server::Handler timed(RouteMetrics &m, Server::Handler handler) {
+  return [&m, handler](const Request &req, Response &res) {
+    auto t0 = chrono::steady_clock::now();
+    handler(req, res);
+    m.record(res.status, chrono::steady_clock::now() - t0);
+  };
+}
+
+Server::HandlerWithContentReader
+timed(RouteMetrics &m, Server::HandlerWithContentReader handler) {
+  return [&m, handler](const Request &req, Response &res,
+                       const ContentReader &read) {
+    auto t0 = chrono::steady_clock::now();
+    handler(req, res, read);
+    m.record(res.status, chrono::steady_clock::now() - t0);
+  };
+}
+
+// Registers every route on the public port (the httplib server, or the
+// epoll front end if there is one) and, in multi-process mode, on this
+// worker's peer port too. On the public port, forward (if set) sees each
+// request first and answers it when the keys belong to another worker. It
+// runs inside the handler because httplib reads the body after pre-routing.
+struct Routes {
+  Server &srv;
+  EpollServer *front;
+  Server *peer;
+  function<bool(const Request &, Response &)> forward;
+
+  void Get(const string &path, Server::Handler h) {
+    if (front)
+      front->Get(path, owned(h));
+    else
+      srv.Get(path, owned(h));
+    if (peer)
+      peer->Get(path, h);
+  }
+  void Post(const string &path, Server::Handler h) {
+    if (front)
+      front->Post(path, owned(h));
+    else
+      srv.Post(path, owned(h));
+    if (peer)
+      peer->Post(path, h);
+  }
+  void Delete(const string &path, Server::Handler h) {
+    if (front)
+      front->Delete(path, owned(h));
+    else
+      srv.Delete(path, owned(h));
+    if (peer)
+      peer->Delete(path, h);
+  }
+  // Streams the request body to the handler; public port only.
+  void Post(const string &path, Server::HandlerWithContentReader h) {
+    if (front)
+      front->Post(path, h);
+    else
+      srv.Post(path, h);
+  }
+
+private:
+  Server::Handler owned(Server::Handler h) {
+    if (!forward)
+      return h;
+    auto fwd = forward;
+    return [fwd, h](const Request &req, Response &res) {
+      if (!fwd(req, res))
+        h(req, res);
+    };
+  }
+};
+
 int main() {
   // const string conn_str =
   //     //"dbname=decs user=postgres password=kali host=Nani.mshome.net";
@@ -44,41 +231,944 @@ int main() {
   ;
   int cache_size;
   cin >> cache_size;
-  LibpqxxPool pool(pool_size, conn_str);
+  cout << "Enter http_threads: ";
+  int http_thread;
+  cin >> http_thread;
+  // The prompted size is the minimum; KV_POOL_MAX lets the pool grow while
+  // acquires are slow. KV_POOL_ACQUIRE_TIMEOUT_MS bounds how long a request
+  // waits for a connection before it gets 503.
+  PoolConfig pool_cfg;
+  pool_cfg.min_size = pool_size;
+  pool_cfg.max_size = max<long>(pool_size, env_or("KV_POOL_MAX", pool_size));
+  pool_cfg.acquire_timeout =
+      chrono::milliseconds(max(0L, env_or("KV_POOL_ACQUIRE_TIMEOUT_MS", 2000)));
+  pool_cfg.grow_wait =
+      chrono::milliseconds(max(0L, env_or("KV_POOL_GROW_WAIT_MS", 5)));
+  pool_cfg.shrink_idle =
+      chrono::milliseconds(max(1L, env_or("KV_POOL_IDLE_MS", 30000)));
+  // SIGINT/SIGTERM are taken by a thread so a running server can stop
+  // cleanly and save its hot keys. They are blocked before the first
+  // background thread starts so that no other thread receives them.
+  sigset_t stop_signals;
+  sigemptyset(&stop_signals);
+  sigaddset(&stop_signals, SIGINT);
+  sigaddset(&stop_signals, SIGTERM);
+  pthread_sigmask(SIG_BLOCK, &stop_signals, nullptr);
+
+  // Write-back mode (WriteBack.h): KV_WRITE_BACK_LOG names a local log that
+  // writes go to before they are answered; Postgres is updated from it every
+  // KV_WRITE_BACK_FLUSH_MS. KV_WRITE_BACK_SYNC_MS=0 fsyncs before answering,
+  // N > 0 fsyncs every N ms. A log left by the last run is replayed first.
+  string wb_path = env_str("KV_WRITE_BACK_LOG", "");
+  long wb_sync_ms = max(0L, env_or("KV_WRITE_BACK_SYNC_MS", 0));
+  long wb_flush_ms = max(1L, env_or("KV_WRITE_BACK_FLUSH_MS", 200));
+  long wb_batch = max(1L, env_or("KV_WRITE_BACK_BATCH", 10000));
+  // KV_INVALIDATION=1: several servers share kv_store and tell each other
+  // which ids they wrote (CacheInvalidation.h), batched over
+  // KV_INVALIDATION_WINDOW_MS.
+  bool invalidate = env_or("KV_INVALIDATION", 0) != 0;
+  long inval_window_ms = max(0L, env_or("KV_INVALIDATION_WINDOW_MS", 5));
+
   try {
-    db::connection *init_conn = pool.acquire();
-    {
-      db::work setup_txn{*init_conn};
-      setup_txn.exec("CREATE TABLE IF NOT EXISTS kv_store ("
-                     "  id INT PRIMARY KEY,"
-                     "  value TEXT NOT NULL"
-                     ");");
-      setup_txn.commit();
-    }
+    db::connection setup_conn(conn_str);
+    db::work setup_txn{setup_conn};
+    setup_txn.exec("CREATE TABLE IF NOT EXISTS kv_store ("
+                   "  id INT PRIMARY KEY,"
+                   "  value TEXT NOT NULL"
+                   ");");
+    if (invalidate)
+      setup_txn.exec(CacheInvalidation::schema());
+    setup_txn.commit();
     cout << "Database table 'kv_store' is ready." << endl;
-    pool.release(init_conn);
+    if (!wb_path.empty()) {
+      size_t n = WriteBackLog::replay(setup_conn, wb_path, wb_batch);
+      if (n)
+        cout << "Write-back: replayed " << n << " log records" << endl;
+    }
   } catch (const std::exception &e) {
     cerr << "Fatal error: Could not initialize database. " << e.what() << endl;
     return 1;
   }
 
-  KVCache cache(cache_size);
+  // KV_WORKERS > 1 forks that many worker processes sharing port 1234
+  // (SO_REUSEPORT). Each has its own pool, cache and HTTP threads, owns the
+  // keys with id % workers == its index and passes other keys on to their
+  // owner, so no key is cached twice. KV_WORKER_CPUS pins the workers.
+  int workers = max(1L, env_or("KV_WORKERS", 1));
+  vector<vector<int>> cpu_sets;
+  string cpu_spec = env_str("KV_WORKER_CPUS", "");
+  if (!cpu_spec.empty() && !parse_cpu_sets(cpu_spec, cpu_sets)) {
+    cerr << "KV_WORKER_CPUS must look like 0-3 or 0-1;2-3" << endl;
+    return 1;
+  }
+  int worker = fork_workers(workers, cpu_sets); // from here on: one worker
+
+  atomic<Server *> running_server{nullptr};
+  atomic<EpollServer *> running_front{nullptr};
+  thread([&stop_signals, &running_server, &running_front] {
+    int sig = 0;
+    sigwait(&stop_signals, &sig);
+    Server *srv = running_server.load();
+    EpollServer *front = running_front.load();
+    if (!srv && !front)
+      _exit(128 + sig); // still starting up
+    cout << "\nStopping server..." << endl;
+    // main stops the peer port once listen() returns
+    if (front)
+      front->stop();
+    else
+      srv->stop();
+  }).detach();
+
+  LibpqxxPool pool(pool_cfg, conn_str);
+  // Admission control: DB work beyond an adaptive concurrency limit is
+  // rejected with 503 instead of queueing (AdmissionControl.h). Cache hits
+  // never take a permit. KV_DB_LIMIT_MAX=0 turns it off.
+  long limit_max = env_or("KV_DB_LIMIT_MAX", 256);
+  unique_ptr<AdaptiveLimiter> db_limiter;
+  if (limit_max > 0)
+    db_limiter.reset(new AdaptiveLimiter(pool_cfg.max_size,
+                                         env_or("KV_DB_LIMIT_MIN", 4),
+                                         limit_max));
+  cout << "Pool: " << pool_cfg.min_size << ".." << pool_cfg.max_size
+       << " connections, acquire timeout " << pool_cfg.acquire_timeout.count()
+       << " ms" << endl;
+  try {
+    prepare_kv_statements(pool);
+  } catch (const std::exception &e) {
+    cerr << "Fatal error: Could not prepare statements. " << e.what() << endl;
+    return 1;
+  }
+
+  // One cache segment per shard, each with its own lock. Default to one shard
+  // per hardware thread so cache hits do not serialize on a single mutex.
+  // The cache size is the total: each worker holds its share of the keys.
+  CacheConfig cache_cfg;
+  cache_cfg.capacity = max(1, cache_size / workers);
+  long default_shards = max(1u, thread::hardware_concurrency() / workers);
+  cache_cfg.shards = max(1L, env_or("KV_CACHE_SHARDS", default_shards));
+  if (!parse_eviction_policy(env_str("KV_CACHE_POLICY", "lru"),
+                             cache_cfg.policy)) {
+    cerr << "KV_CACHE_POLICY must be one of: lru, clock, s3fifo" << endl;
+    return 1;
+  }
+  // KV_CACHE_BYTES switches the capacity from entries to a byte budget
+  // (key + value + per-entry node overhead); the prompted size is ignored.
+  long cache_bytes = env_or("KV_CACHE_BYTES", 0);
+  if (cache_bytes > 0) {
+    cache_cfg.capacity = max(1L, cache_bytes / workers);
+    cache_cfg.capacity_in_bytes = true;
+  }
+  string admission = env_str("KV_CACHE_ADMISSION", "none");
+  if (admission != "none" && admission != "tinylfu") {
+    cerr << "KV_CACHE_ADMISSION must be one of: none, tinylfu" << endl;
+    return 1;
+  }
+  cache_cfg.admission = admission == "tinylfu";
+  KVCache cache(cache_cfg);
+  SingleFlight<int, optional<string>> val_flights;
+  AsyncSingleFlight<int, DbOutcome> val_fetches; // async /val misses
+
+  // Ids known to be missing (404 from /val or /delete). /save clears them.
+  long neg_size = max(0L, env_or("KV_NEG_CACHE_SIZE", 10000));
+  long neg_ttl_ms = max(1L, env_or("KV_NEG_CACHE_TTL_MS", 5000));
+  NegativeCache missing(neg_size, chrono::milliseconds(neg_ttl_ms));
+  // KV_HOT_KEYS_FILE is read by the warm-up and rewritten on shutdown.
+  // Workers keep one file each and warm up only the keys they own.
+  string hot_keys_file = env_str("KV_HOT_KEYS_FILE", "hot_keys.txt");
+  string partition;
+  if (workers > 1) {
+    if (!hot_keys_file.empty())
+      hot_keys_file += "." + to_string(worker);
+    partition = "id % " + to_string(workers) + " = " + to_string(worker);
+  }
+  CacheWarmup warmup(conn_str, cache, missing, hot_keys_file, partition);
+  unique_ptr<CacheInvalidation> invalidation;
+  if (invalidate) {
+    invalidation.reset(new CacheInvalidation(
+        conn_str, cache, missing, chrono::milliseconds(inval_window_ms)));
+    cout << "Cache invalidation: instance " << invalidation->instance_id()
+         << ", channel " << CacheInvalidation::kChannel << endl;
+  }
+  cout << "Negative cache: " << neg_size << " entries, TTL " << neg_ttl_ms
+       << " ms" << endl;
+  cout << "Cache: " << cache_cfg.capacity
+       << (cache_cfg.capacity_in_bytes ? " bytes" : " entries") << " in "
+       << cache.shard_count() << " shards, policy "
+       << eviction_policy_name(cache_cfg.policy) << ", admission " << admission
+       << endl;
+  // Group commit: /save and /delete share one transaction per batch.
+  // KV_GROUP_COMMIT_BATCH <= 1 keeps one transaction per request.
+  long gc_batch = env_or("KV_GROUP_COMMIT_BATCH", 0);
+  long gc_wait_us = max(0L, env_or("KV_GROUP_COMMIT_WAIT_US", 1000));
+  unique_ptr<WriteBackLog> write_back;
+  if (!wb_path.empty()) {
+    if (workers > 1)
+      wb_path += "." + to_string(worker);
+    // Other instances hear about a write once it is in kv_store.
+    auto flushed = [&](const vector<int> &ids) {
+      if (invalidation)
+        invalidation->publish(ids);
+    };
+    try {
+      write_back.reset(new WriteBackLog(pool, wb_path,
+                                        chrono::milliseconds(wb_sync_ms),
+                                        chrono::milliseconds(wb_flush_ms),
+                                        wb_batch, flushed));
+    } catch (const std::exception &e) {
+      cerr << "Fatal error: Could not open the write-back log. " << e.what()
+           << endl;
+      return 1;
+    }
+    cout << "Write-back: log " << wb_path << ", "
+         << (wb_sync_ms ? "fsync every " + to_string(wb_sync_ms) + " ms"
+                        : string("fsync per write"))
+         << ", flush every " << wb_flush_ms << " ms" << endl;
+  }
+  // Tells the other instances which ids changed (the write-back flusher
+  // does it in write-back mode).
+  auto announce = [&](const vector<int> &ids) {
+    if (invalidation && !write_back)
+      invalidation->publish(ids);
+  };
+  unique_ptr<GroupCommitWriter> writer;
+  if (gc_batch > 1 && !write_back) {
+    writer.reset(new GroupCommitWriter(pool, gc_batch,
+                                       chrono::microseconds(gc_wait_us)));
+    cout << "Group commit: up to " << gc_batch << " writes, " << gc_wait_us
+         << " us window" << endl;
+  }
+
+  // Pipelined DB execution: single-statement reads and writes go to a few
+  // libpq connections in pipeline mode instead of taking a pool connection.
+  long pipe_conns = max(0L, env_or("KV_DB_PIPELINE_CONNS", 0));
+  long pipe_depth = max(1L, env_or("KV_DB_PIPELINE_DEPTH", 256));
+  unique_ptr<PgPipeline> pipeline;
+  if (pipe_conns > 0) {
+    pipeline.reset(
+        new PgPipeline(conn_str, pipe_conns, kv_statements(), pipe_depth));
+    cout << "DB pipeline: " << pipe_conns << " connections, up to "
+         << pipe_depth << " statements in flight each" << endl;
+  }
+
   Server srv;
-  cout << "Enter http_threads: ";
-  int http_thread;
-  cin >> http_thread;
-  srv.new_task_queue = [http_thread] {
-    return new httplib::ThreadPool(http_thread);
+  // KV_HTTP_MAX_QUEUE caps the connections waiting for a worker; beyond it
+  // new connections are closed right away (there is no thread to answer
+  // them). Past KV_HTTP_SHED_QUEUE waiting connections, requests that need
+  // the DB get 503 up front so workers move on; /val may still hit the cache.
+  long max_queue = max(0L, env_or("KV_HTTP_MAX_QUEUE", 0));
+  long shed_queue = max(0L, env_or("KV_HTTP_SHED_QUEUE", 0));
+  TaskQueueStats queue_stats;
+  srv.new_task_queue = [http_thread, max_queue, &queue_stats] {
+    return new CountingTaskQueue(http_thread, max_queue, queue_stats);
+  };
+  // httplib writes headers and body separately; without TCP_NODELAY Nagle
+  // holds the body until the client's delayed ACK (~40 ms).
+  srv.set_tcp_nodelay(true);
+
+  // KV_FRONTEND=epoll serves the public port with EpollServer.h instead: a
+  // few I/O threads multiplex every connection, cache hits are answered on
+  // them and everything else runs on http_threads worker threads, so idle
+  // keep-alive connections no longer hold a thread each.
+  unique_ptr<EpollServer> front;
+  string frontend = env_str("KV_FRONTEND", "httplib");
+  if (frontend == "epoll") {
+    long io_threads = max(1L, env_or("KV_EPOLL_IO_THREADS", 2));
+    front.reset(
+        new EpollServer(io_threads, http_thread, max_queue, queue_stats));
+    cout << "Epoll front end: " << io_threads << " I/O threads, "
+         << http_thread << " worker threads" << endl;
+  } else if (frontend != "httplib") {
+    cerr << "KV_FRONTEND must be one of: httplib, epoll" << endl;
+    return 1;
+  }
+  Counter shed;
+  size_t batch_max = max(1L, env_or("KV_BATCH_MAX_KEYS", 1000));
+  long scan_batch = max(1L, env_or("KV_SCAN_BATCH", 1000));
+  BulkLimit bulk_limit(max(1L, env_or("KV_BULK_MAX", 2)));
+  Counter bulk_imported, bulk_exported; // rows
+
+  // Multi-process mode: the peer port (127.0.0.1 only) serves this worker's
+  // keys to the other workers. It has the same routes but never forwards.
+  unique_ptr<PeerRouter> peers;
+  unique_ptr<Server> peer_srv;
+  if (workers > 1) {
+    peers.reset(new PeerRouter(worker, workers,
+                               env_or("KV_WORKER_PORT_BASE", 1235)));
+    peer_srv.reset(new Server);
+    // Each HTTP thread of each worker may hold a keep-alive connection here.
+    peer_srv->new_task_queue = [http_thread, workers, &queue_stats] {
+      return new CountingTaskQueue(http_thread * workers, 0, queue_stats);
+    };
+    peer_srv->set_tcp_nodelay(true);
+    peer_srv->set_socket_options([](socket_t sock) {
+      int one = 1;
+      setsockopt(sock, SOL_SOCKET, SO_REUSEADDR, &one, sizeof(one));
+    });
+  }
+
+  // Sends requests for keys this worker does not own to their owner; batch
+  // bodies are split by owner and the parts sent in parallel. Returns false
+  // when the request is handled here (own keys, or a malformed request the
+  // local handler rejects).
+  auto to_owners = [&](const Request &req, Response &res) {
+    const string &path = req.path;
+    if (path == "/val" || path == "/save" || path == "/delete") {
+      if (!req.has_param("id"))
+        return false;
+      // parse_id() lets negative ids through; like parse_kv_id() for the
+      // batch endpoints, only 0..INT_MAX are routed to other workers
+      int id = parse_id(req.get_param_value("id"));
+      if (id < 0 || peers->is_local(id))
+        return false;
+      if (!peers->forward(peers->owner(id), req, req.body, res))
+        overloaded(res, "the worker owning this key is unavailable");
+      return true;
+    }
+    if (path != "/mget" && path != "/mset" && path != "/mdelete")
+      return false;
+
+    vector<int> ids;
+    vector<string> parts(workers);
+    bool remote = false;
+    for (auto &line : body_lines(req.body)) {
+      int id;
+      if (!parse_kv_id(line.substr(0, line.find('\t')), id))
+        return false;
+      ids.push_back(id);
+      parts[peers->owner(id)] += line + "\n";
+      remote = remote || !peers->is_local(id);
+    }
+    if (!remote || ids.size() > batch_max)
+      return false;
+
+    vector<Response> replies(workers);
+    vector<future<void>> pending;
+    for (int w = 0; w < workers; w++) {
+      if (parts[w].empty())
+        continue;
+      pending.push_back(async(launch::async, [&, w] {
+        if (!peers->forward(w, req, parts[w], replies[w]))
+          overloaded(replies[w], "worker " + to_string(w) + " is unavailable");
+      }));
+    }
+    for (auto &f : pending)
+      f.get();
+    for (int w = 0; w < workers; w++) {
+      if (!parts[w].empty() && replies[w].status != 200) {
+        res = replies[w];
+        return true;
+      }
+    }
+
+    string body;
+    if (path == "/mget") {
+      // Back into request order.
+      unordered_map<int, string> lines;
+      for (auto &r : replies) {
+        for (auto &line : body_lines(r.body)) {
+          int id;
+          if (parse_kv_id(line.substr(0, line.find('\t')), id))
+            lines[id] = line;
+        }
+      }
+      for (int id : ids) {
+        auto it = lines.find(id);
+        body += (it != lines.end() ? it->second : to_string(id)) + "\n";
+      }
+    } else if (path == "/mset") {
+      sort(ids.begin(), ids.end());
+      ids.erase(unique(ids.begin(), ids.end()), ids.end());
+      body = "Keys saved/updated: " + to_string(ids.size());
+    } else {
+      vector<int> deleted;
+      string bad;
+      for (auto &r : replies)
+        parse_id_lines(r.body, deleted, bad);
+      sort(deleted.begin(), deleted.end());
+      for (int id : deleted)
+        body += to_string(id) + "\n";
+    }
+    res.set_content(body, "text/plain");
+    return true;
+  };
+
+  auto shed_request = [&](const Request &req, Response &res) {
+    if (req.path == "/val" || req.path == "/metrics" ||
+        req.path == "/stats" || queue_stats.queued.value() <= shed_queue)
+      return false;
+    shed.add();
+    overloaded(res, "request queue is full");
+    return true;
+  };
+  if (shed_queue > 0) {
+    srv.set_pre_routing_handler([&](const Request &req, Response &res) {
+      return shed_request(req, res) ? Server::HandlerResponse::Handled
+                                    : Server::HandlerResponse::Unhandled;
+    });
+    if (front)
+      front->set_pre_routing_handler(shed_request);
+  }
+
+  // KV_TRACE=<file> records the keys of every request on the public port
+  // (see AccessTrace.h), up to KV_TRACE_MAX keys; workers keep one file
+  // each. httplib parses form bodies after pre-routing, so it records after
+  // the handler; the epoll front end has parsed them before routing and
+  // records what it does not shed.
+  unique_ptr<AccessTrace> trace;
+  string trace_file = env_str("KV_TRACE", "");
+  if (!trace_file.empty()) {
+    if (workers > 1)
+      trace_file += "." + to_string(worker);
+    trace.reset(new AccessTrace(
+        trace_file, max(0L, env_or("KV_TRACE_MAX", 100000000))));
+    if (!trace->ok()) {
+      cerr << "Cannot write KV_TRACE file " << trace_file << endl;
+      return 1;
+    }
+    cout << "Tracing key accesses to " << trace_file << endl;
+  }
+  auto trace_request = [&](const Request &req) {
+    const string &path = req.path;
+    AccessTrace::Op op;
+    if (path == "/val" || path == "/mget")
+      op = AccessTrace::READ;
+    else if (path == "/save" || path == "/mset")
+      op = AccessTrace::WRITE;
+    else if (path == "/delete" || path == "/mdelete")
+      op = AccessTrace::DELETE;
+    else
+      return;
+    if (path[1] != 'm') {
+      int id = parse_id(req.get_param_value("id"));
+      if (id >= 0)
+        trace->record(op, id);
+      return;
+    }
+    vector<int> ids;
+    for (auto &line : body_lines(req.body)) {
+      int id;
+      if (parse_kv_id(line.substr(0, line.find('\t')), id))
+        ids.push_back(id);
+    }
+    trace->record(op, ids);
+  };
+  if (trace) {
+    srv.set_post_routing_handler(
+        [&](const Request &req, Response &) { trace_request(req); });
+    if (front) {
+      front->set_pre_routing_handler([&](const Request &req, Response &res) {
+        if (shed_queue > 0 && shed_request(req, res))
+          return true;
+        trace_request(req);
+        return false;
+      });
+    }
+  }
+  Routes api{srv, front.get(), peer_srv.get(), nullptr};
+  if (peers)
+    api.forward = to_owners;
+
+  deque<RouteMetrics> route_metrics;
+  auto route = [&](const string &path) -> RouteMetrics & {
+    route_metrics.emplace_back(path);
+    return route_metrics.back();
   };
 
-  srv.Get("/", [](const Request &req, Response &res) {
+  api.Get("/", [](const Request &req, Response &res) {
     string s =
         "Your IP: " + req.remote_addr + to_string(req.remote_port) + "\n";
     res.set_content(s, "text/plain");
   });
 
+  // Cache statistics (plain text, one "name value" pair per line)
+  api.Get("/stats", [&](const Request &, Response &res) {
+    CacheStats st = cache.stats();
+    string s = "cache_hits " + to_string(st.hits) + "\n" +
+               "cache_misses " + to_string(st.misses) + "\n" +
+               "cache_hit_ratio " + to_string(st.hit_ratio()) + "\n" +
+               "cache_evictions " + to_string(st.evictions) + "\n" +
+               "cache_admission_rejects " + to_string(st.rejected) + "\n" +
+               "cache_entries " + to_string(st.entries) + "\n" +
+               "cache_bytes " + to_string(st.bytes) + "\n" +
+               "db_fetches " +
+               to_string(val_flights.executed_count() +
+                         val_fetches.executed_count()) +
+               "\n" + "db_fetches_coalesced " +
+               to_string(val_flights.coalesced_count() +
+                         val_fetches.coalesced_count()) +
+               "\n" +
+               "negative_cache_hits " + to_string(missing.hit_count()) + "\n" +
+               "negative_cache_entries " + to_string(missing.size()) + "\n";
+    PoolStats ps = pool.stats();
+    s += "pool_size " + to_string(ps.size) + "\n" +
+         "pool_idle " + to_string(ps.idle) + "\n" +
+         "pool_waiting " + to_string(ps.waiting) + "\n" +
+         "pool_acquires " + to_string(ps.acquires) + "\n" +
+         "pool_timeouts " + to_string(ps.timeouts) + "\n" +
+         "pool_replaced " + to_string(ps.replaced) + "\n" +
+         "pool_grown " + to_string(ps.grown) + "\n" +
+         "pool_shrunk " + to_string(ps.shrunk) + "\n" +
+         "pool_wait_us_avg " + to_string(ps.avg_wait_us()) + "\n";
+    // Cumulative, like a Prometheus histogram: acquires that waited <= N us
+    uint64_t cumulative = 0;
+    for (size_t b = 0; b < ps.wait.counts.size(); b++) {
+      cumulative += ps.wait.counts[b];
+      s += "pool_wait_us_le_" +
+           (b < ps.wait.bounds_us.size() ? to_string(ps.wait.bounds_us[b])
+                                         : string("inf")) +
+           " " + to_string(cumulative) + "\n";
+    }
+    s += "http_queue_depth " + to_string(queue_stats.queued.value()) + "\n" +
+         "http_refused " + to_string(queue_stats.refused.value()) + "\n" +
+         "http_shed " + to_string(shed.value()) + "\n";
+    if (front)
+      s += "epoll_connections " + to_string(front->connection_count()) +
+           "\n" + "epoll_inline " + to_string(front->inline_count()) + "\n" +
+           "epoll_dispatched " + to_string(front->dispatched_count()) + "\n" +
+           "epoll_async " + to_string(front->async_count()) + "\n" +
+           "epoll_rejected " + to_string(front->rejected_count()) + "\n";
+    if (peers)
+      s += "worker " + to_string(worker) + "\n" +
+           "workers " + to_string(workers) + "\n" +
+           "worker_forwarded " + to_string(peers->forwarded.value()) + "\n" +
+           "worker_forward_errors " + to_string(peers->errors.value()) + "\n";
+    s += string("warmup_state ") +
+         CacheWarmup::state_name(warmup.current_state()) + "\n" +
+         "warmup_rows_loaded " + to_string(warmup.rows_loaded()) + "\n" +
+         "warmup_rows_read " + to_string(warmup.rows_read()) + "\n";
+    if (db_limiter)
+      s += "db_limit " + to_string(db_limiter->limit()) + "\n" +
+           "db_in_flight " + to_string(db_limiter->in_flight_count()) + "\n" +
+           "db_rejected " + to_string(db_limiter->rejected_count()) + "\n";
+    if (pipeline)
+      s += "db_pipeline_connections " +
+           to_string(pipeline->connection_count()) + "\n" +
+           "db_pipeline_completed " + to_string(pipeline->completed_count()) +
+           "\n";
+    if (writer) {
+      GroupCommitStats gc = writer->stats();
+      s += "group_commit_batches " + to_string(gc.batches) + "\n" +
+           "group_commit_ops " + to_string(gc.ops) + "\n" +
+           "group_commit_batch_avg " + to_string(gc.avg_batch()) + "\n" +
+           "group_commit_batch_max " + to_string(gc.max_batch) + "\n" +
+           "group_commit_wait_us_avg " + to_string(gc.avg_wait_us()) + "\n" +
+           "group_commit_wait_us_max " + to_string(gc.wait_us_max) + "\n";
+    }
+    if (invalidation) {
+      InvalidationStats iv = invalidation->stats();
+      s += "invalidation_published " + to_string(iv.published) + "\n" +
+           "invalidation_notifies " + to_string(iv.notifies) + "\n" +
+           "invalidation_received " + to_string(iv.received) + "\n" +
+           "invalidation_resets " + to_string(iv.resets) + "\n" +
+           "invalidation_reconnects " + to_string(iv.reconnects) + "\n";
+    }
+    if (trace)
+      s += "trace_records " + to_string(trace->records()) + "\n";
+    s += "bulk_running " + to_string(bulk_limit.running()) + "\n" +
+         "bulk_imported_rows " + to_string(bulk_imported.value()) + "\n" +
+         "bulk_exported_rows " + to_string(bulk_exported.value()) + "\n";
+    if (write_back) {
+      WriteBackStats wb = write_back->stats();
+      s += "write_back_appended " + to_string(wb.appended) + "\n" +
+           "write_back_syncs " + to_string(wb.syncs) + "\n" +
+           "write_back_flushes " + to_string(wb.flushes) + "\n" +
+           "write_back_flushed_keys " + to_string(wb.flushed_keys) + "\n" +
+           "write_back_flush_failures " + to_string(wb.flush_failures) +
+           "\n" + "write_back_pending " + to_string(wb.pending) + "\n";
+    }
+    res.set_content(s, "text/plain");
+  });
+
+  // Prometheus text format. Everything here is read from per-thread
+  // counters or existing stats, so a scrape does not slow down requests.
+  api.Get("/metrics", [&](const Request &, Response &res) {
+    MetricsWriter m;
+    m.family("kv_http_requests_total", "counter",
+             "HTTP requests by route and status class.");
+    for (auto &r : route_metrics) {
+      string l = "route=\"" + r.route + "\",code=";
+      const char *name = "kv_http_requests_total";
+      m.sample(name, l + "\"2xx\"", r.ok.value());
+      m.sample(name, l + "\"4xx\"", r.client_errors.value());
+      m.sample(name, l + "\"5xx\"", r.server_errors.value());
+    }
+    m.family("kv_http_request_duration_seconds", "histogram",
+             "Time spent in the route handler.");
+    for (auto &r : route_metrics)
+      m.histogram("kv_http_request_duration_seconds",
+                  "route=\"" + r.route + "\"", r.latency.snapshot());
+    m.family("kv_http_queue_depth", "gauge",
+             "Accepted connections waiting for an HTTP worker thread.");
+    m.sample("kv_http_queue_depth", "", queue_stats.queued.value());
+    m.family("kv_http_active_workers", "gauge",
+             "HTTP worker threads serving a connection.");
+    m.sample("kv_http_active_workers", "", queue_stats.active.value());
+    if (front) {
+      m.family("kv_http_open_connections", "gauge",
+               "Connections held by the epoll front end.");
+      m.sample("kv_http_open_connections", "", front->connection_count());
+      m.family("kv_http_inline_total", "counter",
+               "Requests answered on an epoll I/O thread.");
+      m.sample("kv_http_inline_total", "", front->inline_count());
+      m.family("kv_http_dispatched_total", "counter",
+               "Requests handed to a worker thread by the epoll front end.");
+      m.sample("kv_http_dispatched_total", "", front->dispatched_count());
+      m.family("kv_http_async_total", "counter",
+               "Requests answered from a DB callback, without a thread.");
+      m.sample("kv_http_async_total", "", front->async_count());
+    }
+    m.family("kv_http_refused_total", "counter",
+             "Connections closed because the HTTP queue was full.");
+    m.sample("kv_http_refused_total", "", queue_stats.refused.value());
+    m.family("kv_http_shed_total", "counter",
+             "Requests answered 503 because the HTTP queue was too deep.");
+    m.sample("kv_http_shed_total", "", shed.value());
+    if (peers) {
+      // Every worker exposes its own metrics; scrape each peer port.
+      string l = "worker=\"" + to_string(worker) + "\"";
+      m.family("kv_worker_forwarded_total", "counter",
+               "Requests passed on to the worker owning the key.");
+      m.sample("kv_worker_forwarded_total", l, peers->forwarded.value());
+      m.family("kv_worker_forward_errors_total", "counter",
+               "Requests whose owning worker could not be reached.");
+      m.sample("kv_worker_forward_errors_total", l, peers->errors.value());
+    }
+    if (db_limiter) {
+      m.family("kv_db_limit", "gauge",
+               "Current adaptive limit on concurrent DB work.");
+      m.sample("kv_db_limit", "", db_limiter->limit());
+      m.family("kv_db_in_flight", "gauge", "Admitted DB work in progress.");
+      m.sample("kv_db_in_flight", "", db_limiter->in_flight_count());
+      m.family("kv_db_rejected_total", "counter",
+               "Requests answered 503 by the DB concurrency limit.");
+      m.sample("kv_db_rejected_total", "", db_limiter->rejected_count());
+    }
+
+    CacheStats st = cache.stats();
+    m.family("kv_cache_hits_total", "counter", "Cache hits.");
+    m.sample("kv_cache_hits_total", "", st.hits);
+    m.family("kv_cache_misses_total", "counter", "Cache misses.");
+    m.sample("kv_cache_misses_total", "", st.misses);
+    m.family("kv_cache_evictions_total", "counter", "Cache evictions.");
+    m.sample("kv_cache_evictions_total", "", st.evictions);
+    m.family("kv_cache_admission_rejects_total", "counter",
+             "Values not cached because of the admission policy.");
+    m.sample("kv_cache_admission_rejects_total", "", st.rejected);
+    m.family("kv_cache_entries", "gauge", "Entries in the cache.");
+    m.sample("kv_cache_entries", "", st.entries);
+    m.family("kv_cache_bytes", "gauge", "Bytes charged to the cache.");
+    m.sample("kv_cache_bytes", "", st.bytes);
+    m.family("kv_cache_warmup_running", "gauge",
+             "1 while the startup warm-up is loading rows.");
+    m.sample("kv_cache_warmup_running", "",
+             warmup.current_state() == CacheWarmup::RUNNING);
+    m.family("kv_cache_warmup_rows_total", "counter",
+             "Rows the startup warm-up put into the cache.");
+    m.sample("kv_cache_warmup_rows_total", "", warmup.rows_loaded());
+    m.family("kv_negative_cache_hits_total", "counter",
+             "Lookups answered 404 by the negative cache.");
+    m.sample("kv_negative_cache_hits_total", "", missing.hit_count());
+    m.family("kv_db_fetches_total", "counter",
+             "DB fetches on the /val miss path.");
+    m.sample("kv_db_fetches_total", "",
+             val_flights.executed_count() + val_fetches.executed_count());
+    m.family("kv_db_fetches_coalesced_total", "counter",
+             "/val misses served by another request's DB fetch.");
+    m.sample("kv_db_fetches_coalesced_total", "",
+             val_flights.coalesced_count() + val_fetches.coalesced_count());
+
+    PoolStats ps = pool.stats();
+    m.family("kv_pool_connections", "gauge", "Pooled DB connections by state.");
+    m.sample("kv_pool_connections", "state=\"in_use\"", ps.in_use());
+    m.sample("kv_pool_connections", "state=\"idle\"", ps.idle);
+    m.family("kv_pool_waiters", "gauge", "Threads waiting for a connection.");
+    m.sample("kv_pool_waiters", "", ps.waiting);
+    m.family("kv_pool_acquire_timeouts_total", "counter",
+             "Acquires that gave up (answered 503).");
+    m.sample("kv_pool_acquire_timeouts_total", "", ps.timeouts);
+    m.family("kv_pool_connections_replaced_total", "counter",
+             "Broken connections closed and reopened.");
+    m.sample("kv_pool_connections_replaced_total", "", ps.replaced);
+    m.family("kv_pool_acquire_wait_seconds", "histogram",
+             "Time spent waiting for a pooled connection.");
+    m.histogram("kv_pool_acquire_wait_seconds", "", ps.wait);
+
+    if (pipeline) {
+      m.family("kv_db_pipeline_completed_total", "counter",
+               "Statements completed on the DB pipeline.");
+      m.sample("kv_db_pipeline_completed_total", "",
+               pipeline->completed_count());
+    }
+    if (writer) {
+      GroupCommitStats gc = writer->stats();
+      m.family("kv_group_commit_batches_total", "counter",
+               "Group-commit transactions.");
+      m.sample("kv_group_commit_batches_total", "", gc.batches);
+      m.family("kv_group_commit_ops_total", "counter",
+               "Writes applied through group commit.");
+      m.sample("kv_group_commit_ops_total", "", gc.ops);
+    }
+    if (invalidation) {
+      InvalidationStats iv = invalidation->stats();
+      m.family("kv_invalidation_published_total", "counter",
+               "Written ids announced to the other instances.");
+      m.sample("kv_invalidation_published_total", "", iv.published);
+      m.family("kv_invalidation_received_total", "counter",
+               "Ids evicted because another instance wrote them.");
+      m.sample("kv_invalidation_received_total", "", iv.received);
+      m.family("kv_invalidation_resets_total", "counter",
+               "Cache clears after missed invalidations.");
+      m.sample("kv_invalidation_resets_total", "", iv.resets);
+    }
+    m.family("kv_bulk_rows_total", "counter",
+             "Rows loaded by /bulk/import and sent by /bulk/export.");
+    m.sample("kv_bulk_rows_total", "direction=\"import\"",
+             bulk_imported.value());
+    m.sample("kv_bulk_rows_total", "direction=\"export\"",
+             bulk_exported.value());
+    if (write_back) {
+      WriteBackStats wb = write_back->stats();
+      m.family("kv_write_back_appended_total", "counter",
+               "Writes appended to the write-back log.");
+      m.sample("kv_write_back_appended_total", "", wb.appended);
+      m.family("kv_write_back_syncs_total", "counter",
+               "fdatasync calls on the write-back log.");
+      m.sample("kv_write_back_syncs_total", "", wb.syncs);
+      m.family("kv_write_back_flushed_keys_total", "counter",
+               "Keys applied to kv_store by the write-back flusher.");
+      m.sample("kv_write_back_flushed_keys_total", "", wb.flushed_keys);
+      m.family("kv_write_back_flush_failures_total", "counter",
+               "Write-back flushes that failed and will be retried.");
+      m.sample("kv_write_back_flush_failures_total", "", wb.flush_failures);
+      m.family("kv_write_back_pending_keys", "gauge",
+               "Keys written but not yet in kv_store.");
+      m.sample("kv_write_back_pending_keys", "", wb.pending);
+    }
+    res.set_content(m.text(), "text/plain; version=0.0.4");
+  });
+
+  // In write-back mode, a write kv_store does not have yet decides a read:
+  // answers it and returns true if id has one.
+  auto pending_write = [&](int id, Response &res) {
+    string value;
+    WriteBackLog::Pending p =
+        write_back ? write_back->lookup(id, value) : WriteBackLog::NONE;
+    if (p == WriteBackLog::VALUE) {
+      res.set_content(value, "text/plain");
+    } else if (p == WriteBackLog::DELETED) {
+      res.status = 404;
+      res.set_content("No value found for id: " + to_string(id),
+                      "text/plain");
+    }
+    return p != WriteBackLog::NONE;
+  };
+
+  // With the epoll front end, cache hits and ids known to be missing are
+  // answered on the I/O thread; only misses go to a worker thread.
+  RouteMetrics &val_route = route("/val");
+  if (front) {
+    front->serve_inline("GET", "/val", [&](const Request &req,
+                                           Response &res) {
+      auto t0 = chrono::steady_clock::now();
+      int id_int = parse_id(req.get_param_value("id"));
+      if (id_int == -1 || (peers && !peers->is_local(id_int)))
+        return false;
+      string cached_value;
+      if (cache.try_get(id_int, cached_value)) {
+        res.status = 200;
+        res.set_content(cached_value, "text/plain");
+      } else if (missing.contains(id_int)) {
+        res.status = 404;
+        res.set_content("No value found for id: " + to_string(id_int),
+                        "text/plain");
+      } else {
+        return false;
+      }
+      val_route.record(res.status, chrono::steady_clock::now() - t0);
+      return true;
+    });
+  }
+
+  // With the epoll front end and the DB pipeline, DB work does not hold a
+  // worker thread either (KV_DB_ASYNC=0 turns it off): /val misses, /save
+  // and /delete are sent on the pipeline from the I/O thread and answered
+  // from the pipeline's callback. Writes only without group commit or
+  // write-back, which have their own path.
+  RouteMetrics &save_route = route("/save");
+  RouteMetrics &delete_route = route("/delete");
+  if (front && pipeline && env_or("KV_DB_ASYNC", 1)) {
+    // Takes a limiter permit like DbPermit and gives it back with the
+    // statement's latency. done runs on a pipeline thread (or right here
+    // when not admitted), so it must be short.
+    auto submit_db = [&](const string &statement, vector<string> params,
+                         function<void(DbOutcome)> done) {
+      AdaptiveLimiter *limiter = db_limiter.get();
+      if (limiter && !limiter->try_acquire()) {
+        done({PgReply(), make_exception_ptr(Overloaded())});
+        return;
+      }
+      auto start = chrono::steady_clock::now();
+      pipeline->submit(statement, std::move(params),
+                       [limiter, start, done](PgReply r) {
+        if (limiter)
+          limiter->release(chrono::steady_clock::now() - start, r.ok);
+        exception_ptr error;
+        if (!r.ok)
+          error = make_exception_ptr(runtime_error(r.error));
+        done({std::move(r), error});
+      });
+    };
+    // Requests these do not take (bad input, other workers' keys) go to
+    // the usual handlers.
+    auto local_id = [&](const Request &req) {
+      int id = parse_id(req.get_param_value("id"));
+      return id != -1 && (!peers || peers->is_local(id)) ? id : -1;
+    };
+    auto send = [](const EpollServer::Reply &reply, RouteMetrics &m,
+                   chrono::steady_clock::time_point t0, Response &res) {
+      m.record(res.status, chrono::steady_clock::now() - t0);
+      reply(res);
+    };
+
+    front->serve_async("GET", "/val", [&, local_id, submit_db, send](
+                                          const Request &req,
+                                          EpollServer::Reply reply) {
+      auto t0 = chrono::steady_clock::now();
+      int id_int = local_id(req);
+      if (id_int == -1)
+        return false;
+      Response res;
+      string cached_value;
+      if (cache.get(id_int, cached_value)) { // filled since the inline check
+        res.set_content(cached_value, "text/plain");
+        send(reply, val_route, t0, res);
+        return true;
+      }
+      if (pending_write(id_int, res)) {
+        send(reply, val_route, t0, res);
+        return true;
+      }
+      bool leader = val_fetches.join(
+          id_int, [&, id_int, t0, reply, send](const DbOutcome &o) {
+        Response res;
+        if (o.error) {
+          db_error(res, o.error);
+        } else if (o.reply.rows.empty()) {
+          res.status = 404;
+          res.set_content("No value found for id: " + to_string(id_int),
+                          "text/plain");
+        } else {
+          res.set_content(o.reply.rows[0][0], "text/plain");
+        }
+        send(reply, val_route, t0, res);
+      });
+      if (leader) {
+        // A /save landing during the read keeps the id out of missing
+        uint64_t since = missing.stamp(id_int);
+        submit_db("kv_get", {to_string(id_int)},
+                  [&, id_int, since](DbOutcome o) {
+          if (!o.error && o.reply.rows.empty())
+            missing.insert(id_int, since);
+          else if (!o.error)
+            cache.fill(id_int, o.reply.rows[0][0]);
+          val_fetches.finish(id_int, o);
+        });
+      }
+      return true;
+    });
+
+    if (!writer && !write_back) {
+      front->serve_async("POST", "/save", [&, local_id, submit_db, send](
+                                              const Request &req,
+                                              EpollServer::Reply reply) {
+        auto t0 = chrono::steady_clock::now();
+        int id_int = local_id(req);
+        if (id_int == -1 || !req.has_param("val"))
+          return false;
+        string val = req.get_param_value("val");
+        submit_db("kv_upsert", {to_string(id_int), val},
+                  [&, id_int, val, t0, reply, send](DbOutcome o) {
+          Response res;
+          if (o.error) {
+            db_error(res, o.error);
+          } else {
+            cache.put(id_int, val);
+            missing.erase(id_int);
+            announce({id_int});
+            res.set_content("Key saved/updated: " + to_string(id_int),
+                            "text/plain");
+          }
+          send(reply, save_route, t0, res);
+        });
+        return true;
+      });
+
+      front->serve_async("DELETE", "/delete", [&, local_id, submit_db, send](
+                                                  const Request &req,
+                                                  EpollServer::Reply reply) {
+        auto t0 = chrono::steady_clock::now();
+        int id_int = local_id(req);
+        if (id_int == -1)
+          return false;
+        submit_db("kv_delete", {to_string(id_int)},
+                  [&, id_int, t0, reply, send](DbOutcome o) {
+          Response res;
+          if (o.error) {
+            db_error(res, o.error);
+          } else if (o.reply.affected_rows == 0) {
+            missing.insert(id_int);
+            res.status = 404;
+            res.set_content("No entry for ID: " + to_string(id_int),
+                            "text/plain");
+          } else {
+            missing.insert(id_int);
+            cache.erase(id_int);
+            announce({id_int});
+            res.set_content("Deleted ID: " + to_string(id_int), "text/plain");
+          }
+          send(reply, delete_route, t0, res);
+        });
+        return true;
+      });
+    }
+  }
+
+  // Runs a kv_*_many statement on the pipeline or a pooled connection and
+  // returns its rows as text.
+  auto exec_many = [&](const string &statement, vector<string> params) {
+    DbPermit permit(db_limiter.get());
+    if (pipeline)
+      return pipelined(*pipeline, statement, std::move(params)).rows;
+    vector<vector<string>> rows;
+    db::connection *conn = pool.acquire();
+    try {
+      db::nontransaction txn{*conn};
+      db::result r =
+          params.size() == 1   ? txn.exec_prepared(statement, params[0])
+          : params.size() == 2 ? txn.exec_prepared(statement, params[0],
+                                                   params[1])
+                               : txn.exec_prepared(statement, params[0],
+                                                   params[1], params[2]);
+      pool.release(conn);
+      conn = nullptr;
+      for (const auto &row : r) {
+        vector<string> cols;
+        for (size_t c = 0; c < row.size(); c++)
+          cols.push_back(row[c].as<string>());
+        rows.push_back(std::move(cols));
+      }
+    } catch (...) {
+      if (conn)
+        pool.release(conn);
+      throw;
+    }
+    return rows;
+  };
+
   // GET
-  srv.Get("/val", [&](const Request &req, Response &res) {
+  api.Get("/val",
+          timed(val_route, [&](const Request &req, Response &res) {
     //cout<<"GET";
     if (!req.has_param("id")) {
       res.status = 400;
@@ -101,34 +1191,71 @@ int main() {
       return;
     }
 
-    db::connection *conn = nullptr;
+    if (missing.contains(id_int)) {
+      res.status = 404;
+      res.set_content("No value found for id: " + to_string(id_int),
+                      "text/plain");
+      return;
+    }
+
+    if (pending_write(id_int, res))
+      return;
+
+    // Concurrent misses on the same key share one DB fetch; waiters get the
+    // leader's value (nullopt = no such row) or its exception.
     try {
-      conn = pool.acquire();
-      db::work txn{*conn};
-      db::result r =
-          txn.exec_params("SELECT value FROM kv_store WHERE id = $1", id_int);
-      txn.commit();
-      pool.release(conn);
+      optional<string> db_val = val_flights.run(id_int, [&] {
+        DbPermit permit(db_limiter.get());
+        // A /save landing during the read keeps the id out of missing
+        uint64_t since = missing.stamp(id_int);
+        optional<string> found;
+        if (pipeline) {
+          PgReply r = pipelined(*pipeline, "kv_get", {to_string(id_int)});
+          if (!r.rows.empty()) {
+            found = r.rows[0][0];
+            cache.fill(id_int, *found);
+          } else {
+            missing.insert(id_int, since);
+          }
+          return found;
+        }
+        db::connection *conn = nullptr;
+        try {
+          // A single SELECT needs no BEGIN/COMMIT: one round trip.
+          conn = pool.acquire();
+          db::nontransaction txn{*conn};
+          db::result r = txn.exec_prepared("kv_get", id_int);
+          pool.release(conn);
+          conn = nullptr;
+          if (!r.empty()) {
+            found = r[0][0].as<string>();
+            cache.fill(id_int, *found);
+          } else {
+            missing.insert(id_int, since);
+          }
+        } catch (...) {
+          if (conn)
+            pool.release(conn);
+          throw;
+        }
+        return found;
+      });
 
-      if (r.empty()) {
+      if (!db_val) {
         res.status = 404;
         res.set_content("No value found for id: " + to_string(id_int),
                         "text/plain");
       } else {
-        string db_val = r[0][0].as<string>();
-        cache.put(id_int, db_val);
-        res.set_content(db_val, "text/plain");
+        res.set_content(*db_val, "text/plain");
       }
     } catch (const std::exception &e) {
-      if (conn)
-        pool.release(conn);
-      res.status = 500;
-      res.set_content(string("Database error: ") + e.what(), "text/plain");
+      db_error(res, e);
     }
-  });
+  }));
 
   // POST
-  srv.Post("/save", [&](const Request &req, Response &res) {
+  api.Post("/save",
+           timed(save_route, [&](const Request &req, Response &res) {
     if (!req.has_param("id") || !req.has_param("val")) {
       res.status = 400;
       res.set_content("Error: Missing 'id' or 'val'.", "text/plain");
@@ -148,30 +1275,38 @@ int main() {
     db::connection *conn = nullptr;
 
     try {
-      conn = pool.acquire();
-      db::work txn{*conn};
-
-      // Use the UPSERT command
-      const string sql = "INSERT INTO kv_store (id, value) VALUES ($1, $2) "
-                         "ON CONFLICT (id) DO UPDATE SET value = $2";
-
-      txn.exec_params(sql, id_int, val);
-      txn.commit();
-      pool.release(conn);
+      DbPermit permit(write_back ? nullptr : db_limiter.get());
+      if (write_back) {
+        write_back->save(id_int, val);
+      } else if (writer) {
+        writer->save(id_int, val);
+      } else if (pipeline) {
+        pipelined(*pipeline, "kv_upsert", {to_string(id_int), val});
+      } else {
+        // Single-statement UPSERT in autocommit: it is committed (and
+        // durable) when exec returns, without a BEGIN/COMMIT round trip.
+        conn = pool.acquire();
+        db::nontransaction txn{*conn};
+        txn.exec_prepared("kv_upsert", id_int, val);
+        pool.release(conn);
+        conn = nullptr;
+      }
 
       cache.put(id_int, val);
+      missing.erase(id_int);
+      announce({id_int});
       res.set_content("Key saved/updated: " + to_string(id_int), "text/plain");
 
     } catch (const std::exception &e) {
       if (conn)
         pool.release(conn);
-      res.status = 500;
-      res.set_content(string("Database error: ") + e.what(), "text/plain");
+      db_error(res, e);
     }
-  });
+  }));
 
   // DELETE
-  srv.Delete("/delete", [&](const Request &req, Response &res) {
+  api.Delete("/delete",
+             timed(delete_route, [&](const Request &req, Response &res) {
     if (!req.has_param("id")) {
       res.status = 400;
       res.set_content("Error: Missing 'id'.", "text/plain");
@@ -189,30 +1324,405 @@ int main() {
 
     db::connection *conn = nullptr;
     try {
-      db::connection *conn = pool.acquire();
-      db::work txn{*conn};
-      db::result r =
-          txn.exec_params("DELETE FROM kv_store WHERE id = $1", id_int);
-      txn.commit();
-      pool.release(conn);
+      DbPermit permit(write_back ? nullptr : db_limiter.get());
+      bool existed;
+      if (write_back) {
+        // kv_store may be behind: ask the log and the caches first.
+        string v;
+        WriteBackLog::Pending p = write_back->lookup(id_int, v);
+        if (p != WriteBackLog::NONE)
+          existed = p == WriteBackLog::VALUE;
+        else if (cache.try_get(id_int, v))
+          existed = true;
+        else if (missing.contains(id_int))
+          existed = false;
+        else
+          existed = !exec_many("kv_get_many", {pg_int_array({id_int})})
+                         .empty();
+        if (existed)
+          write_back->remove(id_int);
+      } else if (writer) {
+        existed = writer->remove(id_int);
+      } else if (pipeline) {
+        existed = pipelined(*pipeline, "kv_delete", {to_string(id_int)})
+                      .affected_rows > 0;
+      } else {
+        conn = pool.acquire();
+        db::nontransaction txn{*conn};
+        db::result r = txn.exec_prepared("kv_delete", id_int);
+        pool.release(conn);
+        conn = nullptr;
+        existed = r.affected_rows() > 0;
+      }
 
-      if (r.affected_rows() == 0) {
+      missing.insert(id_int);
+      if (!existed) {
         res.status = 404;
         res.set_content("No entry for ID: " + to_string(id_int), "text/plain");
       } else {
         cache.erase(id_int);
+        announce({id_int});
         res.set_content("Deleted ID: " + to_string(id_int), "text/plain");
       }
     } catch (const std::exception &e) {
       if (conn)
         pool.release(conn);
-      res.status = 500;
-      res.set_content(string("Database error: ") + e.what(), "text/plain");
+      db_error(res, e);
     }
-  });
+  }));
+
+  // Multi-key endpoints. Bodies hold one record per line (see KVText.h):
+  // "id" for /mget and /mdelete, "id<TAB>value" for /mset. Each request
+  // costs at most one DB statement, however many keys it carries.
+
+  // Response: one line per requested id, in request order - "id<TAB>value"
+  // when found, a bare "id" when not.
+  api.Post("/mget",
+           timed(route("/mget"), [&](const Request &req, Response &res) {
+    vector<int> ids;
+    string bad;
+    if (!parse_id_lines(req.body, ids, bad)) {
+      res.status = 400;
+      res.set_content("Invalid ID: " + bad, "text/plain");
+      return;
+    }
+    if (ids.size() > batch_max) {
+      res.status = 413;
+      res.set_content("Too many keys (max " + to_string(batch_max) + ")",
+                      "text/plain");
+      return;
+    }
+
+    unordered_map<int, string> found;
+    vector<int> misses;
+    for (int id : ids) {
+      string v;
+      if (cache.get(id, v)) {
+        found[id] = v;
+        continue;
+      }
+      if (missing.contains(id))
+        continue;
+      WriteBackLog::Pending p =
+          write_back ? write_back->lookup(id, v) : WriteBackLog::NONE;
+      if (p == WriteBackLog::VALUE)
+        found[id] = v;
+      else if (p == WriteBackLog::NONE)
+        misses.push_back(id);
+    }
+    sort(misses.begin(), misses.end());
+    misses.erase(unique(misses.begin(), misses.end()), misses.end());
+
+    if (!misses.empty()) {
+      vector<uint64_t> since;
+      for (int id : misses)
+        since.push_back(missing.stamp(id));
+      try {
+        for (auto &row : exec_many("kv_get_many", {pg_int_array(misses)})) {
+          int id = stoi(row[0]);
+          cache.fill(id, row[1]);
+          found[id] = std::move(row[1]);
+        }
+      } catch (const std::exception &e) {
+        db_error(res, e);
+        return;
+      }
+      for (size_t i = 0; i < misses.size(); i++)
+        if (!found.count(misses[i]))
+          missing.insert(misses[i], since[i]);
+    }
+
+    string body;
+    for (int id : ids) {
+      body += to_string(id);
+      auto it = found.find(id);
+      if (it != found.end())
+        body += '\t' + escape_value(it->second);
+      body += '\n';
+    }
+    res.set_content(body, "text/plain");
+  }));
+
+  api.Post("/mset",
+           timed(route("/mset"), [&](const Request &req, Response &res) {
+    vector<pair<int, string>> pairs;
+    string bad;
+    if (!parse_pair_lines(req.body, pairs, bad)) {
+      res.status = 400;
+      res.set_content("Invalid line: " + bad, "text/plain");
+      return;
+    }
+    if (pairs.size() > batch_max) {
+      res.status = 413;
+      res.set_content("Too many keys (max " + to_string(batch_max) + ")",
+                      "text/plain");
+      return;
+    }
+
+    // One upsert cannot touch a row twice: the last value for an id wins.
+    map<int, string> latest;
+    for (auto &p : pairs)
+      latest[p.first] = std::move(p.second);
+    vector<int> ids;
+    vector<string> vals;
+    for (auto &kv : latest) {
+      ids.push_back(kv.first);
+      vals.push_back(kv.second);
+    }
+
+    try {
+      if (write_back) {
+        WriteBackLog::Changes changes;
+        for (auto &kv : latest)
+          changes[kv.first] = kv.second;
+        write_back->apply(changes);
+      } else if (!ids.empty()) {
+        exec_many("kv_upsert_many", {pg_int_array(ids), pg_text_array(vals)});
+      }
+    } catch (const std::exception &e) {
+      db_error(res, e);
+      return;
+    }
+    for (auto &kv : latest) {
+      cache.put(kv.first, kv.second);
+      missing.erase(kv.first);
+    }
+    announce(ids);
+    res.set_content("Keys saved/updated: " + to_string(ids.size()),
+                    "text/plain");
+  }));
+
+  // Response: the ids that existed and were deleted, one per line.
+  api.Delete("/mdelete",
+             timed(route("/mdelete"), [&](const Request &req, Response &res) {
+    vector<int> ids;
+    string bad;
+    if (!parse_id_lines(req.body, ids, bad)) {
+      res.status = 400;
+      res.set_content("Invalid ID: " + bad, "text/plain");
+      return;
+    }
+    if (ids.size() > batch_max) {
+      res.status = 413;
+      res.set_content("Too many keys (max " + to_string(batch_max) + ")",
+                      "text/plain");
+      return;
+    }
+    sort(ids.begin(), ids.end());
+    ids.erase(unique(ids.begin(), ids.end()), ids.end());
+
+    string body;
+    try {
+      if (write_back) {
+        // Which ids exist: the log and the caches, then kv_store for the
+        // rest (one read, no write).
+        WriteBackLog::Changes changes;
+        vector<int> unknown;
+        for (int id : ids) {
+          string v;
+          WriteBackLog::Pending p = write_back->lookup(id, v);
+          if (p == WriteBackLog::VALUE || (p == WriteBackLog::NONE &&
+                                           cache.try_get(id, v)))
+            changes[id] = nullopt;
+          else if (p == WriteBackLog::NONE && !missing.contains(id))
+            unknown.push_back(id);
+        }
+        if (!unknown.empty())
+          for (auto &row : exec_many("kv_get_many", {pg_int_array(unknown)}))
+            changes[stoi(row[0])] = nullopt;
+        write_back->apply(changes);
+        for (auto &kv : changes)
+          body += to_string(kv.first) + "\n";
+      } else if (!ids.empty()) {
+        vector<int> deleted;
+        for (auto &row : exec_many("kv_delete_many", {pg_int_array(ids)})) {
+          body += row[0] + "\n";
+          deleted.push_back(stoi(row[0]));
+        }
+        announce(deleted);
+      }
+    } catch (const std::exception &e) {
+      db_error(res, e);
+      return;
+    }
+    for (int id : ids) {
+      cache.erase(id);
+      missing.insert(id);
+    }
+    res.set_content(body, "text/plain");
+  }));
+
+  // Bulk load and dump of kv_store in COPY text format: one "id<TAB>value"
+  // per line, as in /mset (BulkCopy.h). Both bodies are streamed between
+  // the client and Postgres COPY, never held whole, on a connection of
+  // their own; at most KV_BULK_MAX transfers run at once (more get 503).
+  //
+  // An import is one transaction that upserts every line (the last one for
+  // an id wins). After it commits, the imported ids are evicted from the
+  // caches - this worker's, the other workers' and, with KV_INVALIDATION,
+  // other instances' - or the caches are cleared if there were more than
+  // kBulkEvictMax of them.
+  //
+  // In write-back mode both first wait until the writes every worker has
+  // acknowledged are in kv_store (the import waits again before it
+  // commits), so an export has them and they cannot be flushed over an
+  // import later. If a log cannot be flushed (the DB is down) they get 503.
+  const size_t kBulkEvictMax = 100000;
+  auto drain_writes = [&] {
+    if (!write_back)
+      return true;
+    bool ok = write_back->drain();
+    if (peers) {
+      Request drain;
+      drain.method = "POST";
+      drain.target = "/bulk/drain";
+      for (int w = 0; w < workers; w++) {
+        Response reply;
+        if (w != worker &&
+            (!peers->forward(w, drain, "", reply) || reply.status != 200))
+          ok = false;
+      }
+    }
+    return ok;
+  };
+  auto evict_imported = [&](const BulkImport &copy) {
+    const vector<int> &ids = copy.ids();
+    if (copy.complete()) {
+      for (int id : ids) {
+        cache.erase(id);
+        missing.erase(id);
+      }
+    } else {
+      cache.clear();
+      missing.clear();
+    }
+    if (peers) {
+      vector<string> parts(workers);
+      for (int id : ids)
+        parts[peers->owner(id)] += to_string(id) + "\n";
+      Request evict;
+      evict.method = "POST";
+      evict.target = "/bulk/evict";
+      for (int w = 0; w < workers; w++) {
+        if (w == worker || (copy.complete() && parts[w].empty()))
+          continue;
+        Response ignored;
+        if (!peers->forward(w, evict, copy.complete() ? parts[w] : "*",
+                            ignored))
+          cerr << "/bulk/import: could not reach worker " << w << endl;
+      }
+    }
+    if (invalidation) {
+      if (copy.complete())
+        invalidation->publish(ids);
+      else
+        invalidation->publish_all();
+    }
+  };
+  if (peer_srv) {
+    peer_srv->Post("/bulk/evict", [&](const Request &req, Response &res) {
+      if (req.body == "*") {
+        cache.clear();
+        missing.clear();
+      }
+      vector<int> ids;
+      string bad;
+      parse_id_lines(req.body, ids, bad);
+      for (int id : ids) {
+        cache.erase(id);
+        missing.erase(id);
+      }
+      res.set_content("ok", "text/plain");
+    });
+    peer_srv->Post("/bulk/drain", [&](const Request &, Response &res) {
+      if (write_back && !write_back->drain())
+        overloaded(res, "write-back log could not be flushed");
+      else
+        res.set_content("ok", "text/plain");
+    });
+  }
+
+  api.Post("/bulk/import",
+           timed(route("/bulk/import"), [&](const Request &, Response &res,
+                                            const ContentReader &read) {
+    if (!drain_writes()) {
+      overloaded(res, "write-back log could not be flushed; "
+                      "nothing imported");
+      return;
+    }
+    try {
+      BulkImport copy(conn_str, bulk_limit, kBulkEvictMax);
+      exception_ptr failed;
+      bool whole = read([&](const char *data, size_t len) {
+        try {
+          copy.write(data, len);
+          return true;
+        } catch (...) {
+          failed = current_exception();
+          return false;
+        }
+      });
+      if (failed)
+        rethrow_exception(failed);
+      if (!whole) {
+        res.status = 400;
+        res.set_content("Request body incomplete; nothing imported",
+                        "text/plain");
+        return;
+      }
+      if (!drain_writes()) { // writes acknowledged during the upload
+        overloaded(res, "write-back log could not be flushed; "
+                        "nothing imported");
+        return;
+      }
+      size_t rows = copy.commit();
+      bulk_imported.add(rows);
+      evict_imported(copy);
+      res.set_content("Keys imported: " + to_string(rows), "text/plain");
+    } catch (const std::exception &e) {
+      auto *bulk = dynamic_cast<const BulkError *>(&e);
+      if (bulk && bulk->bad_input) {
+        res.status = 400;
+        res.set_content(string("Invalid import: ") + e.what(), "text/plain");
+      } else {
+        db_error(res, e);
+      }
+    }
+  }));
+
+  api.Get("/bulk/export",
+          timed(route("/bulk/export"), [&](const Request &, Response &res) {
+    if (!drain_writes()) {
+      overloaded(res, "write-back log could not be flushed");
+      return;
+    }
+    shared_ptr<BulkExport> copy;
+    try {
+      copy = make_shared<BulkExport>(conn_str, bulk_limit);
+    } catch (const std::exception &e) {
+      db_error(res, e);
+      return;
+    }
+    res.set_chunked_content_provider(
+        "text/plain", [&, copy](size_t, DataSink &sink) {
+      string rows;
+      try {
+        bulk_exported.add(copy->read(rows, 64 * 1024));
+      } catch (const std::exception &e) {
+        cerr << "/bulk/export failed: " << e.what() << endl;
+        return false;
+      }
+      if (!rows.empty() && !sink.write(rows.data(), rows.size()))
+        return false;
+      if (copy->done())
+        sink.done();
+      return true;
+    });
+  }));
 
   // GET No Cache
-  srv.Get("/nocache/val", [&](const Request &req, Response &res) {
+  api.Get("/nocache/val",
+          timed(route("/nocache/val"), [&](const Request &req, Response &res) {
     if (!req.has_param("id")) {
       res.status = 400;
       res.set_content("Error: 'id' parameter is missing.", "text/plain");
@@ -230,30 +1740,177 @@ int main() {
 
     db::connection *conn = nullptr;
     try {
-      db::connection *conn = pool.acquire();
-      db::work txn{*conn};
-      db::result r =
-          txn.exec_params("SELECT value FROM kv_store WHERE id = $1", id_int);
-      txn.commit();
-      pool.release(conn);
+      DbPermit permit(db_limiter.get());
+      optional<string> db_val;
+      if (pipeline) {
+        PgReply r = pipelined(*pipeline, "kv_get", {to_string(id_int)});
+        if (!r.rows.empty())
+          db_val = r.rows[0][0];
+      } else {
+        conn = pool.acquire();
+        db::nontransaction txn{*conn};
+        db::result r = txn.exec_prepared("kv_get", id_int);
+        pool.release(conn);
+        conn = nullptr;
+        if (!r.empty())
+          db_val = r[0][0].as<string>();
+      }
 
-      if (r.empty()) {
+      if (!db_val) {
         res.status = 404;
         res.set_content("No value found for id: " + to_string(id_int),
                         "text/plain");
       } else {
-        string db_val = r[0][0].as<string>();
-        res.set_content(db_val, "text/plain");
+        res.set_content(*db_val, "text/plain");
       }
     } catch (const std::exception &e) {
       if (conn)
         pool.release(conn);
-      res.status = 500;
-      res.set_content(string("Database error: ") + e.what(), "text/plain");
+      db_error(res, e);
     }
-  });
+  }));
 
-  cout << "🚀 Server running on http://localhost:1234 ..." << endl;
-  srv.listen("0.0.0.0", 1234);
+  // Range scan in id order: "id<TAB>value" lines for from <= id <= to (both
+  // optional), at most limit rows (0 = no limit). The body is streamed as
+  // it is read, KV_SCAN_BATCH rows per statement starting after the last id
+  // sent, so memory does not grow with the range and no DB connection is
+  // held while the client reads. The last line is "end", or "next<TAB>id"
+  // when the limit stopped the scan: repeat the request with from=id to go
+  // on. Like /nocache/val it reads kv_store and bypasses the cache.
+  struct Scan {
+    int next;  // first id not sent yet
+    int to;
+    long left; // rows the limit still allows, -1 = no limit
+    long asked = 0;
+    vector<vector<string>> rows; // the batch to send next
+  };
+  auto scan_fetch = [&](Scan &s) {
+    s.asked = s.left < 0 ? scan_batch : min(scan_batch, s.left);
+    s.rows = exec_many("kv_scan", {to_string(s.next), to_string(s.to),
+                                   to_string(s.asked)});
+  };
+  api.Get("/scan",
+          timed(route("/scan"), [&](const Request &req, Response &res) {
+    int from = 0, to = INT_MAX, limit = 0;
+    for (auto p : {make_pair("from", &from), make_pair("to", &to),
+                   make_pair("limit", &limit)}) {
+      if (req.has_param(p.first) &&
+          !parse_kv_id(req.get_param_value(p.first), *p.second)) {
+        res.status = 400;
+        res.set_content(string("Invalid ") + p.first, "text/plain");
+        return;
+      }
+    }
+    auto scan =
+        make_shared<Scan>(Scan{from, to, limit > 0 ? limit : -1, 0, {}});
+    // The first batch is read here, so a failure still gets its status.
+    if (from <= to) {
+      try {
+        scan_fetch(*scan);
+      } catch (const std::exception &e) {
+        db_error(res, e);
+        return;
+      }
+    }
+
+    res.set_chunked_content_provider(
+        "text/plain", [&, scan](size_t, DataSink &sink) {
+      Scan &s = *scan;
+      string chunk;
+      for (auto &row : s.rows) {
+        chunk += row[0] + '\t' + escape_value(row[1]) + '\n';
+        if (chunk.size() >= 64 * 1024) {
+          if (!sink.write(chunk.data(), chunk.size()))
+            return false;
+          chunk.clear();
+        }
+      }
+      bool more = s.next <= s.to && (long)s.rows.size() == s.asked;
+      if (!s.rows.empty()) {
+        int last = stoi(s.rows.back()[0]);
+        more = more && last < s.to;
+        if (more)
+          s.next = last + 1;
+      }
+      if (s.left > 0)
+        s.left -= s.rows.size();
+      s.rows = {};
+      if (more && s.left == 0)
+        chunk += "next\t" + to_string(s.next) + "\n";
+      else if (!more)
+        chunk += "end\n";
+      // An empty write would tell httplib the body is over.
+      if (!chunk.empty() && !sink.write(chunk.data(), chunk.size()))
+        return false;
+      if (!more || s.left == 0) {
+        sink.done();
+        return true;
+      }
+      try {
+        scan_fetch(s);
+      } catch (const std::exception &e) {
+        cerr << "/scan stopped at id " << s.next << ": " << e.what() << endl;
+        return false;
+      }
+      return true;
+    });
+  }));
+
+  // Warm the cache in the background while already serving traffic.
+  if (env_or("KV_WARMUP", 1))
+    warmup.start();
+
+  thread peer_thread;
+  auto stop_peer = [&] {
+    if (peer_thread.joinable()) {
+      peer_srv->wait_until_ready();
+      peer_srv->stop();
+      peer_thread.join();
+    }
+  };
+  if (peer_srv) {
+    if (!peer_srv->bind_to_port("127.0.0.1", peers->port(worker))) {
+      cerr << "Could not bind to peer port " << peers->port(worker) << endl;
+      return 1;
+    }
+    peer_thread = thread([&] { peer_srv->listen_after_bind(); });
+  }
+  // Both front ends set SO_REUSEPORT, so every worker binds 1234.
+  bool bound = front ? front->bind_to_port("0.0.0.0", 1234)
+                     : srv.bind_to_port("0.0.0.0", 1234);
+  if (!bound) {
+    cerr << "Could not bind to port 1234" << endl;
+    stop_peer();
+    return 1;
+  }
+  if (worker == 0)
+    cout << "🚀 Server running on http://localhost:1234 ..." << endl;
+  if (front) {
+    running_front = front.get();
+    front->listen_after_bind();
+  } else {
+    running_server = &srv;
+    srv.listen_after_bind();
+  }
+  stop_peer();
+
+  warmup.stop();
+  if (write_back) {
+    write_back->stop(); // last flush
+    uint64_t left = write_back->stats().pending;
+    if (left)
+      cerr << "Write-back: " << left << " keys not flushed, kept in "
+           << wb_path << " for the next start" << endl;
+  }
+  if (!hot_keys_file.empty()) {
+    if (CacheWarmup::save_hot_keys(cache, hot_keys_file))
+      cout << "Saved " << cache.size() << " hot keys to " << hot_keys_file
+           << endl;
+    else
+      cerr << "Could not write " << hot_keys_file << endl;
+  }
+  if (trace)
+    cout << "Traced " << trace->records() << " key accesses to " << trace_file
+         << endl;
   return 0;
 }
\ No newline at end of file